@@ -0,0 +1,67 @@
+"""
+Save benchmark results as JSON and compare a run against an earlier one.
+
+A result file is {"kind", "env", "results": {case: {metric: value}}}. Metrics named in
+HIGHER_IS_BETTER improve upward (throughput); every other metric is a cost (latency, time per op).
+"""
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+HIGHER_IS_BETTER = {"rps", "ops_per_s"}
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(RESULTS_DIR), timeout=5).stdout.strip()
+    except Exception:
+        commit = ""
+    return {
+        "commit": commit or "unknown",
+        "time": datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+def save(kind: str, results: dict, extra_env: dict = None, path: str = None) -> str:
+    """Write results; also refresh <kind>-latest.json so --compare has a default baseline."""
+    env = {**environment(), **(extra_env or {})}
+    doc = {"kind": kind, "env": env, "results": results}
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    if path is None:
+        stamp = env["time"].replace(":", "").replace("-", "")
+        path = os.path.join(RESULTS_DIR, f"{kind}-{stamp}-{env['commit']}.json")
+    for p in (path, os.path.join(RESULTS_DIR, f"{kind}-latest.json")):
+        with open(p, "w", encoding="utf-8") as f:
+            json.dump(doc, f, indent=2, sort_keys=True)
+    return path
+
+def load(path: str) -> dict:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def compare(current: dict, baseline: dict, threshold: float = 0.10) -> int:
+    """Print case/metric changes vs baseline; returns how many got worse by more than threshold."""
+    base = baseline.get("results", baseline)
+    regressions = 0
+    print(f"\ncompared with {baseline.get('env', {}).get('commit', '?')} "
+          f"({baseline.get('env', {}).get('time', '?')}), threshold {threshold:.0%}")
+    print(f"{'case':<34} {'metric':<12} {'baseline':>12} {'current':>12} {'change':>8}")
+    for case, metrics in current.items():
+        for metric, value in metrics.items():
+            old = base.get(case, {}).get(metric)
+            if not isinstance(value, (int, float)) or not isinstance(old, (int, float)) or not old:
+                continue
+            change = (value - old) / old
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            flag = ""
+            if worse > threshold:
+                regressions += 1
+                flag = "  REGRESSION"
+            print(f"{case:<34} {metric:<12} {old:>12.4g} {value:>12.4g} {change:>+7.1%}{flag}")
+    return regressions
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Load driver: replays JSONL traffic against the API and reports latency percentiles and RPS.
+
+    # fully offline: starts the Anthropic mock and the API on free ports, then drives them
+    python benchmarks/load.py --spawn --duration 20 --concurrency 32 --save
+
+    # against a running server
+    python benchmarks/load.py --target http://127.0.0.1:8080 --traffic requests.jsonl
+
+Traffic lines are either explicit requests
+    {"method": "POST", "path": "/count", "json": {...}}        (optional "params" for the query string)
+or anything with prompt-like text in "text", "prompt", "body" or "title" (requests.jsonl-style);
+those are turned into calls according to --mix, e.g. "score=4,count=4,rewrite=1,rewrite_stream=1,ingest=2".
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+import bench_results
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+DEFAULT_MIX = "score=4,count=4,rewrite=1,rewrite_stream=1,ingest=2"
+FALLBACK_PROMPTS = [
+    "Summarize this article in 3 bullet points.",
+    "please can you very kindly explain how our API endpoint handles errors in a detailed manner",
+    "Extract every invoice number and total from the text below and return only JSON with fields id, total.",
+    "Write a SQL query that ranks customers by 2024 revenue; at most 10 rows.",
+]
+
+def _build_call(kind: str, text: str, i: int) -> dict:
+    if kind == "score":
+        return {"method": "POST", "path": "/score", "json": {"text": text}}
+    if kind == "count":
+        return {"method": "POST", "path": "/count", "json": {"text": text, "expected_output_tokens": 300}}
+    if kind == "count_local":
+        return {"method": "POST", "path": "/count", "json": {"text": text, "mode": "local"}}
+    if kind == "rewrite":
+        return {"method": "POST", "path": "/rewrite", "json": {"text": text}}
+    if kind == "rewrite_stream":
+        return {"method": "POST", "path": "/rewrite/stream", "json": {"text": text}}
+    if kind == "ingest":
+        return {"method": "POST", "path": "/session/ingest",
+                "json": {"session_id": f"load-{i % 200}", "tokens_input": max(1, len(text) // 4),
+                         "tokens_total": max(1, len(text) // 4) + 300}}
+    raise ValueError(f"unknown mix entry: {kind}")
+
+def load_traffic(path: str, mix: str, total: int, seed: int) -> list:
+    """Explicit requests are replayed as-is; text lines are expanded by the mix until `total` calls."""
+    explicit, prompts = [], []
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                row = json.loads(line)
+                if "path" in row:
+                    explicit.append({"method": row.get("method", "POST"), "path": row["path"],
+                                     "json": row.get("json"), "params": row.get("params")})
+                else:
+                    text = next((row[k] for k in ("text", "prompt", "body", "title") if row.get(k)), None)
+                    if text:
+                        prompts.append(str(text))
+    if explicit and not prompts:
+        return explicit
+    prompts = prompts or FALLBACK_PROMPTS
+    weights = []
+    for part in mix.split(","):
+        kind, _, w = part.partition("=")
+        weights.append((kind.strip(), float(w or 1)))
+    rng = random.Random(seed)
+    kinds, ws = zip(*weights)
+    calls = list(explicit)
+    for i in range(max(total - len(calls), 0)):
+        calls.append(_build_call(rng.choices(kinds, ws)[0], rng.choice(prompts), i))
+    return calls
+
+def _label(call: dict) -> str:
+    body = call.get("json") or {}
+    if call["path"] == "/count" and body.get("mode") == "local":
+        return "POST /count?local"
+    return f"{call['method']} {call['path']}"
+
+async def drive(target: str, calls: list, concurrency: int, duration: float) -> tuple:
+    """Workers take calls round-robin until `duration` seconds pass (or the list is used up if 0)."""
+    samples = {}  # label -> list of (latency_s, ok)
+    cursor = {"i": 0}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=target, limits=limits, timeout=60.0) as client:
+        t_start = time.perf_counter()
+        deadline = t_start + duration if duration else None
+
+        async def worker():
+            while True:
+                if deadline is not None:
+                    if time.perf_counter() >= deadline:
+                        return
+                    call = calls[cursor["i"] % len(calls)]
+                elif cursor["i"] >= len(calls):
+                    return
+                else:
+                    call = calls[cursor["i"]]
+                cursor["i"] += 1
+                t0 = time.perf_counter()
+                ok = False
+                try:
+                    # read the whole body so streamed responses are timed to their end
+                    r = await client.request(call["method"], call["path"], json=call.get("json"),
+                                             params=call.get("params"))
+                    ok = r.is_success
+                except httpx.HTTPError:
+                    pass
+                samples.setdefault(_label(call), []).append((time.perf_counter() - t0, ok))
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - t_start
+        try:
+            server_stats = (await client.get("/upstream/stats")).json()
+        except Exception:
+            server_stats = None
+    return samples, elapsed, server_stats
+
+def _pct(sorted_values: list, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(q / 100.0 * len(sorted_values))) - 1))]
+
+def summarize(samples: dict, elapsed: float) -> dict:
+    results = {}
+    everything = []
+    for label, rows in sorted(samples.items()):
+        lat = sorted(s for s, _ in rows)
+        everything += lat
+        results[label] = {
+            "requests": len(rows),
+            "errors": sum(1 for _, ok in rows if not ok),
+            "rps": round(len(rows) / elapsed, 2),
+            "p50_ms": round(_pct(lat, 50) * 1000, 3),
+            "p90_ms": round(_pct(lat, 90) * 1000, 3),
+            "p99_ms": round(_pct(lat, 99) * 1000, 3),
+            "max_ms": round(lat[-1] * 1000, 3),
+        }
+    everything.sort()
+    results["ALL"] = {
+        "requests": len(everything),
+        "errors": sum(r["errors"] for r in results.values()),
+        "rps": round(len(everything) / elapsed, 2),
+        "p50_ms": round(_pct(everything, 50) * 1000, 3),
+        "p90_ms": round(_pct(everything, 90) * 1000, 3),
+        "p99_ms": round(_pct(everything, 99) * 1000, 3),
+        "max_ms": round(everything[-1] * 1000, 3) if everything else 0.0,
+    }
+    return results
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _wait_ready(url: str, proc: subprocess.Popen, timeout: float = 30.0):
+    t_end = time.time() + timeout
+    while time.time() < t_end:
+        if proc.poll() is not None:
+            raise RuntimeError(f"process exited with {proc.returncode} before {url} was ready")
+        try:
+            if httpx.get(url, timeout=1.0).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"{url} not ready after {timeout}s")
+
+def spawn(args) -> tuple:
+    """Start the mock and the API; returns (target url, processes)."""
+    mock_port, api_port = _free_port(), _free_port()
+    mock = subprocess.Popen([
+        sys.executable, os.path.join(HERE, "mock_anthropic.py"), "--port", str(mock_port),
+        "--latency-ms", str(args.mock_latency_ms), "--count-latency-ms", str(args.mock_count_latency_ms),
+        "--jitter-ms", str(args.mock_jitter_ms), "--error-rate", str(args.mock_error_rate),
+        "--rate-limit-rate", str(args.mock_rate_limit_rate), "--seed", str(args.seed),
+    ])
+    env = {**os.environ, "ANTHROPIC_API_KEY": "offline-benchmark",
+           "ANTHROPIC_BASE_URL": f"http://127.0.0.1:{mock_port}", "RULES_POLL_SECONDS": "0"}
+    for kv in args.server_env:
+        k, _, v = kv.partition("=")
+        env[k] = v
+    api = subprocess.Popen([sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1",
+                            "--port", str(api_port), "--log-level", "warning", "--no-access-log"],
+                           cwd=REPO, env=env)
+    procs = [mock, api]
+    try:
+        _wait_ready(f"http://127.0.0.1:{mock_port}/mock/stats", mock)
+        _wait_ready(f"http://127.0.0.1:{api_port}/health", api)
+    except Exception:
+        for p in procs:
+            p.terminate()
+        raise
+    return f"http://127.0.0.1:{api_port}", procs
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Replay traffic against the API and report p50/p99 and RPS",
+                                 epilog=__doc__.split("\n\n", 2)[2], formatter_class=argparse.RawTextHelpFormatter)
+    where = ap.add_mutually_exclusive_group(required=True)
+    where.add_argument("--target", help="base URL of a running server")
+    where.add_argument("--spawn", action="store_true", help="start the mock and the API locally")
+    ap.add_argument("--traffic", default=os.path.join(REPO, "requests.jsonl"), help="JSONL traffic file")
+    ap.add_argument("--mix", default=DEFAULT_MIX, help="endpoint weights for text lines")
+    ap.add_argument("--requests", type=int, default=2000, help="calls generated from text lines")
+    ap.add_argument("--duration", type=float, default=15.0, help="seconds to run; 0 = each call once")
+    ap.add_argument("--concurrency", type=int, default=32)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--mock-latency-ms", type=float, default=80.0)
+    ap.add_argument("--mock-count-latency-ms", type=float, default=30.0)
+    ap.add_argument("--mock-jitter-ms", type=float, default=20.0)
+    ap.add_argument("--mock-error-rate", type=float, default=0.0)
+    ap.add_argument("--mock-rate-limit-rate", type=float, default=0.0)
+    ap.add_argument("--server-env", action="append", default=[], metavar="KEY=VALUE",
+                    help="extra environment for the spawned API (repeatable)")
+    ap.add_argument("--save", action="store_true", help="write results to benchmarks/results/")
+    ap.add_argument("--compare", metavar="JSON", help="earlier result file to compare against")
+    ap.add_argument("--threshold", type=float, default=0.10)
+    args = ap.parse_args(argv)
+
+    calls = load_traffic(args.traffic, args.mix, args.requests, args.seed)
+    procs = []
+    target = args.target
+    if args.spawn:
+        target, procs = spawn(args)
+    try:
+        samples, elapsed, server_stats = asyncio.run(drive(target, calls, args.concurrency, args.duration))
+    finally:
+        for p in procs:
+            p.terminate()
+        for p in procs:
+            p.wait(timeout=10)
+
+    results = summarize(samples, elapsed)
+    print(f"{len(calls)} distinct calls, concurrency {args.concurrency}, {elapsed:.1f}s")
+    print(f"{'endpoint':<26} {'reqs':>7} {'errs':>6} {'rps':>9} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9}")
+    for label, r in results.items():
+        print(f"{label:<26} {r['requests']:>7} {r['errors']:>6} {r['rps']:>9.1f} "
+              f"{r['p50_ms']:>9.2f} {r['p90_ms']:>9.2f} {r['p99_ms']:>9.2f}")
+
+    if args.save:
+        run = {k: getattr(args, k) for k in ("concurrency", "duration", "mix", "requests", "seed", "mock_latency_ms",
+                                             "mock_error_rate", "mock_rate_limit_rate")}
+        run["target"] = "spawn" if args.spawn else target
+        path = bench_results.save("load", results, {"run": run, "upstream": server_stats})
+        print(f"\nsaved {path}")
+    if args.compare:
+        # error counts and request totals depend on run length; compare latency and throughput only
+        keep = {"rps", "p50_ms", "p99_ms"}
+        current = {k: {m: v for m, v in r.items() if m in keep} for k, r in results.items()}
+        if bench_results.compare(current, bench_results.load(args.compare), args.threshold):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
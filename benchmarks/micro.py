@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for the hot paths that never touch the network.
+
+    python benchmarks/micro.py                      # run everything, print a table
+    python benchmarks/micro.py -k score --save      # only cases containing "score", save JSON
+    python benchmarks/micro.py --compare benchmarks/results/micro-latest.json
+
+Each case reports the best time per operation over several timed runs.
+"""
+import argparse
+import asyncio
+import importlib.util
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("ANTHROPIC_API_KEY", "offline-benchmark")  # no upstream calls are made
+os.environ.setdefault("RULES_POLL_SECONDS", "0")
+
+import numpy as np
+
+import server
+import bench_results
+
+WORDS = ("summarize the quarterly report for our customers and list every risk in json with at most "
+         "five bullets please very basically the dataset schema endpoint latency 2024 revenue").split()
+
+def make_prompt(n_chars: int, rng: random.Random) -> str:
+    parts, size = [], 0
+    while size < n_chars:
+        w = rng.choice(WORDS)
+        parts.append(w)
+        size += len(w) + 1
+    return " ".join(parts)
+
+def bench(fn, min_time: float, repeat: int = 5) -> float:
+    """Best seconds per call of fn() over `repeat` runs of at least min_time each."""
+    n = 1
+    while True:  # calibrate the loop count
+        t0 = time.perf_counter()
+        for _ in range(n):
+            fn()
+        if time.perf_counter() - t0 >= min_time / 5:
+            break
+        n *= 2
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(n):
+            fn()
+        best = min(best, (time.perf_counter() - t0) / n)
+    return best
+
+def bench_async(make_coro, min_time: float, repeat: int = 5) -> float:
+    loop = asyncio.new_event_loop()
+    try:
+        return bench(lambda: loop.run_until_complete(make_coro()), min_time, repeat)
+    finally:
+        loop.close()
+
+async def _drain(agen):
+    n = 0
+    async for chunk in agen:
+        n += len(chunk)
+    return n
+
+def cases(min_time: float):
+    """(name, ops per call, run) for every case; run() times it and returns seconds per call.
+
+    run() must be called before the next case is drawn: the closures share this frame's state.
+    """
+    rng = random.Random(7)
+    short, long = make_prompt(200, rng), make_prompt(10_000, rng)
+    rules = server.RULES
+
+    # --- /score helpers ---
+    for label, text in (("short", short), ("10k", long)):
+        norm = " ".join(text.split())
+        yield f"score.features.{label}", 1, lambda: bench(lambda: server._prompt_features(norm, rules), min_time)
+        yield f"score.score_text.{label}", 1, lambda: bench(lambda: server._score_text(text), min_time)
+    sig = {"has_task": True, "has_format": False, "has_length_limit": False, "has_constraints": True,
+           "has_context": False, "too_long": False}
+    yield "score.build_suggestions", 1, lambda: bench(lambda: server._build_suggestions(sig, False, 2), min_time)
+    yield "score.too_long", 1, lambda: bench(lambda: server._too_long(long), min_time)
+
+    # --- impact math ---
+    yield "impact.from_tokens", 1, lambda: bench(lambda: server._impact_from_tokens(1234), min_time)
+    tokens = np.arange(10_000, dtype=np.int64) * 7
+    yield "impact.columns.10k", 10_000, lambda: bench(lambda: server._impact_columns(tokens), min_time)
+
+    # --- session ingest ---
+    now = server._now()
+    one = server.TurnColumns.single(now, 120, 420, server._impact_from_tokens(420))
+    mem = server.MemorySessionStore({}, 3600, 5000)
+    yield "ingest.memory.single", 1, lambda: bench_async(lambda: mem.ingest_many("s", one, [None]), min_time)
+
+    n = 1000
+    ts = np.full(n, now, dtype=np.int64)
+    tin, tt = np.full(n, 120, dtype=np.int64), np.full(n, 420, dtype=np.int64)
+    kwh, co2, water = server._impact_columns(tt)
+    bulk = server.TurnColumns.from_columns(ts, tin, tt, kwh, co2, water)
+    keys = [None] * n
+    yield "ingest.memory.bulk1000", n, lambda: bench_async(lambda: mem.ingest_many("b", bulk, keys), min_time)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        async def concurrent_singles():
+            # 100 concurrent requests land in one group commit
+            await asyncio.gather(*(sql.ingest_many(f"s{i % 10}", one, [None]) for i in range(100)))
+
+        sql = server.SQLiteSessionStore(os.path.join(tmp, "bench.sqlite3"), 3600, 5000, 2.0)
+        yield "ingest.sqlite.100concurrent", 100, lambda: bench_async(concurrent_singles, min_time, repeat=3)
+        yield "ingest.sqlite.bulk1000", n, lambda: bench_async(lambda: sql.ingest_many("b", bulk, keys), min_time,
+                                                               repeat=3)
+        sql._db.close()
+
+    # --- export (10k turns, memory store) ---
+    exp = server.MemorySessionStore({}, 3600, 10_000)
+    tt = np.arange(10_000, dtype=np.int64) % 900 + 100
+    kwh, co2, water = server._impact_columns(tt)
+    cols = server.TurnColumns.from_columns(np.full(10_000, now, dtype=np.int64), tt // 3, tt, kwh, co2, water)
+    asyncio.run(exp.ingest_many("e", cols, [None] * 10_000))
+    fields = server.TURN_FIELDS
+    chunk = server.EXPORT_CHUNK_ROWS
+    yield "export.csv.10k", 10_000, lambda: bench_async(
+        lambda: _drain(server._csv_stream(fields, exp.iter_turns("e", chunk))), min_time, repeat=3)
+    yield "export.ndjson.10k", 10_000, lambda: bench_async(
+        lambda: _drain(server._ndjson_stream(fields, exp.iter_turns("e", chunk))), min_time, repeat=3)
+    if importlib.util.find_spec("pyarrow") is None:
+        return
+    yield "export.parquet.10k", 10_000, lambda: bench_async(
+        lambda: _drain(server._arrow_stream(fields, exp.iter_turns("e", chunk), "parquet")), min_time, repeat=3)
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Offline microbenchmarks for server.py")
+    ap.add_argument("-k", "--filter", default="", help="only run cases whose name contains this")
+    ap.add_argument("--min-time", type=float, default=0.2, help="seconds per timed run")
+    ap.add_argument("--save", action="store_true", help="write results to benchmarks/results/")
+    ap.add_argument("--compare", metavar="JSON", help="earlier result file to compare against")
+    ap.add_argument("--threshold", type=float, default=0.10, help="relative slowdown flagged as regression")
+    args = ap.parse_args(argv)
+
+    results = {}
+    print(f"{'case':<30} {'us/call':>10} {'ops/s':>14}")
+    for name, ops, run in cases(args.min_time):
+        if args.filter not in name:
+            continue
+        sec = run()
+        results[name] = {"us_per_call": round(sec * 1e6, 3)}
+        print(f"{name:<30} {sec * 1e6:>10.2f} {ops / sec:>14,.0f}")
+
+    if args.save:
+        print(f"\nsaved {bench_results.save('micro', results)}")
+    if args.compare:
+        if bench_results.compare(results, bench_results.load(args.compare), args.threshold):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
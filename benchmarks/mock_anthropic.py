@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the two Anthropic endpoints server.py calls, for offline load tests.
+
+    python benchmarks/mock_anthropic.py --port 8787 --latency-ms 80 --jitter-ms 40 --error-rate 0.01
+
+Then start the API against it:
+
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8787 ANTHROPIC_API_KEY=offline uvicorn server:app
+
+Latency and failures are injected per request: --error-rate answers 529 (overloaded),
+--rate-limit-rate answers 429 with a retry-after header. Streams split the completion
+into --stream-chunks deltas spread over the same latency.
+"""
+import argparse
+import asyncio
+import json
+import random
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+COMPLETION = (
+    "Issues:\n- The task is not stated up front\n- No output format is given\n- No length limit\n"
+    "Revised:\nSummarize the attached report in 5 bullet points of at most 20 words each. "
+    "Return only the bullets."
+)
+
+CONFIG = {
+    "latency_ms": 80.0,
+    "jitter_ms": 40.0,
+    "count_latency_ms": 30.0,
+    "error_rate": 0.0,
+    "rate_limit_rate": 0.0,
+    "retry_after": 1.0,
+    "stream_chunks": 12,
+    "seed": None,
+}
+STATS = {"count_tokens": 0, "messages": 0, "streams": 0, "errors": 0, "rate_limited": 0}
+RNG = random.Random()
+
+app = FastAPI(title="Anthropic mock")
+
+def _delay(base_ms: float) -> float:
+    return max(0.0, base_ms + RNG.uniform(-CONFIG["jitter_ms"], CONFIG["jitter_ms"])) / 1000.0
+
+def _injected_failure():
+    roll = RNG.random()
+    if roll < CONFIG["rate_limit_rate"]:
+        STATS["rate_limited"] += 1
+        return JSONResponse({"type": "error", "error": {"type": "rate_limit_error", "message": "mock 429"}},
+                            status_code=429, headers={"retry-after": str(CONFIG["retry_after"])})
+    if roll < CONFIG["rate_limit_rate"] + CONFIG["error_rate"]:
+        STATS["errors"] += 1
+        return JSONResponse({"type": "error", "error": {"type": "overloaded_error", "message": "mock 529"}},
+                            status_code=529)
+    return None
+
+def _prompt_text(body) -> str:
+    parts = []
+    for m in body.get("messages", []):
+        content = m.get("content", "")
+        if isinstance(content, str):
+            parts.append(content)
+        else:
+            parts += [c.get("text", "") for c in content if isinstance(c, dict)]
+    return "\n".join(parts)
+
+@app.post("/v1/messages/count_tokens")
+async def count_tokens(request: Request):
+    body = await request.json()
+    STATS["count_tokens"] += 1
+    await asyncio.sleep(_delay(CONFIG["count_latency_ms"]))
+    failure = _injected_failure()
+    if failure is not None:
+        return failure
+    return {"input_tokens": max(1, len(_prompt_text(body)) // 4)}
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/v1/messages")
+async def messages(request: Request):
+    body = await request.json()
+    STATS["messages"] += 1
+    failure = _injected_failure()
+    if failure is not None:
+        await asyncio.sleep(_delay(CONFIG["count_latency_ms"]))
+        return failure
+
+    if not body.get("stream"):
+        await asyncio.sleep(_delay(CONFIG["latency_ms"]))
+        return {"type": "message", "role": "assistant", "model": body.get("model"),
+                "content": [{"type": "text", "text": COMPLETION}], "stop_reason": "end_turn"}
+
+    STATS["streams"] += 1
+    n = max(1, CONFIG["stream_chunks"])
+    step = -(-len(COMPLETION) // n)
+    total = _delay(CONFIG["latency_ms"])
+
+    async def events():
+        yield _sse("message_start", {"type": "message_start"})
+        for i in range(0, len(COMPLETION), step):
+            await asyncio.sleep(total / n)
+            yield _sse("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                               "delta": {"type": "text_delta", "text": COMPLETION[i:i + step]}})
+        yield _sse("message_stop", {"type": "message_stop"})
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+@app.get("/mock/stats")
+def mock_stats():
+    return {**STATS, "config": CONFIG}
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[1], formatter_class=argparse.RawTextHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8787)
+    ap.add_argument("--latency-ms", type=float, default=CONFIG["latency_ms"], help="messages latency")
+    ap.add_argument("--count-latency-ms", type=float, default=CONFIG["count_latency_ms"])
+    ap.add_argument("--jitter-ms", type=float, default=CONFIG["jitter_ms"], help="uniform +/- on every latency")
+    ap.add_argument("--error-rate", type=float, default=CONFIG["error_rate"], help="fraction answered 529")
+    ap.add_argument("--rate-limit-rate", type=float, default=CONFIG["rate_limit_rate"], help="fraction answered 429")
+    ap.add_argument("--retry-after", type=float, default=CONFIG["retry_after"])
+    ap.add_argument("--stream-chunks", type=int, default=CONFIG["stream_chunks"])
+    ap.add_argument("--seed", type=int, default=None)
+    args = ap.parse_args(argv)
+    CONFIG.update({k: v for k, v in vars(args).items() if k in CONFIG})
+    if args.seed is not None:
+        RNG.seed(args.seed)
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
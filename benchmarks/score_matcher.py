@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark: compiled /score matcher vs the original per-helper scans.
+
+Also checks that both produce identical ScoreRes payloads on random prompts.
+
+    python benchmarks/score_matcher.py
+"""
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("ANTHROPIC_API_KEY", "offline-benchmark")  # no upstream calls are made
+
+import server
+from server import ACTION_VERBS, FORMAT_HINTS, FLUFF, CONSTRAINT_LEX, DOMAIN_HINTS  # builtin rule set
+
+
+# --- original implementation, kept verbatim as the reference ---
+def _has_action_verb(s):
+    head = s.strip().lower()
+    words = head.split()
+    head8 = " ".join(words[:8])
+    return any(re.search(rf"\b{re.escape(v)}\b", head8) for v in ACTION_VERBS)
+
+def _has_output_format(s):
+    low = s.lower()
+    if re.search(r"```(json|csv|yaml|markdown)?", low): return True
+    if re.search(r"\{[^}]{3,}\}", s): return True
+    if re.search(r"\b(return|output)\s+only\b", low): return True
+    return any(f in low for f in FORMAT_HINTS)
+
+def _has_length_limit(s):
+    low = s.lower()
+    if re.search(r"\b\d+\s*(words?|tokens?|characters?|chars?|sentences?|bullets?)\b", low): return True
+    return any(p in low for p in ["no more than","at most","limit to","maximum","max "])
+
+def _has_constraints(s):
+    low = s.lower()
+    return any(p in low for p in CONSTRAINT_LEX)
+
+def _fluff_count(s):
+    low = s.lower()
+    return sum(low.count(w) for w in FLUFF)
+
+def _has_domain_context(s):
+    low = s.lower()
+    if re.search(r"\b(19|20)\d{2}\b", s): return True
+    if re.search(r"\b\d{2,}\b", s): return True
+    return any(w in low for w in DOMAIN_HINTS)
+
+def legacy_score(text):
+    text_norm = " ".join(text.split())
+    is_long = server._too_long(text_norm)
+    fluff = _fluff_count(text_norm)
+    signals = {
+        "has_task": _has_action_verb(text_norm),
+        "has_format": _has_output_format(text_norm),
+        "has_length_limit": _has_length_limit(text_norm),
+        "has_constraints": _has_constraints(text_norm),
+        "has_context": _has_domain_context(text_norm),
+        "too_long": is_long,
+    }
+    return server.ScoreRes(
+        score=server._score(signals, is_long, fluff),
+        signals=signals,
+        suggestions=server._build_suggestions(signals, is_long, fluff),
+        details={
+            "text_length_chars": len(text_norm),
+            "approx_tokens": max(1, len(text_norm) // 4),
+            "fluff_count": fluff,
+            "detected": {
+                "format_hints": any(h in text_norm.lower() for h in FORMAT_HINTS),
+                "constraint_keywords_found": [w for w in CONSTRAINT_LEX if w in text_norm.lower()],
+                "domain_terms_found": [w for w in DOMAIN_HINTS if w in text_norm.lower()],
+            },
+        },
+    )
+
+
+VOCAB = (ACTION_VERBS + FORMAT_HINTS + FLUFF + CONSTRAINT_LEX + DOMAIN_HINTS
+         + ["the", "data", "report", "every", "maxim", "2024", "7", "42", "{a: b}", "```json",
+            "Return only", "\n", "  ", "MAX", "Very", "listing", "stepsteps"])
+FILLER = ["the", "a", "of", "report", "quarterly", "results", "and", "with", "for", "team",
+          "we", "our", "customers", "revenue", "growth", "region", "this", "that", "is", "in"]
+
+def make_text(n_chars, rng, density=0.1):
+    parts, size = [], 0
+    while size < n_chars:
+        w = rng.choice(VOCAB) if rng.random() < density else rng.choice(FILLER)
+        parts.append(w)
+        size += len(w) + 1
+    return " ".join(parts)
+
+def check_equivalence(n=3000, seed=7):
+    rng = random.Random(seed)
+    for _ in range(n):
+        text = make_text(rng.randint(0, 600), rng, density=rng.random())
+        a = legacy_score(text).model_dump()
+        b = server._score_text(text).model_dump()
+        b["details"].pop("ruleset_version")
+        if a != b:
+            raise AssertionError(f"mismatch for {text!r}:\n{a}\n{b}")
+    print(f"equivalence: {n} random prompts identical")
+
+def bench(fn, text, min_time=0.3):
+    n, t0 = 0, time.perf_counter()
+    while True:
+        fn(text)
+        n += 1
+        elapsed = time.perf_counter() - t0
+        if elapsed >= min_time:
+            return elapsed / n
+
+if __name__ == "__main__":
+    check_equivalence()
+    rng = random.Random(1)
+    print(f"{'size':>8} {'legacy_ms':>10} {'compiled_ms':>11} {'speedup':>8}")
+    for size in (1_000, 10_000, 100_000):
+        text = make_text(size, rng, density=0.01)  # prose-like: few lexicon hits
+        old = bench(legacy_score, text)
+        new = bench(server._score_text, text)
+        print(f"{size:>8} {old * 1000:>10.3f} {new * 1000:>11.3f} {old / new:>7.1f}x")
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Memory and export cost of per-session turn storage: dict-per-turn vs TurnColumns.
+
+    python benchmarks/session_memory.py [turns]
+"""
+import csv
+import io
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("ANTHROPIC_API_KEY", "offline-benchmark")  # no upstream calls are made
+
+import server
+
+
+def build_dicts(n):
+    turns = []
+    for i in range(n):
+        tokens_total = 150 + i % 400
+        turns.append({"turn_index": i + 1, "ts": 1757819239 + i, "tokens_input": 40 + i % 300,
+                      "tokens_total": tokens_total, **server._impact_from_tokens(tokens_total)})
+    return turns
+
+def build_columns(n):
+    cols = server.TurnColumns()
+    for i in range(n):
+        tokens_total = 150 + i % 400
+        cols.append(1757819239 + i, 40 + i % 300, tokens_total, server._impact_from_tokens(tokens_total))
+    return cols
+
+def measure(build, n):
+    tracemalloc.start()
+    obj = build(n)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return obj, size
+
+def csv_export(rows):
+    out = io.StringIO()
+    w = csv.writer(out)
+    w.writerow(server.TURN_FIELDS)
+    w.writerows(rows)
+    return out.getvalue()
+
+def timed(fn, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best * 1000.0
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    dicts, dict_bytes = measure(build_dicts, n)
+    cols, col_bytes = measure(build_columns, n)
+    assert cols.dicts() == dicts
+
+    print(f"turns: {n}")
+    print(f"memory  dicts: {dict_bytes / 1024:9.1f} KiB  ({dict_bytes / n:6.1f} B/turn)")
+    print(f"memory  cols:  {col_bytes / 1024:9.1f} KiB  ({col_bytes / n:6.1f} B/turn)  "
+          f"-> {dict_bytes / col_bytes:.1f}x smaller")
+    legacy = lambda: csv_export([[t[k] for k in server.TURN_FIELDS] for t in dicts])
+    print(f"csv export  dicts: {timed(legacy):8.2f} ms")
+    print(f"csv export  cols:  {timed(lambda: csv_export(cols.rows())):8.2f} ms")
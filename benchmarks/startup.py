@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Cold-start benchmark: how long until a fresh process can answer.
+
+    python benchmarks/startup.py                          # uvicorn, 5 runs
+    python benchmarks/startup.py --server gunicorn --workers 2 --save
+    python benchmarks/startup.py --no-bytecode            # as if server.py had to be compiled on boot
+    python benchmarks/startup.py --breakdown              # slowest imports (python -X importtime)
+    python benchmarks/startup.py --compare benchmarks/results/startup-latest.json
+
+Measured per run, each in a new process: `import server` alone, then for a spawned server the
+time from exec to the first 200 from /health, /score and /count?local. Medians are reported.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+import bench_results
+from load import REPO, _free_port
+
+ENV = {"ANTHROPIC_API_KEY": "offline-benchmark", "RULES_POLL_SECONDS": "0"}
+FIRST_CALLS = (
+    ("first_health_ms", "GET", "/health", None),
+    ("first_score_ms", "POST", "/score", {"text": "Summarize this report in 3 bullet points."}),
+    ("first_count_local_ms", "POST", "/count", {"text": "Summarize this report.", "mode": "local"}),
+)
+
+def server_bytecode(compiled: bool):
+    """compiled: as after the build's `compileall server.py`; otherwise as a deploy without it."""
+    if compiled:
+        subprocess.run([sys.executable, "-m", "compileall", "-q", "server.py"], cwd=REPO, check=True)
+        return
+    cache = os.path.join(REPO, "__pycache__")
+    for name in os.listdir(cache) if os.path.isdir(cache) else ():
+        if name.startswith("server."):
+            os.remove(os.path.join(cache, name))
+
+def import_ms(env: dict) -> float:
+    code = "import time; t = time.perf_counter(); import server; print((time.perf_counter() - t) * 1000)"
+    out = subprocess.run([sys.executable, "-c", code], cwd=REPO, env=env, capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+def server_cmd(args, port: int) -> list:
+    if args.server == "gunicorn":
+        return [sys.executable, "-m", "gunicorn", "server:app", "-c", "gunicorn.conf.py",
+                "--bind", f"127.0.0.1:{port}", "--workers", str(args.workers), "--log-level", "warning"]
+    return [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(port),
+            "--log-level", "warning", "--no-access-log"]
+
+def first_responses(args, env: dict, tmp: str) -> dict:
+    """ms from exec to the first successful answer of each FIRST_CALLS entry, in order."""
+    port = _free_port()
+    env = {**env, "SESSION_DB_PATH": os.path.join(tmp, "sessions.sqlite3"),
+           "ROLLUP_SHARED_PATH": os.path.join(tmp, "rollups.mmap") if args.workers > 1 else ""}
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(server_cmd(args, port), cwd=REPO, env=env)
+    out = {}
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=5.0) as client:
+            for metric, method, path, body in FIRST_CALLS:
+                while True:
+                    if proc.poll() is not None:
+                        raise RuntimeError(f"server exited with {proc.returncode}")
+                    if time.perf_counter() - t0 > args.timeout:
+                        raise RuntimeError(f"no answer from {path} after {args.timeout}s")
+                    try:
+                        if client.request(method, path, json=body).status_code == 200:
+                            break
+                    except httpx.TransportError:
+                        pass
+                    time.sleep(0.005)
+                out[metric] = (time.perf_counter() - t0) * 1000
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+    return out
+
+def breakdown(env: dict, top: int):
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import server"], cwd=REPO, env=env,
+                         capture_output=True, text=True, check=True)
+    rows = []
+    for line in out.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            name = parts[2].rstrip()
+            if len(name) - len(name.lstrip()) <= 3:  # `import server` and its direct imports
+                rows.append((int(parts[1]) / 1000.0, name.strip()))
+    print(f"{'cumulative ms':>14}  module")
+    for ms, name in sorted(rows, reverse=True)[:top]:
+        print(f"{ms:>14.1f}  {name}")
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Measure cold start of server.py")
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--server", choices=("uvicorn", "gunicorn"), default="uvicorn")
+    ap.add_argument("--workers", type=int, default=1, help="gunicorn workers")
+    ap.add_argument("--timeout", type=float, default=60.0)
+    ap.add_argument("--no-bytecode", action="store_true",
+                    help="drop server.py's cached bytecode before every process, i.e. no compileall at build")
+    ap.add_argument("--breakdown", action="store_true", help="print the slowest imports and exit")
+    ap.add_argument("--save", action="store_true", help="write results to benchmarks/results/")
+    ap.add_argument("--compare", metavar="JSON", help="earlier result file to compare against")
+    ap.add_argument("--threshold", type=float, default=0.10)
+    args = ap.parse_args(argv)
+    if args.server == "uvicorn" and args.workers != 1:
+        ap.error("--workers needs --server gunicorn")
+
+    env = {**os.environ, **ENV}
+    if args.breakdown:
+        breakdown(env, 15)
+        return
+
+    samples = {"import_ms": []}
+    with tempfile.TemporaryDirectory() as tmp:
+        for _ in range(args.runs):
+            server_bytecode(not args.no_bytecode)
+            samples["import_ms"].append(import_ms(env))
+            server_bytecode(not args.no_bytecode)
+            for metric, ms in first_responses(args, env, tmp).items():
+                samples.setdefault(metric, []).append(ms)
+            for name in os.listdir(tmp):  # every run starts from empty state files
+                os.remove(os.path.join(tmp, name))
+
+    label = args.server if args.server == "uvicorn" else f"gunicorn-{args.workers}w"
+    results = {f"{label}.{metric}": {"median_ms": round(statistics.median(v), 1), "min_ms": round(min(v), 1)}
+               for metric, v in samples.items()}
+    print(f"{'case':<36} {'median ms':>10} {'min ms':>10}")
+    for case, r in results.items():
+        print(f"{case:<36} {r['median_ms']:>10.1f} {r['min_ms']:>10.1f}")
+
+    if args.save:
+        run = {"runs": args.runs, "server": args.server, "workers": args.workers,
+               "bytecode": not args.no_bytecode}
+        print(f"\nsaved {bench_results.save('startup', results, {'run': run})}")
+    if args.compare:
+        current = {k: {"median_ms": r["median_ms"]} for k, r in results.items()}
+        if bench_results.compare(current, bench_results.load(args.compare), args.threshold):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
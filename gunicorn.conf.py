@@ -0,0 +1,31 @@
+"""
+Multi-worker mode: a pool of uvicorn workers under gunicorn.
+
+    gunicorn server:app -c gunicorn.conf.py            # WEB_CONCURRENCY workers (default: CPUs, max 4)
+
+Workers share nothing in memory, so with more than one worker the state that has to be
+global is moved to the host: sessions go to the SQLite store, the /aggregate rollups are
+mapped from one file, and session push is fed from the store's change feed, so a
+subscriber sees every ingest whichever worker took it (SESSION_PUSH_POLL_MS later).
+/count revisions need no shared state: each one carries its base counts, MACed with a key
+every worker derives from REVISION_SECRET (or ANTHROPIC_API_KEY), so any worker continues it.
+Per-worker state stays per worker: token/rewrite caches, upstream limits (so the effective
+upstream concurrency is workers x UPSTREAM_*_CONCURRENCY) and /metrics.
+"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("WEB_CONCURRENCY") or min(os.cpu_count() or 1, 4))
+worker_class = "uvicorn.workers.UvicornWorker"
+# each worker imports the app itself: the SQLite connection and asyncio state must not cross a fork
+preload_app = False
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = 20
+keepalive = 5
+accesslog = None
+
+if workers > 1:
+    # read by server.py at import, which happens in the workers after this file is loaded
+    os.environ.setdefault("SESSION_STORE", "sqlite")
+    os.environ.setdefault("ROLLUP_SHARED_PATH", "rollups.mmap")
+    os.environ.setdefault("SESSION_CHANGE_FEED", "1")
@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+"""
+Offline prompt-log analytics: /score heuristics, local token estimate and impact for every
+prompt in a JSONL log, written as columnar part files plus per-model totals.
+
+    python prompt_pipeline.py requests.jsonl -o out/requests          # parquet parts + _summary.json
+    python prompt_pipeline.py big.jsonl -o out/big --workers 8 --resume
+    python prompt_pipeline.py big.jsonl -o out/big --format csv        # without pyarrow
+
+A line is a JSON object; the prompt is the first non-empty of --text-fields (default
+text, prompt, body, title) or the last user turn of "messages". Optional per-line fields:
+"model" (impact factors and tokenizer family), "ts" (carbon intensity time), "id"/"request_id".
+Prompt text is never written out.
+
+Memory stays flat: lines are read by a generator, at most 2 chunks per worker are in flight,
+and each chunk becomes one row group of the open part file. After every part (--part-rows)
+the input byte offset and running totals go to _checkpoint.json, so --resume after a crash or
+Ctrl-C redoes at most one part. The directory reads as one table, e.g. pandas.read_parquet(out).
+"""
+import argparse
+import importlib.util
+import json
+import os
+import signal
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# server.py is imported for its scoring, estimator and factor code only; no API key or upstream is used
+os.environ.setdefault("ANTHROPIC_API_KEY", "offline-pipeline")
+os.environ["SESSION_STORE"] = "memory"
+os.environ["ROLLUP_SHARED_PATH"] = ""
+
+import server
+
+DEFAULT_TEXT_FIELDS = "text,prompt,body,title"
+SIGNALS = ["has_task", "has_format", "has_length_limit", "has_constraints", "has_context", "too_long"]
+COLUMNS = (["line", "id", "model", "chars", "tokens_input", "tokens_total", "score"] + SIGNALS
+           + ["fluff", "kwh", "co2_kg", "water_l"])
+AGG_FIELDS = ["prompts", "tokens_input", "tokens_total", "kwh", "co2_kg", "water_l", "score_sum"]
+# leading "_" / "." keep these out of `pyarrow.dataset(out_dir)` / `pandas.read_parquet(out_dir)`
+CHECKPOINT = "_checkpoint.json"
+SUMMARY = "_summary.json"
+
+# ------------------------
+# Reading
+# ------------------------
+def read_chunks(path: str, offset: int, first_line: int, chunk_lines: int, max_lines: int = 0):
+    """Yield (first line number, raw lines, byte offset after the chunk) from `offset` on."""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        line_no = first_line
+        lines = []
+        for raw in f:
+            if max_lines and line_no + len(lines) > max_lines:
+                break
+            lines.append(raw)
+            offset += len(raw)
+            if len(lines) == chunk_lines:
+                yield line_no, lines, offset
+                line_no += len(lines)
+                lines = []
+        if lines:
+            yield line_no, lines, offset
+
+def _prompt_text(row: dict, fields: list) -> str:
+    for k in fields:
+        v = row.get(k)
+        if isinstance(v, str) and v.strip():
+            return v
+    if isinstance(row.get("messages"), list):
+        return server._choose_text(server.ScoreReq(messages=row["messages"]))
+    return ""
+
+# ------------------------
+# Worker side
+# ------------------------
+def _init_worker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the parent handles Ctrl-C and drains the pool
+
+def process_chunk(first_line: int, lines: list, opts: dict) -> dict:
+    """Score and estimate one chunk; returns its columns, per-model sums and skip counts."""
+    fields = opts["text_fields"]
+    out = {k: [] for k in COLUMNS if k not in SIGNALS}
+    sig = {k: [] for k in SIGNALS}
+    ts = []
+    bad = empty = 0
+    now = server._now()
+    for i, raw in enumerate(lines):
+        try:
+            row = json.loads(raw)
+        except ValueError:
+            bad += 1
+            continue
+        if not isinstance(row, dict):
+            bad += 1
+            continue
+        text = _prompt_text(row, fields)
+        if not text:
+            empty += 1
+            continue
+        model = str(row.get("model") or opts["model"])
+        res = server._score_text(text)
+        tokens_input = server._estimate_tokens_local(model, text)
+        out["line"].append(first_line + i)
+        rid = row.get("id", row.get("request_id"))
+        out["id"].append(None if rid is None else str(rid))
+        out["model"].append(model)
+        out["chars"].append(res.details["text_length_chars"])
+        out["tokens_input"].append(tokens_input)
+        out["tokens_total"].append(tokens_input + opts["output_tokens"])
+        out["score"].append(res.score)
+        out["fluff"].append(res.details["fluff_count"])
+        for k in SIGNALS:
+            sig[k].append(res.signals[k])
+        t = row.get("ts")
+        ts.append(t if isinstance(t, int) and not isinstance(t, bool) else now)
+
+    cols = {
+        "line": np.asarray(out["line"], dtype=np.int64),
+        "id": out["id"],
+        "model": out["model"],
+        "chars": np.asarray(out["chars"], dtype=np.int32),
+        "tokens_input": np.asarray(out["tokens_input"], dtype=np.int64),
+        "tokens_total": np.asarray(out["tokens_total"], dtype=np.int64),
+        "score": np.asarray(out["score"], dtype=np.int8),
+        **{k: np.asarray(v, dtype=bool) for k, v in sig.items()},
+        "fluff": np.asarray(out["fluff"], dtype=np.int16),
+    }
+    n = len(cols["line"])
+    kwh, co2, water = np.zeros(n), np.zeros(n), np.zeros(n)
+    models = np.asarray(cols["model"], dtype=object)
+    ts_col = np.asarray(ts, dtype=np.int64)
+    aggs = {}
+    for model in dict.fromkeys(cols["model"]):
+        idx = np.flatnonzero(models == model)
+        f = server.FACTORS.get(model, opts["region"])
+        kwh[idx], co2[idx], water[idx] = server._impact_columns(
+            cols["tokens_total"][idx], cols["tokens_input"][idx], f, ts_col[idx])
+        aggs[model] = {
+            "prompts": len(idx),
+            "tokens_input": int(cols["tokens_input"][idx].sum()),
+            "tokens_total": int(cols["tokens_total"][idx].sum()),
+            "kwh": float(kwh[idx].sum()),
+            "co2_kg": float(co2[idx].sum()),
+            "water_l": float(water[idx].sum()),
+            "score_sum": int(cols["score"][idx].sum()),
+        }
+    cols.update(kwh=kwh, co2_kg=co2, water_l=water)
+    return {"cols": cols, "aggs": aggs, "lines": len(lines), "bad": bad, "empty": empty}
+
+# ------------------------
+# Output
+# ------------------------
+class PartWriter:
+    """One part file; each chunk is appended as a row group (parquet), record batch (arrow) or rows (csv).
+
+    Written as .<name>.tmp and renamed on close, so a part on disk is always complete.
+    """
+
+    def __init__(self, path: str, fmt: str):
+        self.path = path
+        self.fmt = fmt
+        self.rows = 0
+        self._tmp = os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".tmp")
+        self._writer = None
+        self._file = None
+
+    def write(self, cols: dict):
+        n = len(cols["line"])
+        if not n:
+            return
+        if self.fmt == "csv":
+            if self._file is None:
+                import csv
+                self._file = open(self._tmp, "w", newline="", encoding="utf-8")
+                self._writer = csv.writer(self._file)
+                self._writer.writerow(COLUMNS)
+            self._writer.writerows(zip(*(cols[k].tolist() if isinstance(cols[k], np.ndarray) else cols[k]
+                                         for k in COLUMNS)))
+        else:
+            import pyarrow as pa
+            batch = pa.record_batch([pa.array(cols[k]) for k in COLUMNS], names=COLUMNS)
+            if self._writer is None:
+                if self.fmt == "parquet":
+                    import pyarrow.parquet as pq
+                    self._writer = pq.ParquetWriter(self._tmp, batch.schema)
+                else:
+                    self._file = pa.OSFile(self._tmp, "wb")
+                    self._writer = pa.ipc.new_file(self._file, batch.schema)
+            self._writer.write_batch(batch)
+        self.rows += n
+
+    def close(self) -> bool:
+        """Finish the file; False if no rows were written (nothing is left on disk)."""
+        if self._writer is None and self._file is None:
+            return False
+        if self.fmt != "csv":
+            self._writer.close()
+        if self._file is not None:
+            self._file.close()
+        os.replace(self._tmp, self.path)
+        return True
+
+def _write_json(path: str, doc: dict):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(doc, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+def _merge_aggs(into: dict, aggs: dict):
+    for model, a in aggs.items():
+        cur = into.setdefault(model, dict.fromkeys(AGG_FIELDS, 0))
+        for k in AGG_FIELDS:
+            cur[k] += a[k]
+
+def _by_model(aggs: dict) -> dict:
+    out = {}
+    for model, a in sorted(aggs.items()):
+        out[model] = {
+            "prompts": a["prompts"],
+            "tokens_input": a["tokens_input"],
+            "tokens_total": a["tokens_total"],
+            "kwh": round(a["kwh"], 6),
+            "co2_kg": round(a["co2_kg"], 6),
+            "water_l": round(a["water_l"], 6),
+            "mean_score": round(a["score_sum"] / a["prompts"], 3) if a["prompts"] else None,
+        }
+    return out
+
+# ------------------------
+# Driver
+# ------------------------
+def _options(args) -> dict:
+    return {
+        "input": os.path.abspath(args.input),
+        "format": args.format,
+        "model": args.model,
+        "region": args.region,
+        "output_tokens": args.output_tokens,
+        "text_fields": [f.strip() for f in args.text_fields.split(",") if f.strip()],
+        "rules_version": server.RULES.version,
+        "factors_version": server.FACTORS.version,
+    }
+
+def _start_state(args, opts: dict) -> dict:
+    ckpt_path = os.path.join(args.output, CHECKPOINT)
+    if os.path.exists(ckpt_path):
+        if not args.resume:
+            sys.exit(f"{args.output} already has a checkpoint; pass --resume to continue it or pick another -o")
+        with open(ckpt_path, encoding="utf-8") as f:
+            state = json.load(f)
+        changed = [k for k in opts if state["options"].get(k) != opts[k]]
+        if changed:
+            sys.exit(f"cannot resume: {', '.join(changed)} differ from the checkpointed run")
+        if os.path.getsize(opts["input"]) < state["offset"]:
+            sys.exit("cannot resume: the input is shorter than the checkpointed offset")
+    else:
+        state = {"options": opts, "offset": 0, "lines": 0, "rows": 0, "bad": 0, "empty": 0,
+                 "parts": [], "aggregates": {}, "seconds": 0.0, "done": False}
+    # parts after the checkpoint (or half-written ones) are redone
+    keep = set(state["parts"])
+    for name in os.listdir(args.output):
+        if name.lstrip(".").startswith("part-") and name not in keep:
+            os.remove(os.path.join(args.output, name))
+    return state
+
+def run(args) -> dict:
+    if args.format != "csv" and importlib.util.find_spec("pyarrow") is None:
+        sys.exit(f"--format {args.format} needs pyarrow; install it or use --format csv")
+    try:
+        server.FACTORS.get(args.model, args.region)
+    except KeyError:
+        sys.exit(f"unknown region: {args.region}")
+    os.makedirs(args.output, exist_ok=True)
+    opts = _options(args)
+    state = _start_state(args, opts)
+    if state["done"]:
+        print(f"{args.output} is already complete ({state['rows']} rows)", file=sys.stderr)
+        return state
+
+    ext = {"parquet": "parquet", "arrow": "arrow", "csv": "csv"}[args.format]
+    part = None
+    t_run = time.perf_counter()
+    rows_run = 0
+    t_report = t_run
+
+    def open_part():
+        name = f"part-{len(state['parts']):05d}.{ext}"
+        return PartWriter(os.path.join(args.output, name), args.format)
+
+    def checkpoint(part_writer, offset: int):
+        if part_writer is not None and part_writer.close():
+            state["parts"].append(os.path.basename(part_writer.path))
+        state["offset"] = offset
+        state["seconds"] += time.perf_counter() - t_mark[0]
+        t_mark[0] = time.perf_counter()
+        _write_json(os.path.join(args.output, CHECKPOINT), state)
+
+    t_mark = [t_run]
+    chunks = read_chunks(opts["input"], state["offset"], state["lines"] + 1, args.chunk_lines, args.max_lines)
+    pool = ProcessPoolExecutor(args.workers, initializer=_init_worker) if args.workers > 0 else None
+    pending = deque()
+    offset = state["offset"]
+    # first Ctrl-C: stop after the chunk being written and checkpoint; a second one aborts
+    stop = []
+
+    def on_sigint(signum, frame):
+        if stop:
+            raise KeyboardInterrupt
+        stop.append(signum)
+
+    previous = signal.signal(signal.SIGINT, on_sigint)
+    finished = False
+    try:
+        while not stop:
+            while pool is not None and len(pending) < 2 * args.workers:
+                nxt = next(chunks, None)
+                if nxt is None:
+                    break
+                first, lines, end = nxt
+                pending.append((pool.submit(process_chunk, first, lines, opts), end))
+            if pool is None:
+                nxt = next(chunks, None)
+                if nxt is not None:
+                    first, lines, end = nxt
+                    pending.append((process_chunk(first, lines, opts), end))
+            if not pending:
+                finished = True
+                break
+            fut, end = pending.popleft()
+            res = fut if pool is None else fut.result()
+
+            part = part or open_part()
+            part.write(res["cols"])
+            _merge_aggs(state["aggregates"], res["aggs"])
+            n = len(res["cols"]["line"])
+            state["rows"] += n
+            state["lines"] += res["lines"]
+            state["bad"] += res["bad"]
+            state["empty"] += res["empty"]
+            offset = end
+            rows_run += n
+            if part.rows >= args.part_rows:
+                checkpoint(part, offset)
+                part = None
+
+            now = time.perf_counter()
+            if args.progress and now - t_report >= args.progress:
+                t_report = now
+                print(f"{state['lines']:>12,} lines {state['rows']:>12,} prompts "
+                      f"{rows_run / (now - t_run):>10,.0f} prompts/s", file=sys.stderr)
+    finally:
+        signal.signal(signal.SIGINT, previous)
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    interrupted = not finished
+    if interrupted:
+        print("\ninterrupted; checkpointing what was written", file=sys.stderr)
+    # everything consumed so far is in `part`; close it so the checkpoint covers it
+    state["done"] = not interrupted
+    checkpoint(part, offset)
+    elapsed = time.perf_counter() - t_run
+    summary = {
+        "input": opts["input"],
+        "rows": state["rows"], "lines": state["lines"], "bad_lines": state["bad"], "empty_lines": state["empty"],
+        "parts": state["parts"],
+        "by_model": _by_model(state["aggregates"]),
+        "rules_version": opts["rules_version"], "factors_version": opts["factors_version"],
+        "output_tokens_assumed": opts["output_tokens"],
+        "this_run": {"prompts": rows_run, "seconds": round(elapsed, 3),
+                     "prompts_per_s": round(rows_run / elapsed, 1) if elapsed else 0.0, "workers": args.workers},
+        "processing_seconds_total": round(state["seconds"], 3),
+        "complete": state["done"],
+    }
+    _write_json(os.path.join(args.output, SUMMARY), summary)
+    if interrupted:
+        sys.exit(130)
+    return summary
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Score and estimate impact for a JSONL prompt log",
+                                 epilog=__doc__.split("\n\n", 2)[2], formatter_class=argparse.RawTextHelpFormatter)
+    ap.add_argument("input", help="JSONL file, one prompt per line")
+    ap.add_argument("-o", "--output", required=True, help="output directory (parts, checkpoint, summary)")
+    ap.add_argument("--format", choices=("parquet", "arrow", "csv"), default="parquet")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="processes; 0 = in this process")
+    ap.add_argument("--chunk-lines", type=int, default=2000, help="lines per task / row group")
+    ap.add_argument("--part-rows", type=int, default=500_000, help="rows per part file (= checkpoint interval)")
+    ap.add_argument("--model", default="claude-3-5-haiku-20241022", help="for lines without a model")
+    ap.add_argument("--region", default=None, help="impact factor region (IMPACT_REGION if omitted)")
+    ap.add_argument("--output-tokens", type=int, default=200,
+                    help="assumed output tokens per prompt, as /count's default")
+    ap.add_argument("--text-fields", default=DEFAULT_TEXT_FIELDS)
+    ap.add_argument("--max-lines", type=int, default=0, help="stop after this input line (0 = all)")
+    ap.add_argument("--resume", action="store_true", help="continue from the checkpoint in --output")
+    ap.add_argument("--progress", type=float, default=5.0, help="seconds between progress lines; 0 = quiet")
+    args = ap.parse_args(argv)
+
+    summary = run(args)
+    if "by_model" not in summary:
+        return
+    print(f"{'model':<32} {'prompts':>10} {'tokens':>14} {'kWh':>12} {'CO2 kg':>12} {'water L':>12} {'score':>6}")
+    for model, a in summary["by_model"].items():
+        print(f"{model:<32} {a['prompts']:>10,} {a['tokens_total']:>14,} {a['kwh']:>12.4f} "
+              f"{a['co2_kg']:>12.4f} {a['water_l']:>12.4f} {a['mean_score'] or 0:>6.2f}")
+    r = summary["this_run"]
+    print(f"\n{r['prompts']:,} prompts in {r['seconds']:.1f}s = {r['prompts_per_s']:,.0f} prompts/s "
+          f"({r['workers']} workers)")
+    print(f"{summary['rows']:,} rows in {len(summary['parts'])} parts; "
+          f"skipped {summary['bad_lines']:,} bad and {summary['empty_lines']:,} empty input lines")
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,47 @@
 import os
-import httpx
-from fastapi import FastAPI, HTTPException
+import sys
+import importlib.util
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from dotenv import load_dotenv
 import re
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Union
 import time
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from starlette.background import BackgroundTask
 import io, csv
+import asyncio
+from array import array
+import hashlib
+import base64, hmac, struct
+import numpy as np
+import heapq
+import json
+import math
+import random
+from bisect import bisect_left
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+import mmap
+
+def _lazy_module(name: str):
+    """Module that is imported on first attribute access; keeps cold start off routes that never use it."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+# httpx (+ httpcore, h2) is ~1/4 of import time and only upstream calls need it
+httpx = _lazy_module("httpx")
 
 
 load_dotenv()
@@ -19,7 +52,23 @@ ALLOWED_ORIGIN = os.getenv("ALLOWED_ORIGIN", "*")  # tighten later
 if not ANTHROPIC_API_KEY:
     raise RuntimeError("Missing ANTHROPIC_API_KEY")
 
-app = FastAPI(title="Eden AI Sustainability API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    tasks = []
+    if RULES_POLL_SECONDS > 0:
+        tasks.append(asyncio.create_task(_watch_rules()))
+    if SESSION_SWEEP_SECONDS > 0:
+        tasks.append(asyncio.create_task(_sweep_sessions()))
+    if METRICS_ENABLED and LOOP_LAG_INTERVAL > 0:
+        tasks.append(asyncio.create_task(_monitor_loop_lag()))
+    if SESSION_CHANGE_FEED:
+        tasks.append(asyncio.create_task(_relay_session_changes()))
+    yield
+    for task in tasks:
+        task.cancel()
+    await _close_upstream_client()
+
+app = FastAPI(title="Eden AI Sustainability API", lifespan=lifespan)
 
 @app.get("/health")
 def health():
@@ -34,13 +83,502 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ------------------------
+# Metrics (Prometheus text exposition; no client library needed)
+# ------------------------
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))  # seconds between lag probes; 0 disables
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+FAST_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05)
+
+def _fmt_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{str(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Histogram:
+    """Fixed-bucket histogram; observe() is a bisect and two additions, cheap enough for every request."""
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.series: Dict[tuple, list] = {}  # label values -> [per-bucket counts (+Inf last), sum]
+
+    def observe(self, value: float, *labels):
+        s = self.series.get(labels)
+        if s is None:
+            s = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        s[0][bisect_left(self.buckets, value)] += 1
+        s[1] += value
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in self.series.items():
+            cum = 0
+            for le, c in zip(self.buckets + ("+Inf",), counts):
+                cum += c
+                le_label = 'le="%s"' % le
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, labels, le_label)} {cum}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labelnames, labels)} {total}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labelnames, labels)} {cum}")
+        return out
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.series: Dict[tuple, float] = {}
+
+    def inc(self, *labels, n: float = 1):
+        self.series[labels] = self.series.get(labels, 0) + n
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        out += [f"{self.name}{_fmt_labels(self.labelnames, k)} {v}" for k, v in self.series.items()]
+        return out
+
+HTTP_REQUESTS = Counter("http_requests_total", "Requests by route, method and status.", ("route", "method", "status"))
+HTTP_LATENCY = Histogram("http_request_duration_seconds", "Request latency until the response is fully sent.",
+                         ("route", "method"))
+UPSTREAM_LATENCY = Histogram("upstream_request_duration_seconds",
+                             "Time per upstream HTTP attempt (streams: until the body is consumed).",
+                             ("endpoint", "outcome"))
+SCORE_LATENCY = Histogram("score_heuristics_duration_seconds", "Time in the /score heuristics per prompt.",
+                          buckets=FAST_BUCKETS)
+LOCAL_COUNT_LATENCY = Histogram("count_local_estimate_duration_seconds", "Time per local token estimate.",
+                                buckets=FAST_BUCKETS)
+LOOP_LAG = Histogram("event_loop_lag_seconds", "How late the event loop woke a sleeping probe task.")
+METRICS: List[Any] = [HTTP_REQUESTS, HTTP_LATENCY, UPSTREAM_LATENCY, SCORE_LATENCY, LOCAL_COUNT_LATENCY, LOOP_LAG]
+
+# scrape-time collectors: () -> [(name, type, help, [(labels dict, value)])]; read state that already exists
+METRIC_COLLECTORS: List[Any] = []
+
+def register_metric_collector(fn):
+    METRIC_COLLECTORS.append(fn)
+    return fn
+
+def _render_metrics() -> str:
+    lines: List[str] = []
+    for m in METRICS:
+        lines += m.render()
+    for collect in METRIC_COLLECTORS:
+        for name, kind, help, samples in collect():
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            for labels, value in samples:
+                lines.append(f"{name}{_fmt_labels(tuple(labels), tuple(labels.values()))} {float(value)}")
+    return "\n".join(lines) + "\n"
+
+class MetricsMiddleware:
+    """Plain ASGI middleware (no BaseHTTPMiddleware task/queue overhead)."""
+
+    def __init__(self, app):
+        self.app = app
+        self.routes: Dict[Any, str] = {}  # endpoint function -> route path, filled on first sight
+
+    def _route(self, scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"  # keeps label cardinality bounded for 404 scans
+        route = self.routes.get(endpoint)
+        if route is None:
+            route = next((r.path for r in app.routes if getattr(r, "endpoint", None) is endpoint), "unmatched")
+            self.routes[endpoint] = route
+        return route
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        t0 = time.perf_counter()
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route, method = self._route(scope), scope["method"]
+            HTTP_LATENCY.observe(time.perf_counter() - t0, route, method)
+            HTTP_REQUESTS.inc(route, method, status[0])
+
+async def _monitor_loop_lag():
+    # a blocked loop shows up as a late wake-up
+    while True:
+        t0 = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        LOOP_LAG.observe(max(0.0, time.perf_counter() - t0 - LOOP_LAG_INTERVAL))
+
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
+@app.get("/metrics")
+async def metrics():
+    # on the event loop, like every writer of the series and collector state it reads
+    return PlainTextResponse(_render_metrics(), media_type="text/plain; version=0.0.4")
+
+# ------------------------
+# Upstream HTTP client (one pooled client for the app lifetime)
+# ------------------------
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "20"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "10"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "1") == "1"
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+UPSTREAM_POOL_TIMEOUT = float(os.getenv("UPSTREAM_POOL_TIMEOUT", "5"))
+COUNT_TIMEOUT = float(os.getenv("COUNT_TIMEOUT", "15"))
+COUNT_DEGRADE_LOCAL = os.getenv("COUNT_DEGRADE_LOCAL", "1") == "1"  # /count falls back to a local estimate
+REWRITE_TIMEOUT = float(os.getenv("REWRITE_TIMEOUT", "20"))
+
+ANTHROPIC_HEADERS = {
+    "x-api-key": ANTHROPIC_API_KEY,
+    "anthropic-version": "2023-06-01",
+    "content-type": "application/json",
+}
+
+_UPSTREAM: Dict[str, Any] = {"client": None, "slots": None}
+UPSTREAM_STATS = {"requests": 0, "waited": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0}
+
+def _upstream_client() -> "httpx.AsyncClient":
+    # created on the first upstream call, which is also when httpx gets imported
+    if _UPSTREAM["client"] is None:
+        _UPSTREAM["client"] = httpx.AsyncClient(
+            http2=UPSTREAM_HTTP2,
+            limits=httpx.Limits(
+                max_connections=UPSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+                keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(COUNT_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT, pool=UPSTREAM_POOL_TIMEOUT),
+            headers=ANTHROPIC_HEADERS,
+        )
+        # mirrors max_connections so we can measure how long callers wait for a slot
+        _UPSTREAM["slots"] = asyncio.Semaphore(UPSTREAM_MAX_CONNECTIONS)
+    return _UPSTREAM["client"]
+
+async def _close_upstream_client():
+    client = _UPSTREAM["client"]
+    _UPSTREAM["client"] = None
+    _UPSTREAM["slots"] = None
+    if client is not None:
+        await client.aclose()
+
+async def _acquire_upstream_slot(slots: asyncio.Semaphore):
+    t0 = time.perf_counter()
+    await slots.acquire()
+    wait_ms = (time.perf_counter() - t0) * 1000.0
+    UPSTREAM_STATS["requests"] += 1
+    UPSTREAM_STATS["wait_ms_total"] += wait_ms
+    if wait_ms >= 1.0:
+        UPSTREAM_STATS["waited"] += 1
+    UPSTREAM_STATS["wait_ms_max"] = max(UPSTREAM_STATS["wait_ms_max"], wait_ms)
+
+def _upstream_timeout(timeout: float) -> "httpx.Timeout":
+    return httpx.Timeout(timeout, connect=UPSTREAM_CONNECT_TIMEOUT, pool=UPSTREAM_POOL_TIMEOUT)
+
+# --- per-endpoint limiter, retries and circuit breaker ---
+UPSTREAM_QUEUE_MS = float(os.getenv("UPSTREAM_QUEUE_MS", "2000"))        # max wait for an endpoint slot
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))
+UPSTREAM_RETRY_BASE_MS = float(os.getenv("UPSTREAM_RETRY_BASE_MS", "200"))
+UPSTREAM_RETRY_MAX_MS = float(os.getenv("UPSTREAM_RETRY_MAX_MS", "4000"))
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))                # consecutive failed calls to open
+BREAKER_COOLDOWN_SECONDS = float(os.getenv("BREAKER_COOLDOWN_SECONDS", "30"))
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504, 529}
+
+class UpstreamUnavailable(Exception):
+    """Upstream not attempted or given up on: queue budget spent, breaker open, or retries exhausted."""
+
+    def __init__(self, endpoint: str, reason: str, retry_after: Optional[float] = None,
+                 status: Optional[int] = None):
+        super().__init__(f"upstream {endpoint} unavailable: {reason}")
+        self.endpoint = endpoint
+        self.reason = reason
+        self.retry_after = retry_after
+        self.status = status
+
+class CircuitBreaker:
+    """closed -> open after N consecutive failures -> half_open after cooldown (one probe) -> closed."""
+
+    def __init__(self, failures: int, cooldown_seconds: float):
+        self.failures = failures
+        self.cooldown_seconds = cooldown_seconds
+        self.state = "closed"
+        self.consecutive = 0
+        self.opened_at = 0.0
+        self.opened = 0
+        self.probing = False
+
+    def allow(self) -> bool:
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.cooldown_seconds:
+                return False
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self.probing:
+                return False
+            self.probing = True
+        return True
+
+    def record(self, ok: bool):
+        self.probing = False
+        if ok:
+            self.state = "closed"
+            self.consecutive = 0
+            return
+        self.consecutive += 1
+        if self.state == "half_open" or self.consecutive >= self.failures:
+            if self.state != "open":
+                self.opened += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def retry_after(self) -> float:
+        return max(0.0, self.cooldown_seconds - (time.monotonic() - self.opened_at))
+
+def _retry_after_seconds(r: "httpx.Response") -> Optional[float]:
+    value = r.headers.get("retry-after")
+    try:
+        return max(0.0, float(value)) if value else None
+    except ValueError:
+        return None  # HTTP-date form; fall back to our own backoff
+
+class UpstreamLimiter:
+    """Bounds concurrent calls to one upstream endpoint; a call holds its slot across retries."""
+
+    def __init__(self, name: str, concurrency: int):
+        self.name = name
+        self.concurrency = concurrency
+        self.sem = asyncio.Semaphore(concurrency)
+        self.breaker = CircuitBreaker(BREAKER_FAILURES, BREAKER_COOLDOWN_SECONDS)
+        self.stats = {"calls": 0, "succeeded": 0, "failed": 0, "retries": 0, "rejected_queue": 0,
+                      "rejected_open": 0, "degraded": 0, "in_flight": 0, "queued": 0,
+                      "queue_ms_total": 0.0, "queue_ms_max": 0.0}
+
+    async def enter(self):
+        """Take a slot within UPSTREAM_QUEUE_MS; raises UpstreamUnavailable instead of queueing forever."""
+        self.stats["calls"] += 1
+        if not self.breaker.allow():
+            self.stats["rejected_open"] += 1
+            raise UpstreamUnavailable(self.name, "circuit_open", self.breaker.retry_after())
+        t0 = time.perf_counter()
+        self.stats["queued"] += 1
+        try:
+            await asyncio.wait_for(self.sem.acquire(), UPSTREAM_QUEUE_MS / 1000.0)
+        except asyncio.TimeoutError:
+            self.stats["rejected_queue"] += 1
+            self.breaker.probing = False
+            raise UpstreamUnavailable(self.name, "queue_timeout", UPSTREAM_QUEUE_MS / 1000.0)
+        finally:
+            self.stats["queued"] -= 1
+        wait_ms = (time.perf_counter() - t0) * 1000.0
+        self.stats["queue_ms_total"] += wait_ms
+        self.stats["queue_ms_max"] = max(self.stats["queue_ms_max"], wait_ms)
+        self.stats["in_flight"] += 1
+
+    def leave(self):
+        self.stats["in_flight"] -= 1
+        self.sem.release()
+
+    async def run(self, attempt, timeout: float):
+        """attempt(timeout) until it succeeds, fails for good, or the timeout budget is spent."""
+        deadline = time.monotonic() + timeout
+        recorded = False
+        try:
+            for n in range(UPSTREAM_RETRIES + 1):
+                remaining = deadline - time.monotonic()
+                try:
+                    result = await attempt(max(remaining, 0.001))
+                    self.breaker.record(True)
+                    recorded = True
+                    self.stats["succeeded"] += 1
+                    return result
+                except httpx.HTTPStatusError as e:
+                    if e.response.status_code not in RETRYABLE_STATUS:
+                        self.breaker.record(True)  # the upstream answered; the request was bad
+                        recorded = True
+                        self.stats["failed"] += 1
+                        raise
+                    last, status, hint = e, e.response.status_code, _retry_after_seconds(e.response)
+                except httpx.TransportError as e:
+                    last, status, hint = e, None, None
+                # full jitter, but never sooner than the upstream asked for
+                backoff = random.uniform(0, min(UPSTREAM_RETRY_MAX_MS, UPSTREAM_RETRY_BASE_MS * 2 ** n)) / 1000.0
+                delay = max(backoff, hint or 0.0)
+                if n == UPSTREAM_RETRIES or time.monotonic() + delay >= deadline:
+                    break
+                self.stats["retries"] += 1
+                await asyncio.sleep(delay)
+            self.breaker.record(False)
+            recorded = True
+            self.stats["failed"] += 1
+            raise UpstreamUnavailable(self.name, "retries_exhausted", hint, status) from last
+        finally:
+            if not recorded:
+                self.breaker.probing = False  # cancelled mid-probe; let the next call probe
+
+    async def call(self, attempt, timeout: float):
+        await self.enter()
+        try:
+            return await self.run(attempt, timeout)
+        finally:
+            self.leave()
+
+    def snapshot(self) -> Dict[str, Any]:
+        st = self.stats
+        done = st["calls"] - st["rejected_open"] - st["rejected_queue"]
+        return {
+            "concurrency": self.concurrency,
+            **{k: v for k, v in st.items() if k not in ("queue_ms_total", "queue_ms_max")},
+            "queue_ms_avg": round(st["queue_ms_total"] / done, 3) if done > 0 else 0.0,
+            "queue_ms_max": round(st["queue_ms_max"], 3),
+            "breaker": {"state": self.breaker.state, "opened": self.breaker.opened,
+                        "consecutive_failures": self.breaker.consecutive},
+        }
+
+UPSTREAM_LIMITERS = {
+    "count": UpstreamLimiter("count", int(os.getenv("UPSTREAM_COUNT_CONCURRENCY", "12"))),
+    "messages": UpstreamLimiter("messages", int(os.getenv("UPSTREAM_MESSAGES_CONCURRENCY", "8"))),
+}
+
+def _unavailable_http(e: UpstreamUnavailable) -> HTTPException:
+    headers = {"Retry-After": str(math.ceil(e.retry_after))} if e.retry_after is not None else None
+    return HTTPException(status_code=429 if e.status == 429 else 503, detail=str(e), headers=headers)
+
+# set by /analyze on the count task it starts, so it can score while that count waits on the network
+UPSTREAM_WAIT_SIGNAL: ContextVar[Optional[asyncio.Event]] = ContextVar("upstream_wait_signal", default=None)
+
+def _signal_upstream_wait():
+    ev = UPSTREAM_WAIT_SIGNAL.get()
+    if ev is not None:
+        ev.set()
+
+async def _upstream_post(url: str, payload: Dict[str, Any], timeout: float, endpoint: str) -> "httpx.Response":
+    client = _upstream_client()
+
+    async def attempt(t: float) -> "httpx.Response":
+        slots = _UPSTREAM["slots"]
+        await _acquire_upstream_slot(slots)
+        t0 = time.perf_counter()
+        outcome = "error"
+        try:
+            _signal_upstream_wait()
+            r = await client.post(url, json=payload, timeout=_upstream_timeout(t))
+            outcome = "ok" if r.is_success else str(r.status_code)
+        finally:
+            slots.release()
+            UPSTREAM_LATENCY.observe(time.perf_counter() - t0, endpoint, outcome)
+        r.raise_for_status()
+        return r
+
+    return await UPSTREAM_LIMITERS[endpoint].call(attempt, timeout)
+
+async def _upstream_open_stream(url: str, payload: Dict[str, Any], timeout: float, endpoint: str) -> tuple:
+    """Send a streaming POST; returns (response, release). Call release() once the body is consumed.
+
+    Retries only cover opening the stream; the endpoint slot is held until release().
+    """
+    client = _upstream_client()
+    limiter = UPSTREAM_LIMITERS[endpoint]
+
+    async def attempt(t: float) -> tuple:
+        slots = _UPSTREAM["slots"]
+        await _acquire_upstream_slot(slots)
+        t0 = time.perf_counter()
+
+        async def release():
+            await r.aclose()
+            slots.release()
+            UPSTREAM_LATENCY.observe(time.perf_counter() - t0, endpoint, "ok" if r.is_success else str(r.status_code))
+
+        try:
+            request = client.build_request("POST", url, json=payload, timeout=_upstream_timeout(t))
+            r = await client.send(request, stream=True)
+        except BaseException:
+            slots.release()
+            UPSTREAM_LATENCY.observe(time.perf_counter() - t0, endpoint, "error")
+            raise
+        if r.is_error:
+            await r.aread()
+            await release()
+            r.raise_for_status()
+        return r, release
+
+    await limiter.enter()
+    try:
+        r, release_conn = await limiter.run(attempt, timeout)
+    except BaseException:
+        limiter.leave()
+        raise
+
+    async def release():
+        try:
+            await release_conn()
+        finally:
+            limiter.leave()
+
+    return r, release
+
+def _upstream_pool_stats() -> Dict[str, Any]:
+    client = _UPSTREAM["client"]
+    # httpx does not expose its pool; read httpcore's connection list when available
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    conns = list(getattr(pool, "connections", []) or [])
+    n = UPSTREAM_STATS["requests"]
+    return {
+        "http2": UPSTREAM_HTTP2,
+        "max_connections": UPSTREAM_MAX_CONNECTIONS,
+        "max_keepalive_connections": UPSTREAM_MAX_KEEPALIVE,
+        "open_connections": sum(1 for c in conns if not c.is_closed()),
+        "idle_connections": sum(1 for c in conns if c.is_idle()),
+        "requests": n,
+        "requests_waited": UPSTREAM_STATS["waited"],
+        "wait_ms_avg": round(UPSTREAM_STATS["wait_ms_total"] / n, 3) if n else 0.0,
+        "wait_ms_max": round(UPSTREAM_STATS["wait_ms_max"], 3),
+        "endpoints": {name: lim.snapshot() for name, lim in UPSTREAM_LIMITERS.items()},
+    }
+
+@app.get("/upstream/stats")
+def upstream_stats():
+    return _upstream_pool_stats()
+
+BREAKER_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+@register_metric_collector
+def _upstream_metrics():
+    lims = UPSTREAM_LIMITERS.values()
+    results = ("succeeded", "failed", "rejected_queue", "rejected_open", "degraded")
+    return [
+        ("upstream_calls_total", "counter", "Upstream calls by final result.",
+         [({"endpoint": l.name, "result": r}, l.stats[r]) for l in lims for r in results]),
+        ("upstream_retries_total", "counter", "Upstream retry attempts.",
+         [({"endpoint": l.name}, l.stats["retries"]) for l in lims]),
+        ("upstream_in_flight", "gauge", "Calls holding an endpoint slot.",
+         [({"endpoint": l.name}, l.stats["in_flight"]) for l in lims]),
+        ("upstream_queued", "gauge", "Calls waiting for an endpoint slot.",
+         [({"endpoint": l.name}, l.stats["queued"]) for l in lims]),
+        ("upstream_breaker_state", "gauge", "Circuit breaker: 0 closed, 1 half open, 2 open.",
+         [({"endpoint": l.name}, BREAKER_STATES[l.breaker.state]) for l in lims]),
+    ]
+
 # ------------------------
 # Count Endpoint
 # ------------------------
 class CountReq(BaseModel):
-    text: str
+    text: str = ""                              # full prompt; may be omitted in incremental mode
     model: str = "claude-3-5-haiku-20241022"   # pick a default
     expected_output_tokens: Optional[int] = None  # optional
+    # incremental mode: revision returned by an earlier /count plus the edit since then
+    base_revision: Optional[str] = None
+    delta: str = ""                             # text inserted/appended at the edit point
+    removed_chars: int = 0                      # chars of the base deleted at the edit point
+    final: bool = False                         # e.g. on submit: force an exact count
+    mode: str = "exact"                         # exact | local | auto (local if upstream is over budget)
+    region: Optional[str] = None                # grid region for impact factors; IMPACT_REGION if omitted
 
 class CountRes(BaseModel):
     tokens_input: int
@@ -50,37 +588,1313 @@ class CountRes(BaseModel):
     kwh: Optional[float] = None
     co2_kg: Optional[float] = None
     water_l: Optional[float] = None
+    exact: bool = True                # False when tokens_input is a local estimate
+    revision: Optional[str] = None    # pass back as base_revision with the next delta
+    reconcile_needed: bool = False    # send the full text next time to get an exact count
+    factors: Optional[Dict[str, Any]] = None  # factor set behind kwh/co2_kg/water_l
+    degraded: bool = False            # upstream unavailable (breaker/queue/retries); local estimate used
+
+ANTHROPIC_BASE_URL = os.getenv("ANTHROPIC_BASE_URL", "https://api.anthropic.com").rstrip("/")  # e.g. a local mock
+ANTHROPIC_BASE_COUNT = f"{ANTHROPIC_BASE_URL}/v1/messages/count_tokens"
+
+# ------------------------
+# Token-count cache (digest -> count only, never the prompt text)
+# ------------------------
+TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", "50000"))
+TOKEN_CACHE_MAX_BYTES = int(os.getenv("TOKEN_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+TOKEN_CACHE_TTL_SECONDS = int(os.getenv("TOKEN_CACHE_TTL_SECONDS", str(6 * 60 * 60)))
+
+class LRUTTLCache:
+    """Bounded LRU cache with per-entry TTL and an approximate byte budget."""
+
+    # per-entry bookkeeping (OrderedDict node, tuple, ints) on top of key/value
+    ENTRY_OVERHEAD_BYTES = 120
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl_seconds: int, sizeof=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._sizeof = sizeof or (lambda key, value: len(key))
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()  # key -> (value, expires_at, nbytes)
+        self.bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            self.stats["misses"] += 1
+            return None
+        value, expires_at, nbytes = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.bytes -= nbytes
+            self.stats["expirations"] += 1
+            self.stats["misses"] += 1
+            return None
+        self._data.move_to_end(key)
+        self.stats["hits"] += 1
+        return value
+
+    def put(self, key, value):
+        old = self._data.pop(key, None)
+        if old is not None:
+            self.bytes -= old[2]
+        nbytes = self._sizeof(key, value) + self.ENTRY_OVERHEAD_BYTES
+        self._data[key] = (value, time.monotonic() + self.ttl_seconds, nbytes)
+        self.bytes += nbytes
+        while self._data and (len(self._data) > self.max_entries or self.bytes > self.max_bytes):
+            _, (_, _, evicted_bytes) = self._data.popitem(last=False)
+            self.bytes -= evicted_bytes
+            self.stats["evictions"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "entries": len(self._data),
+            "bytes": self.bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0,
+        }
+
+TOKEN_CACHE = LRUTTLCache(TOKEN_CACHE_MAX_ENTRIES, TOKEN_CACHE_MAX_BYTES, TOKEN_CACHE_TTL_SECONDS)
+_INFLIGHT_COUNTS: Dict[bytes, asyncio.Future] = {}
+TOKEN_CACHE_COALESCED = {"count": 0}
 
-ANTHROPIC_BASE_COUNT = "https://api.anthropic.com/v1/messages/count_tokens"
+def _count_key(model: str, text: str) -> bytes:
+    return hashlib.blake2b(f"{model}\x00{text}".encode("utf-8"), digest_size=16).digest()
 
-# rough constants
+async def _count_input_tokens(model: str, text: str) -> int:
+    key = _count_key(model, text)
+    cached = TOKEN_CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    # identical request already upstream: wait for its answer instead of sending another
+    pending = _INFLIGHT_COUNTS.get(key)
+    if pending is not None:
+        TOKEN_CACHE_COALESCED["count"] += 1
+        _signal_upstream_wait()
+        return await asyncio.shield(pending)
+
+    fut = asyncio.get_running_loop().create_future()
+    _INFLIGHT_COUNTS[key] = fut
+    try:
+        payload = {"model": model, "messages": [{"role": "user", "content": text}]}
+        t0 = time.perf_counter()
+        r = await _upstream_post(ANTHROPIC_BASE_COUNT, payload, COUNT_TIMEOUT, "count")
+        _observe_count_latency((time.perf_counter() - t0) * 1000.0)
+        tokens = int(r.json().get("input_tokens", 0))
+        TOKEN_CACHE.put(key, tokens)
+        _token_estimator(model).observe(model, text, tokens)
+        fut.set_result(tokens)
+        return tokens
+    except asyncio.CancelledError:
+        fut.cancel()
+        raise
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()  # mark retrieved when nobody else was waiting
+        raise
+    finally:
+        _INFLIGHT_COUNTS.pop(key, None)
+
+# ------------------------
+# Incremental counting (revision -> count/length only, never the prompt text)
+# ------------------------
+REVISION_TTL_SECONDS = int(os.getenv("REVISION_TTL_SECONDS", str(60 * 60)))
+REVISION_SECRET = os.getenv("REVISION_SECRET", "")  # MAC key; derived from ANTHROPIC_API_KEY when unset
+COUNT_RECONCILE_SECONDS = float(os.getenv("COUNT_RECONCILE_SECONDS", "3"))
+COUNT_RECONCILE_EDITS = int(os.getenv("COUNT_RECONCILE_EDITS", "25"))
+CHARS_PER_TOKEN = 4.0
+
+# A revision is the base state itself, packed and MACed, so any worker (or a restarted one)
+# can continue from it and nothing is kept server-side. Every worker derives the same key.
+_REVISION_KEY = hashlib.blake2b((REVISION_SECRET or ANTHROPIC_API_KEY).encode("utf-8"),
+                                digest_size=32, person=b"eden-revision").digest()
+_REVISION_FMT = struct.Struct("<B8sdIIIdH")  # version, model hash, tokens, chars, exact tokens/chars/at, edits
+_REVISION_MAC_BYTES = 12
+INCREMENTAL_STATS = {"estimated": 0, "reconciled": 0, "unknown_base": 0}
+
+def _model_tag(model: str) -> bytes:
+    return hashlib.blake2b(model.encode("utf-8"), digest_size=8).digest()
+
+def _put_revision(model: str, tokens: float, chars: int,
+                  exact_tokens: int, exact_chars: int, exact_at: float, edits: int) -> str:
+    body = _REVISION_FMT.pack(1, _model_tag(model), tokens, chars, exact_tokens, exact_chars,
+                              exact_at, min(edits, 0xFFFF))
+    mac = hashlib.blake2b(body, key=_REVISION_KEY, digest_size=_REVISION_MAC_BYTES).digest()
+    return base64.urlsafe_b64encode(body + mac).rstrip(b"=").decode("ascii")
+
+def _get_revision(rev: str, model: str) -> Optional[Dict[str, Any]]:
+    """Base state of a revision for this model, or None if it is malformed, forged or expired."""
+    try:
+        raw = base64.urlsafe_b64decode(rev + "=" * (-len(rev) % 4))
+    except ValueError:
+        return None
+    if len(raw) != _REVISION_FMT.size + _REVISION_MAC_BYTES:
+        return None
+    body, mac = raw[:_REVISION_FMT.size], raw[_REVISION_FMT.size:]
+    if not hmac.compare_digest(mac, hashlib.blake2b(body, key=_REVISION_KEY,
+                                                    digest_size=_REVISION_MAC_BYTES).digest()):
+        return None
+    version, tag, tokens, chars, exact_tokens, exact_chars, exact_at, edits = _REVISION_FMT.unpack(body)
+    if version != 1 or tag != _model_tag(model) or time.time() - exact_at > REVISION_TTL_SECONDS:
+        return None
+    return {
+        "tokens": tokens, "chars": chars,
+        "exact_tokens": exact_tokens, "exact_chars": exact_chars,
+        "exact_at": exact_at, "edits": edits,
+    }
+
+def _exact_revision(model: str, text: str, tokens: int) -> str:
+    # wall clock, not monotonic: the revision may come back to another process
+    return _put_revision(model, float(tokens), len(text), tokens, len(text), time.time(), 0)
+
+def _estimate_from_base(base: Dict[str, Any], delta: str, removed_chars: int) -> tuple:
+    # tokens/char of the last exact count is a per-prompt calibration for the delta
+    ratio = (base["exact_tokens"] / base["exact_chars"]) if base["exact_chars"] else 1.0 / CHARS_PER_TOKEN
+    removed = min(max(0, removed_chars), base["chars"])
+    tokens = max(0.0, base["tokens"] - removed * ratio + len(delta) * ratio)
+    return tokens, base["chars"] - removed + len(delta)
+
+def _reconcile_due(base: Dict[str, Any], final: bool) -> bool:
+    if final:
+        return True
+    if base["edits"] + 1 >= COUNT_RECONCILE_EDITS:
+        return True
+    return time.time() - base["exact_at"] >= COUNT_RECONCILE_SECONDS
+
+# ------------------------
+# Local token estimation (offline fallback, calibrated against exact counts)
+# ------------------------
+COUNT_MODES = ("exact", "local", "auto")
+COUNT_AUTO_BUDGET_MS = float(os.getenv("COUNT_AUTO_BUDGET_MS", "300"))
+COUNT_LATENCY = {"ewma_ms": 0.0, "samples": 0}
+COUNT_AUTO_PROBE_SECONDS = float(os.getenv("COUNT_AUTO_PROBE_SECONDS", "5"))
+COUNT_AUTO_PROBE: Dict[str, Any] = {"task": None, "at": 0.0}
+COUNT_AUTO_STATS = {"exact": 0, "local_fallback": 0, "local_unhealthy": 0, "probes": 0}
+
+_WORD_RE = re.compile(r"[A-Za-z]+")
+_DIGIT_RE = re.compile(r"\d")
+_SYMBOL_RE = re.compile(r"[^\sA-Za-z\d]")
+
+class CharWordEstimator:
+    """Word/char token model for one model family; its scale tracks exact counts."""
+
+    def __init__(self, family: str, scale: float = 1.0, alpha: float = 0.05):
+        self.family = family
+        self.scale = scale
+        self.alpha = alpha
+        self.errors: Dict[str, Dict[str, float]] = {}  # model -> running error stats
+
+    def raw(self, text: str) -> float:
+        words = _WORD_RE.findall(text)
+        letters = sum(map(len, words))
+        # words up to ~6 letters are one token; longer ones split roughly every 4 letters
+        overflow = max(0, letters - 6 * len(words))
+        digits = len(_DIGIT_RE.findall(text))
+        symbols = len(_SYMBOL_RE.findall(text))
+        return len(words) + overflow / 4.0 + digits / 2.0 + symbols
+
+    def estimate(self, text: str) -> int:
+        if not text:
+            return 0
+        return max(1, int(round(self.raw(text) * self.scale)))
+
+    def observe(self, model: str, text: str, exact: int):
+        raw = self.raw(text)
+        if raw <= 0 or exact <= 0:
+            return
+        err = raw * self.scale - exact
+        e = self.errors.setdefault(model, {"samples": 0, "mape": 0.0, "bias": 0.0})
+        e["samples"] += 1
+        a = max(self.alpha, 1.0 / e["samples"])
+        e["mape"] += a * (abs(err) / exact - e["mape"])
+        e["bias"] += a * (err / exact - e["bias"])
+        self.scale += self.alpha * (exact / raw - self.scale)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "scale": round(self.scale, 4),
+            "models": {m: {"samples": e["samples"], "mape": round(e["mape"], 4), "bias": round(e["bias"], 4)}
+                       for m, e in self.errors.items()},
+        }
+
+TOKEN_ESTIMATORS: Dict[str, Any] = {"claude": CharWordEstimator("claude", scale=1.05)}
+
+def _model_family(model: str) -> str:
+    return (model or "").split("-", 1)[0].lower() or "default"
+
+def register_token_estimator(family: str, estimator: Any):
+    # anything with estimate(text) / observe(model, text, exact) / snapshot() works
+    TOKEN_ESTIMATORS[family] = estimator
+
+def _token_estimator(model: str):
+    family = _model_family(model)
+    est = TOKEN_ESTIMATORS.get(family)
+    if est is None:
+        est = TOKEN_ESTIMATORS[family] = CharWordEstimator(family)
+    return est
+
+def _estimate_tokens_local(model: str, text: str) -> int:
+    t0 = time.perf_counter()
+    tokens = _token_estimator(model).estimate(text)
+    LOCAL_COUNT_LATENCY.observe(time.perf_counter() - t0)
+    return tokens
+
+def _observe_count_latency(ms: float):
+    COUNT_LATENCY["samples"] += 1
+    a = max(0.1, 1.0 / COUNT_LATENCY["samples"])
+    COUNT_LATENCY["ewma_ms"] += a * (ms - COUNT_LATENCY["ewma_ms"])
+
+_BACKGROUND_TASKS: set = set()
+
+def _keep_background(task: asyncio.Task):
+    # hold a reference until done; a late upstream answer still fills the cache
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(lambda t: (_BACKGROUND_TASKS.discard(t), t.cancelled() or t.exception()))
+
+def _count_upstream_healthy() -> bool:
+    breaker = UPSTREAM_LIMITERS["count"].breaker
+    return breaker.state == "closed" and COUNT_LATENCY["ewma_ms"] <= COUNT_AUTO_BUDGET_MS
+
+def _probe_count_upstream(model: str, text: str):
+    # while unhealthy, one background count every COUNT_AUTO_PROBE_SECONDS keeps the EWMA
+    # (and the breaker) current, so auto mode notices when the upstream recovers
+    probe = COUNT_AUTO_PROBE["task"]
+    if (probe is not None and not probe.done()) or time.monotonic() - COUNT_AUTO_PROBE["at"] < COUNT_AUTO_PROBE_SECONDS:
+        return
+    COUNT_AUTO_PROBE["at"] = time.monotonic()
+    COUNT_AUTO_PROBE["task"] = task = asyncio.ensure_future(_count_input_tokens(model, text))
+    COUNT_AUTO_STATS["probes"] += 1
+    _keep_background(task)
+
+async def _count_input_tokens_auto(model: str, text: str) -> tuple:
+    # (tokens, exact): race the upstream only while it has been healthy; otherwise answer locally
+    if not _count_upstream_healthy():
+        cached = TOKEN_CACHE.get(_count_key(model, text))
+        if cached is not None:
+            return cached, True
+        COUNT_AUTO_STATS["local_unhealthy"] += 1
+        _probe_count_upstream(model, text)
+        return _estimate_tokens_local(model, text), False
+    task = asyncio.ensure_future(_count_input_tokens(model, text))
+    try:
+        tokens = await asyncio.wait_for(asyncio.shield(task), COUNT_AUTO_BUDGET_MS / 1000.0)
+        COUNT_AUTO_STATS["exact"] += 1
+        return tokens, True
+    except asyncio.TimeoutError:
+        # let it finish: its latency is what moves the EWMA over budget; it also stands in for a probe
+        COUNT_AUTO_PROBE["task"] = task
+        _keep_background(task)
+    except Exception:
+        pass
+    COUNT_AUTO_STATS["local_fallback"] += 1
+    return _estimate_tokens_local(model, text), False
+
+@app.get("/count/local/stats")
+async def count_local_stats():
+    # async: read on the loop, so the estimators' dicts cannot change mid-iteration
+    return {
+        "auto_budget_ms": COUNT_AUTO_BUDGET_MS,
+        "upstream_latency_ewma_ms": round(COUNT_LATENCY["ewma_ms"], 3),
+        "upstream_latency_samples": COUNT_LATENCY["samples"],
+        "upstream_healthy": _count_upstream_healthy(),
+        "auto": dict(COUNT_AUTO_STATS),
+        "families": {f: e.snapshot() for f, e in TOKEN_ESTIMATORS.items()},
+    }
+
+@register_metric_collector
+def _count_metrics():
+    snap = TOKEN_CACHE.snapshot()
+    return [
+        ("token_cache_requests_total", "counter", "Token-count cache lookups.",
+         [({"result": "hit"}, snap["hits"]), ({"result": "miss"}, snap["misses"])]),
+        ("token_cache_entries", "gauge", "Entries in the token-count cache.", [({}, snap["entries"])]),
+        ("token_count_coalesced_total", "counter", "Counts answered by an identical in-flight request.",
+         [({}, TOKEN_CACHE_COALESCED["count"])]),
+        ("token_count_incremental_total", "counter", "Incremental /count outcomes.",
+         [({"result": k}, v) for k, v in INCREMENTAL_STATS.items()]),
+    ]
+
+@app.get("/count/cache/stats")
+def count_cache_stats():
+    return {
+        **TOKEN_CACHE.snapshot(),
+        "coalesced": TOKEN_CACHE_COALESCED["count"],
+        "inflight": len(_INFLIGHT_COUNTS),
+        "incremental": dict(INCREMENTAL_STATS),
+    }
+
+# rough constants; the builtin factor set when impact_factors.json is absent
 WH_PER_TOKEN = 0.05
 KGCO2_PER_KWH = 0.40
 WUE_L_PER_KWH = 1.8
 
 # ------------------------
-# In-memory session store (no prompt text)
+# Impact factors (per model / per region)
 # ------------------------
+IMPACT_FACTORS_PATH = os.getenv(
+    "IMPACT_FACTORS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "impact_factors.json"))
+IMPACT_REGION = os.getenv("IMPACT_REGION", "default")  # used when a request names no region
+
+class FactorSet:
+    """Factors for one (model, region) pair; carbon intensity is a 24-entry curve by local hour."""
+
+    __slots__ = ("model", "region", "version", "wh_in", "wh_out", "co2_curve", "co2_by_hour", "flat",
+                 "wue", "utc_offset_s")
+
+    def __init__(self, model: str, region: str, version: str, wh_in: float, wh_out: float,
+                 co2_curve: List[float], wue: float, utc_offset_hours: float):
+        self.model = model
+        self.region = region
+        self.version = version
+        self.wh_in = wh_in
+        self.wh_out = wh_out
+        self.co2_by_hour = tuple(co2_curve)
+        self.co2_curve = np.array(co2_curve, dtype=np.float64)
+        self.flat = len(set(self.co2_by_hour)) == 1
+        self.wue = wue
+        self.utc_offset_s = int(utc_offset_hours * 3600)
+
+    def wh(self, tokens_total, tokens_input=None):
+        # a single rate multiplies the total, exactly as before input/output factors existed
+        if tokens_input is None or self.wh_in == self.wh_out:
+            return tokens_total * self.wh_out
+        return tokens_input * self.wh_in + (tokens_total - tokens_input) * self.wh_out
+
+    def hour(self, ts):
+        return (ts + self.utc_offset_s) // 3600 % 24
+
+    def kgco2_at(self, ts: Optional[int] = None) -> float:
+        if self.flat:
+            return self.co2_by_hour[0]
+        return self.co2_by_hour[self.hour(_now() if ts is None else ts)]
+
+    def kgco2_column(self, ts) -> Any:
+        if self.flat or ts is None:
+            return self.kgco2_at()
+        return self.co2_curve[self.hour(np.asarray(ts, dtype=np.int64))]
+
+    def info(self, ts: Optional[int] = None) -> Dict[str, Any]:
+        """The factor set as reported in responses; with ts, the carbon intensity applied at that time."""
+        out = {"model": self.model, "region": self.region, "version": self.version,
+               "wh_per_input_token": self.wh_in, "wh_per_output_token": self.wh_out,
+               "wue_l_per_kwh": self.wue}
+        if self.flat:
+            out["kgco2_per_kwh"] = self.co2_by_hour[0]
+        elif ts is None:
+            out["kgco2_per_kwh_by_hour"] = list(self.co2_by_hour)
+        else:
+            out["kgco2_per_kwh"] = self.kgco2_at(ts)
+            out["local_hour"] = int(self.hour(ts))
+        return out
+
+class FactorRegistry:
+    """Every (model, region) FactorSet built up front; model names resolve by longest prefix, memoized."""
+
+    MAX_RESOLVED = 1024
+
+    def __init__(self, version: str, models: Dict[str, Dict[str, float]], regions: Dict[str, Dict[str, Any]]):
+        self.version = version
+        self.models = models
+        self.regions = regions
+        self.table = {
+            (m, r): FactorSet(m, r, version, mf["wh_per_input_token"], mf["wh_per_output_token"],
+                              rf["kgco2_per_kwh"], rf["wue_l_per_kwh"], rf.get("utc_offset_hours", 0))
+            for m, mf in models.items() for r, rf in regions.items()
+        }
+        self._prefixes = sorted((m for m in models if m != "default"), key=len, reverse=True)
+        self._resolved: Dict[str, str] = {}
+        self.default = self.get(None, None)
+
+    def resolve_model(self, model: Optional[str]) -> str:
+        name = (model or "").lower()
+        key = self._resolved.get(name)
+        if key is None:
+            key = next((p for p in self._prefixes if name.startswith(p)), "default")
+            if len(self._resolved) >= self.MAX_RESOLVED:
+                self._resolved.clear()
+            self._resolved[name] = key
+        return key
+
+    def get(self, model: Optional[str], region: Optional[str]) -> FactorSet:
+        """Raises KeyError for a region that is not in the registry."""
+        return self.table[(self.resolve_model(model), region or IMPACT_REGION)]
+
+    def describe(self) -> Dict[str, Any]:
+        return {"version": self.version, "default_region": IMPACT_REGION,
+                "models": self.models, "regions": self.regions}
+
+def _load_factors(path: str) -> FactorRegistry:
+    """Parse a factors file; raises ValueError on a malformed file."""
+    with open(path, encoding="utf-8") as f:
+        raw = json.load(f)
+    if not isinstance(raw, dict) or not raw.get("version"):
+        raise ValueError("factors file needs a top-level object with a 'version'")
+    models = raw.get("models", {})
+    regions = raw.get("regions", {})
+    if "default" not in models:
+        raise ValueError("'models' needs a 'default' entry")
+    if IMPACT_REGION not in regions:
+        raise ValueError(f"'regions' needs an entry for IMPACT_REGION '{IMPACT_REGION}'")
+    for name, m in models.items():
+        for k in ("wh_per_input_token", "wh_per_output_token"):
+            if not isinstance(m.get(k), (int, float)) or m[k] < 0:
+                raise ValueError(f"models.{name}.{k} must be a non-negative number")
+    for name, r in regions.items():
+        co2 = r.get("kgco2_per_kwh")
+        if isinstance(co2, (int, float)):
+            co2 = [co2] * 24
+        if not isinstance(co2, list) or len(co2) != 24 or not all(isinstance(v, (int, float)) for v in co2):
+            raise ValueError(f"regions.{name}.kgco2_per_kwh must be a number or 24 numbers (local hours 0-23)")
+        if not isinstance(r.get("wue_l_per_kwh"), (int, float)):
+            raise ValueError(f"regions.{name}.wue_l_per_kwh must be a number")
+        regions[name] = {**r, "kgco2_per_kwh": co2}
+    return FactorRegistry(str(raw["version"]), {k.lower(): v for k, v in models.items()}, regions)
+
+def _initial_factors() -> FactorRegistry:
+    try:
+        return _load_factors(IMPACT_FACTORS_PATH)
+    except FileNotFoundError:
+        return FactorRegistry(
+            "builtin",
+            {"default": {"wh_per_input_token": WH_PER_TOKEN, "wh_per_output_token": WH_PER_TOKEN}},
+            {IMPACT_REGION: {"kgco2_per_kwh": [KGCO2_PER_KWH] * 24, "wue_l_per_kwh": WUE_L_PER_KWH}},
+        )
+
+FACTORS = _initial_factors()
+
+def _factors(model: Optional[str], region: Optional[str]) -> FactorSet:
+    try:
+        return FACTORS.get(model, region)
+    except KeyError:
+        raise HTTPException(status_code=400, detail=f"Unknown region: {region}")
+
+# ------------------------
+# Session store (no prompt text)
+# ------------------------
+SESSION_STORE_BACKEND = os.getenv("SESSION_STORE", "memory")  # memory | sqlite
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "sessions.sqlite3")
+SESSION_FLUSH_MS = float(os.getenv("SESSION_FLUSH_MS", "5"))        # sqlite group-commit window
+SESSION_MAX_TURNS = int(os.getenv("SESSION_MAX_TURNS", "5000"))     # per-session turn history kept
+SESSION_SWEEP_SECONDS = float(os.getenv("SESSION_SWEEP_SECONDS", "60"))  # background TTL sweep period
+# sqlite only: every ingest/reset is also written to a change feed that each worker process relays to
+# its own push subscribers (gunicorn.conf.py turns it on when it runs several workers)
+SESSION_CHANGE_FEED = os.getenv("SESSION_CHANGE_FEED", "0") == "1"
+SESSION_CHANGE_RETAIN_SECONDS = float(os.getenv("SESSION_CHANGE_RETAIN_SECONDS", "300"))
 SESSIONS: Dict[str, Dict[str, Any]] = {}
 SESSION_TTL_SECONDS = 24 * 60 * 60  # 24h
 
+TURN_FIELDS = ["turn_index", "ts", "tokens_input", "tokens_total", "kwh", "co2_kg", "water_l"]
+
 def _now() -> int:
     return int(time.time())
 
-def _evict_expired_sessions():
-    now = _now()
-    stale = [sid for sid, rec in SESSIONS.items() if now - rec.get("updated_at", now) > SESSION_TTL_SECONDS]
-    for sid in stale:
-        SESSIONS.pop(sid, None)
+class TurnColumns:
+    """Turn history as typed columns (8 bytes per field per turn); turn_index is implied."""
+
+    __slots__ = ("first_index", "ts", "tokens_input", "tokens_total", "kwh", "co2_kg", "water_l")
+    ROW_BYTES = 8 * 6
+
+    def __init__(self, first_index: int = 1):
+        self.first_index = first_index
+        self.ts = array("q")
+        self.tokens_input = array("q")
+        self.tokens_total = array("q")
+        self.kwh = array("d")
+        self.co2_kg = array("d")
+        self.water_l = array("d")
+
+    @classmethod
+    def from_rows(cls, rows: List[tuple]) -> "TurnColumns":
+        # rows: (turn_index, ts, tokens_input, tokens_total, kwh, co2_kg, water_l), contiguous turn_index
+        cols = cls(rows[0][0] if rows else 1)
+        if rows:
+            _, ts, ti, tt, kwh, co2, water = zip(*rows)
+            cols.ts.extend(ts)
+            cols.tokens_input.extend(ti)
+            cols.tokens_total.extend(tt)
+            cols.kwh.extend(kwh)
+            cols.co2_kg.extend(co2)
+            cols.water_l.extend(water)
+        return cols
+
+    @classmethod
+    def from_columns(cls, ts, tokens_input, tokens_total, kwh, co2_kg, water_l) -> "TurnColumns":
+        # numpy columns are copied as raw bytes, no per-element Python objects
+        cols = cls()
+        for col, values in ((cols.ts, ts), (cols.tokens_input, tokens_input), (cols.tokens_total, tokens_total),
+                            (cols.kwh, kwh), (cols.co2_kg, co2_kg), (cols.water_l, water_l)):
+            col.frombytes(np.ascontiguousarray(values, dtype="<i8" if col.typecode == "q" else "<f8").tobytes())
+        return cols
+
+    def __len__(self) -> int:
+        return len(self.ts)
+
+    def _columns(self) -> tuple:
+        return (self.ts, self.tokens_input, self.tokens_total, self.kwh, self.co2_kg, self.water_l)
+
+    def take(self, idx: List[int]) -> "TurnColumns":
+        out = TurnColumns(self.first_index)
+        for src, dst in zip(self._columns(), out._columns()):
+            dst.extend(src[i] for i in idx)
+        return out
+
+    def extend(self, other: "TurnColumns"):
+        for dst, src in zip(self._columns(), other._columns()):
+            dst.extend(src)
+
+    def append(self, ts: int, tokens_input: int, tokens_total: int, impact: Dict[str, float]):
+        self.ts.append(ts)
+        self.tokens_input.append(tokens_input)
+        self.tokens_total.append(tokens_total)
+        self.kwh.append(impact["kwh"])
+        self.co2_kg.append(impact["co2_kg"])
+        self.water_l.append(impact["water_l"])
+
+    @classmethod
+    def single(cls, ts: int, tokens_input: int, tokens_total: int, impact: Dict[str, float]) -> "TurnColumns":
+        cols = cls()
+        cols.append(ts, tokens_input, tokens_total, impact)
+        return cols
+
+    def keep_last(self, n: int):
+        drop = len(self.ts) - n
+        if drop > 0:
+            for col in self._columns():
+                del col[:drop]
+            self.first_index += drop
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.ts) * self.ROW_BYTES
+
+    def sums(self) -> Dict[str, float]:
+        """Column totals except ts; floats summed exactly and rounded like the per-turn values."""
+        return {"tokens_input": sum(self.tokens_input), "tokens_total": sum(self.tokens_total),
+                **{k: round(math.fsum(getattr(self, k)), 6) for k in ("kwh", "co2_kg", "water_l")}}
+
+    def rows(self):
+        """Tuples in TURN_FIELDS order; nothing is materialized up front."""
+        return zip(range(self.first_index, self.first_index + len(self.ts)),
+                   self.ts, self.tokens_input, self.tokens_total, self.kwh, self.co2_kg, self.water_l)
+
+    def dicts(self) -> List[Dict[str, Any]]:
+        return [dict(zip(TURN_FIELDS, row)) for row in self.rows()]
+
+    def batch(self, start: int, stop: int) -> Dict[str, np.ndarray]:
+        """Rows [start, stop) as NumPy columns keyed by TURN_FIELDS (copies, safe to hold across awaits)."""
+        out = {"turn_index": np.arange(self.first_index + start, self.first_index + min(stop, len(self.ts)),
+                                       dtype=np.int64)}
+        for name, col in zip(TURN_FIELDS[1:], self._columns()):
+            out[name] = np.array(col[start:stop], dtype=np.int64 if col.typecode == "q" else np.float64)
+        return out
+
+    def select(self, positions: np.ndarray) -> Dict[str, np.ndarray]:
+        """Rows at the given positions as NumPy columns; turn_index is explicit since rows may be sparse."""
+        out = {"turn_index": positions.astype(np.int64) + self.first_index}
+        for name, col in zip(TURN_FIELDS[1:], self._columns()):
+            # fancy indexing copies, so the buffer view is released before the caller yields
+            out[name] = np.frombuffer(col, dtype=np.int64 if col.typecode == "q" else np.float64)[positions]
+        return out
+
+def _rows_to_batch(fields: List[str], rows: List[tuple]) -> Dict[str, np.ndarray]:
+    cols = list(zip(*rows)) if rows else [()] * len(fields)
+    return {f: np.array(c, dtype=EXPORT_DTYPES[f]) for f, c in zip(fields, cols)}
+
+# dtype per exported column; session_id only appears in multi-session exports
+EXPORT_DTYPES = {"session_id": object, "turn_index": np.int64, "ts": np.int64, "tokens_input": np.int64,
+                 "tokens_total": np.int64, "kwh": np.float64, "co2_kg": np.float64, "water_l": np.float64}
+
+def _is_expired(updated_at: int, now: int, ttl_seconds: int) -> bool:
+    return now - updated_at > ttl_seconds
+
+def _empty_totals() -> Dict[str, float]:
+    return {"tokens_input": 0, "tokens_total": 0, "kwh": 0.0, "co2_kg": 0.0, "water_l": 0.0}
+
+class MemorySessionStore:
+    """Sessions in the SESSIONS dict of this process; lost on restart, not shared across workers."""
+
+    name = "memory"
+
+    def __init__(self, sessions: Dict[str, Dict[str, Any]], ttl_seconds: int, max_turns: int):
+        self.sessions = sessions
+        self.ttl_seconds = ttl_seconds
+        self.max_turns = max_turns
+        # min-heap of (updated_at, sid); entries go stale when a session is touched again
+        self._expiry: List[tuple] = []
+        # kept up to date on every change so stats() never walks the dict (it is read from other threads)
+        self.turns = sum(len(r["cols"]) for r in sessions.values())
+
+    def _drop(self, sid: str):
+        rec = self.sessions.pop(sid, None)
+        if rec is not None:
+            self.turns -= len(rec["cols"])
+
+    def _live(self, sid: str) -> Optional[Dict[str, Any]]:
+        # the sweeper may not have run yet; never serve an expired session
+        rec = self.sessions.get(sid)
+        if rec is not None and _is_expired(rec["updated_at"], _now(), self.ttl_seconds):
+            self._drop(sid)
+            return None
+        return rec
+
+    def _touch(self, sid: str, updated_at: int):
+        heapq.heappush(self._expiry, (updated_at, sid))
+        if len(self._expiry) > 2 * len(self.sessions) + 1024:
+            # drop stale entries so the heap stays proportional to live sessions
+            self._expiry = [(r["updated_at"], k) for k, r in self.sessions.items()]
+            heapq.heapify(self._expiry)
+
+    async def ingest_many(self, sid: str, cols: TurnColumns, keys: List[Optional[str]]) -> Dict[str, Any]:
+        """Append turns (already in apply order); turns whose idempotency key was seen are skipped."""
+        rec = self._live(sid)
+        seen = rec["keys"] if rec else {}
+        batch_seen: Dict[str, None] = {}  # ordered, so the trim below drops the oldest keys
+        keep = []
+        for i, k in enumerate(keys):
+            if k is None or (k not in seen and k not in batch_seen):
+                keep.append(i)
+                if k is not None:
+                    batch_seen[k] = None
+        duplicates = len(keys) - len(keep)
+        if len(keep) < len(keys):
+            cols = cols.take(keep)
+        if not len(cols):
+            return {"rec": rec, "applied": 0, "duplicates": duplicates, "turns": cols}
+
+        if not rec:
+            rec = {
+                "started_at": cols.ts[0],
+                "updated_at": cols.ts[0],
+                "totals": _empty_totals(),
+                "turn_count": 0,
+                "cols": TurnColumns(),
+                "keys": {},  # recent idempotency keys, insertion ordered
+            }
+            self.sessions[sid] = rec
+
+        held = len(rec["cols"])
+        rec["turn_count"] += len(cols)
+        rec["cols"].extend(cols)
+        rec["cols"].keep_last(self.max_turns)
+        self.turns += len(rec["cols"]) - held
+        for k in batch_seen:
+            rec["keys"][k] = None
+        while len(rec["keys"]) > self.max_turns:
+            del rec["keys"][next(iter(rec["keys"]))]
+
+        totals = rec["totals"]
+        totals["tokens_input"] += sum(cols.tokens_input)
+        totals["tokens_total"] += sum(cols.tokens_total)
+        totals["kwh"] += sum(cols.kwh)
+        totals["co2_kg"] += sum(cols.co2_kg)
+        totals["water_l"] += sum(cols.water_l)
+        rec["updated_at"] = cols.ts[-1]
+        self._touch(sid, rec["updated_at"])
+        return {"rec": rec, "applied": len(cols), "duplicates": duplicates, "turns": cols}
+
+    async def get(self, sid: str) -> Optional[Dict[str, Any]]:
+        return self._live(sid)
+
+    async def summary(self, sid: str) -> Optional[Dict[str, Any]]:
+        return self._live(sid)
+
+    async def reset(self, sid: str):
+        self._drop(sid)
+
+    async def evict_expired(self) -> int:
+        # pops only expired heap entries: O(k log n) for k evictions, not a scan of all sessions
+        now, evicted = _now(), 0
+        heap = self._expiry
+        while heap and _is_expired(heap[0][0], now, self.ttl_seconds):
+            updated_at, sid = heapq.heappop(heap)
+            rec = self.sessions.get(sid)
+            if rec is not None and rec["updated_at"] == updated_at:
+                self._drop(sid)
+                evicted += 1
+        return evicted
+
+    async def iter_turns(self, sid: str, chunk_rows: int):
+        """Yield the session's turns as NumPy column batches, as of the call; later ingests are not included."""
+        rec = self._live(sid)
+        if rec is None:
+            return
+        cols = rec["cols"]
+        last = cols.first_index + len(cols) - 1
+        nxt = cols.first_index
+        while nxt <= last:
+            # keep_last() may trim the head between chunks; resume from the oldest turn still held
+            start = max(nxt - cols.first_index, 0)
+            stop = min(start + chunk_rows, last - cols.first_index + 1)
+            if start >= stop:
+                return
+            nxt = cols.first_index + stop
+            yield cols.batch(start, stop)
+
+    async def iter_range(self, start_ts: int, end_ts: int, chunk_rows: int):
+        """Yield (session_id, batch) for turns with start_ts <= ts <= end_ts, sessions in id order."""
+        for sid in sorted(self.sessions):
+            rec = self._live(sid)
+            if rec is None:
+                continue
+            cols = rec["cols"]
+            if not len(cols):
+                continue
+            ts = np.frombuffer(cols.ts, dtype=np.int64)
+            wanted = np.flatnonzero((ts >= start_ts) & (ts <= end_ts)) + cols.first_index
+            del ts
+            for i in range(0, len(wanted), chunk_rows):
+                positions = wanted[i:i + chunk_rows] - cols.first_index
+                positions = positions[positions >= 0]
+                if len(positions):
+                    yield sid, cols.select(positions)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "sessions": len(self.sessions),
+            "turns": self.turns,
+            "turn_bytes": self.turns * TurnColumns.ROW_BYTES,
+        }
+
+class SQLiteSessionStore:
+    """Sessions in an embedded SQLite (WAL) file, shared by every worker on the host.
+
+    Writes are group-committed: ops queued within SESSION_FLUSH_MS go out in one
+    transaction on a worker thread, and each caller gets its own post-write totals.
+    With `change_feed`, each ingest and reset also appends a row to session_changes in
+    the same transaction, so the feed is in commit order across every process writing.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str, ttl_seconds: int, max_turns: int, flush_ms: float,
+                 change_feed: bool = False, change_retain_seconds: float = 300):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_turns = max_turns
+        self.flush_ms = flush_ms
+        self.change_feed = change_feed
+        self.change_retain_seconds = change_retain_seconds
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                started_at INTEGER NOT NULL, updated_at INTEGER NOT NULL, turn_count INTEGER NOT NULL,
+                tokens_input INTEGER NOT NULL, tokens_total INTEGER NOT NULL,
+                kwh REAL NOT NULL, co2_kg REAL NOT NULL, water_l REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions(updated_at);
+            CREATE TABLE IF NOT EXISTS turns (
+                session_id TEXT NOT NULL, turn_index INTEGER NOT NULL, ts INTEGER NOT NULL,
+                tokens_input INTEGER NOT NULL, tokens_total INTEGER NOT NULL,
+                kwh REAL NOT NULL, co2_kg REAL NOT NULL, water_l REAL NOT NULL,
+                PRIMARY KEY (session_id, turn_index)) WITHOUT ROWID;
+            -- seq: turn index the key arrived with; the last max_turns keys are kept, as in memory
+            CREATE TABLE IF NOT EXISTS turn_keys (
+                session_id TEXT NOT NULL, key TEXT NOT NULL, seq INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (session_id, key)) WITHOUT ROWID;
+            -- row counts kept by every write, so stats never scan the tables
+            CREATE TABLE IF NOT EXISTS session_counts (
+                id INTEGER PRIMARY KEY CHECK (id = 0), sessions INTEGER NOT NULL, turns INTEGER NOT NULL);
+            INSERT OR IGNORE INTO session_counts
+                SELECT 0, (SELECT COUNT(*) FROM sessions), (SELECT COUNT(*) FROM turns)
+                WHERE NOT EXISTS (SELECT 1 FROM session_counts);
+            CREATE TABLE IF NOT EXISTS session_changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT, at REAL NOT NULL,
+                session_id TEXT NOT NULL, kind TEXT NOT NULL, payload TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS session_changes_at ON session_changes(at);
+        """)
+        if "seq" not in {c[1] for c in self._db.execute("PRAGMA table_info(turn_keys)")}:
+            # databases from before the key cap: their keys get seq 0 and are trimmed first
+            self._db.execute("ALTER TABLE turn_keys ADD COLUMN seq INTEGER NOT NULL DEFAULT 0")
+        self._db.execute("CREATE INDEX IF NOT EXISTS turn_keys_seq ON turn_keys(session_id, seq)")
+        # stats() reads on the event loop; a second connection never waits on the writer's lock (WAL)
+        self._stats_db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._queue: List[tuple] = []
+        self._flusher: Optional[asyncio.Task] = None
+        self.batches = 0
+
+    # --- write path: group commit ---
+    async def _submit(self, op: tuple):
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.append((op, fut))
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_soon())
+        return await fut
+
+    async def _flush_soon(self):
+        await asyncio.sleep(self.flush_ms / 1000.0)
+        while self._queue:
+            batch, self._queue = self._queue, []
+            try:
+                results = await asyncio.to_thread(self._apply, [op for op, _ in batch])
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            for (_, fut), res in zip(batch, results):
+                if not fut.done():
+                    fut.set_result(res)
+
+    def _apply(self, ops: List[tuple]) -> List[Any]:
+        results = []
+        with self._lock:
+            db = self._db
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                for op in ops:
+                    results.append(getattr(self, "_op_" + op[0])(db, *op[1:]))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        self.batches += 1
+        return results
+
+    def _op_ingest_many(self, db, sid, cols: TurnColumns, keys: List[Optional[str]]):
+        row = db.execute("SELECT updated_at, turn_count FROM sessions WHERE session_id = ?", (sid,)).fetchone()
+        new = row is None
+        if not new and _is_expired(row[0], _now(), self.ttl_seconds):
+            self._op_reset(db, sid)  # not swept yet; start over like a new session
+            new = True
+        held = 0 if new else row[1]
+        keep = []
+        keyed = False
+        for i, k in enumerate(keys):
+            if k is None:
+                keep.append(i)
+            elif db.execute("INSERT OR IGNORE INTO turn_keys VALUES (?, ?, ?)",
+                            (sid, k, held + len(keep) + 1)).rowcount:
+                keep.append(i)
+                keyed = True
+        duplicates = len(keys) - len(keep)
+        if len(keep) < len(keys):
+            cols = cols.take(keep)
+        n = len(cols)
+        if not n:
+            row = db.execute("SELECT * FROM sessions WHERE session_id = ?", (sid,)).fetchone()
+            return {"rec": self._row_to_rec(row) if row else None, "applied": 0, "duplicates": duplicates,
+                    "turns": cols}
+
+        db.execute(
+            "INSERT INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT(session_id) DO UPDATE SET updated_at = excluded.updated_at,"
+            " turn_count = turn_count + excluded.turn_count,"
+            " tokens_input = tokens_input + excluded.tokens_input,"
+            " tokens_total = tokens_total + excluded.tokens_total,"
+            " kwh = kwh + excluded.kwh, co2_kg = co2_kg + excluded.co2_kg, water_l = water_l + excluded.water_l",
+            (sid, cols.ts[0], cols.ts[-1], n, sum(cols.tokens_input), sum(cols.tokens_total),
+             sum(cols.kwh), sum(cols.co2_kg), sum(cols.water_l)),
+        )
+        row = db.execute("SELECT * FROM sessions WHERE session_id = ?", (sid,)).fetchone()
+        turn_count = row[3]
+        cols.first_index = turn_count - n + 1
+        db.executemany("INSERT INTO turns VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       ((sid, *r) for r in cols.rows()))
+        trimmed = 0
+        if turn_count > self.max_turns:
+            trimmed = db.execute("DELETE FROM turns WHERE session_id = ? AND turn_index <= ?",
+                                 (sid, turn_count - self.max_turns)).rowcount
+        if keyed and turn_count > self.max_turns:  # keys <= turns, so only then can there be too many
+            db.execute("DELETE FROM turn_keys WHERE session_id = ? AND seq < (SELECT seq FROM turn_keys"
+                       " WHERE session_id = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                       (sid, sid, self.max_turns - 1))
+        self._count(db, int(new), n - trimmed)
+        rec = self._row_to_rec(row)
+        self._change(db, sid, "delta", {"delta": {"turns": n, **cols.sums()}, "totals": _impact_summary(rec),
+                                        "updated_at": rec["updated_at"]})
+        return {"rec": rec, "applied": n, "duplicates": duplicates, "turns": cols}
+
+    def _op_reset(self, db, sid, announce: bool = False):
+        sessions = db.execute("DELETE FROM sessions WHERE session_id = ?", (sid,)).rowcount
+        turns = db.execute("DELETE FROM turns WHERE session_id = ?", (sid,)).rowcount
+        db.execute("DELETE FROM turn_keys WHERE session_id = ?", (sid,))
+        self._count(db, -sessions, -turns)
+        if announce:  # an explicit reset; expiry and eviction are not pushed
+            self._change(db, sid, "reset", {"totals": None})
+
+    def _change(self, db, sid: str, kind: str, payload: Dict[str, Any]):
+        if self.change_feed:
+            db.execute("INSERT INTO session_changes (at, session_id, kind, payload) VALUES (?, ?, ?, ?)",
+                       (time.time(), sid, kind, json.dumps(payload)))
+
+    @staticmethod
+    def _count(db, sessions: int, turns: int):
+        if sessions or turns:
+            db.execute("UPDATE session_counts SET sessions = sessions + ?, turns = turns + ?", (sessions, turns))
+
+    def _op_evict(self, db, cutoff):
+        stale = [r[0] for r in db.execute("SELECT session_id FROM sessions WHERE updated_at < ?", (cutoff,))]
+        for sid in stale:
+            self._op_reset(db, sid)
+        # the change feed is only for relaying; a reader further behind than this has missed out anyway
+        db.execute("DELETE FROM session_changes WHERE at < ?", (time.time() - self.change_retain_seconds,))
+        return len(stale)
+
+    @staticmethod
+    def _row_to_rec(row) -> Dict[str, Any]:
+        return {
+            "started_at": row[1],
+            "updated_at": row[2],
+            "turn_count": row[3],
+            "totals": {"tokens_input": row[4], "tokens_total": row[5],
+                       "kwh": row[6], "co2_kg": row[7], "water_l": row[8]},
+        }
 
-def _impact_from_tokens(total_tokens: int) -> Dict[str, float]:
-    kwh = (total_tokens * WH_PER_TOKEN) / 1000.0
+    async def ingest_many(self, sid: str, cols: TurnColumns, keys: List[Optional[str]]) -> Dict[str, Any]:
+        return await self._submit(("ingest_many", sid, cols, keys))
+
+    async def reset(self, sid: str):
+        await self._submit(("reset", sid, True))
+
+    async def evict_expired(self) -> int:
+        # uses the updated_at index, so only expired rows are visited
+        return await self._submit(("evict", _now() - self.ttl_seconds))
+
+    # --- read path ---
+    def _get(self, sid: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._db.execute("SELECT * FROM sessions WHERE session_id = ?", (sid,)).fetchone()
+            if row is None or _is_expired(row[2], _now(), self.ttl_seconds):
+                return None
+            rec = self._row_to_rec(row)
+            rec["cols"] = TurnColumns.from_rows(self._db.execute(
+                "SELECT turn_index, ts, tokens_input, tokens_total, kwh, co2_kg, water_l"
+                " FROM turns WHERE session_id = ? ORDER BY turn_index", (sid,)).fetchall())
+        return rec
+
+    async def get(self, sid: str) -> Optional[Dict[str, Any]]:
+        return await asyncio.to_thread(self._get, sid)
+
+    async def summary(self, sid: str) -> Optional[Dict[str, Any]]:
+        """Totals and timestamps only; turns are not loaded."""
+        rows = await asyncio.to_thread(self._read, "SELECT * FROM sessions WHERE session_id = ?", (sid,))
+        if not rows or _is_expired(rows[0][2], _now(), self.ttl_seconds):
+            return None
+        return self._row_to_rec(rows[0])
+
+    def _read(self, sql: str, params: tuple) -> List[tuple]:
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    async def last_change(self) -> int:
+        rows = await asyncio.to_thread(self._read, "SELECT COALESCE(MAX(seq), 0) FROM session_changes", ())
+        return rows[0][0]
+
+    async def changes(self, after: int, limit: int) -> List[tuple]:
+        """(seq, session_id, kind, payload json) of the change feed after `after`, oldest first."""
+        return await asyncio.to_thread(
+            self._read, "SELECT seq, session_id, kind, payload FROM session_changes WHERE seq > ? ORDER BY seq LIMIT ?",
+            (after, limit))
+
+    async def iter_turns(self, sid: str, chunk_rows: int):
+        """Yield the session's turns in pages of chunk_rows (keyset on turn_index), as of the call."""
+        rec = await self.summary(sid)
+        if rec is None:
+            return
+        last, after = rec["turn_count"], 0
+        while after < last:
+            rows = await asyncio.to_thread(
+                self._read,
+                "SELECT turn_index, ts, tokens_input, tokens_total, kwh, co2_kg, water_l FROM turns"
+                " WHERE session_id = ? AND turn_index > ? AND turn_index <= ? ORDER BY turn_index LIMIT ?",
+                (sid, after, last, chunk_rows))
+            if not rows:
+                return
+            after = rows[-1][0]
+            yield _rows_to_batch(TURN_FIELDS, rows)
+
+    async def iter_range(self, start_ts: int, end_ts: int, chunk_rows: int):
+        """Yield (session_id, batch) for turns with start_ts <= ts <= end_ts, sessions in id order."""
+        cutoff = _now() - self.ttl_seconds
+        after = ("", 0)
+        while True:
+            rows = await asyncio.to_thread(
+                self._read,
+                "SELECT t.session_id, t.turn_index, t.ts, t.tokens_input, t.tokens_total, t.kwh, t.co2_kg, t.water_l"
+                " FROM turns t JOIN sessions s ON s.session_id = t.session_id"
+                " WHERE (t.session_id, t.turn_index) > (?, ?) AND t.ts BETWEEN ? AND ? AND s.updated_at >= ?"
+                " ORDER BY t.session_id, t.turn_index LIMIT ?",
+                (*after, start_ts, end_ts, cutoff, chunk_rows))
+            if not rows:
+                return
+            after = rows[-1][:2]
+            # a page can span sessions; split it so each yielded batch belongs to one session
+            i = 0
+            while i < len(rows):
+                j = i
+                while j < len(rows) and rows[j][0] == rows[i][0]:
+                    j += 1
+                yield rows[i][0], _rows_to_batch(TURN_FIELDS, [r[1:] for r in rows[i:j]])
+                i = j
+
+    def stats(self) -> Dict[str, int]:
+        # one-row primary-key read: cheap enough for the event loop, includes other workers' writes
+        n_sessions, n_turns = self._stats_db.execute("SELECT sessions, turns FROM session_counts").fetchone()
+        return {"sessions": n_sessions, "turns": n_turns, "batches": self.batches}
+
+def _make_session_store():
+    if SESSION_STORE_BACKEND == "sqlite":
+        return SQLiteSessionStore(SESSION_DB_PATH, SESSION_TTL_SECONDS, SESSION_MAX_TURNS, SESSION_FLUSH_MS,
+                                  SESSION_CHANGE_FEED, SESSION_CHANGE_RETAIN_SECONDS)
+    if SESSION_CHANGE_FEED:
+        raise RuntimeError("SESSION_CHANGE_FEED needs SESSION_STORE=sqlite")
+    if SESSION_STORE_BACKEND == "memory":
+        return MemorySessionStore(SESSIONS, SESSION_TTL_SECONDS, SESSION_MAX_TURNS)
+    raise RuntimeError(f"Unknown SESSION_STORE: {SESSION_STORE_BACKEND}")
+
+SESSION_STORE = _make_session_store()
+SESSION_SWEEP_STATS = {"sweeps": 0, "evicted": 0, "last_ms": 0.0, "max_ms": 0.0, "errors": 0}
+
+async def _sweep_sessions_once() -> int:
+    t0 = time.perf_counter()
+    evicted = await SESSION_STORE.evict_expired()
+    ms = (time.perf_counter() - t0) * 1000.0
+    SESSION_SWEEP_STATS["sweeps"] += 1
+    SESSION_SWEEP_STATS["evicted"] += evicted
+    SESSION_SWEEP_STATS["last_ms"] = round(ms, 3)
+    SESSION_SWEEP_STATS["max_ms"] = round(max(SESSION_SWEEP_STATS["max_ms"], ms), 3)
+    return evicted
+
+async def _sweep_sessions():
+    # TTL eviction runs here, off the request path; requests only check the session they touch
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_SECONDS)
+        try:
+            await _sweep_sessions_once()
+        except Exception:
+            SESSION_SWEEP_STATS["errors"] += 1
+
+# ------------------------
+# Rollups (time buckets across all sessions)
+# ------------------------
+# resolution -> (bucket seconds, buckets retained); each is a fixed ring, so memory does not grow
+ROLLUP_RESOLUTIONS = {
+    "minute": (60, int(os.getenv("ROLLUP_MINUTES", "2880"))),  # 2 days
+    "hour": (3600, int(os.getenv("ROLLUP_HOURS", "2160"))),    # 90 days
+    "day": (86400, int(os.getenv("ROLLUP_DAYS", "730"))),      # 2 years
+}
+ROLLUP_FIELDS = ["turns", "tokens_input", "tokens_total", "kwh", "co2_kg", "water_l"]
+ROLLUP_SKETCH_ACCURACY = float(os.getenv("ROLLUP_SKETCH_ACCURACY", "0.02"))  # relative error of percentiles
+ROLLUP_SKETCH_MAX_TOKENS = 1 << 22
+# file the rings are mapped from so every worker on the host adds to (and reads) the same buckets;
+# empty keeps them in this process only
+ROLLUP_SHARED_PATH = os.getenv("ROLLUP_SHARED_PATH", "")
+
+class TokenSketch:
+    """Log-bucketed histogram (DDSketch style): any quantile within ROLLUP_SKETCH_ACCURACY relative error.
+
+    Bin 0 holds zeros; bin k+1 holds values in (gamma^(k-1), gamma^k]. Sketches merge by adding counts.
+    """
+
+    def __init__(self, accuracy: float, max_value: int):
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = np.log(self.gamma)
+        self.nbins = int(np.ceil(np.log(max_value) / self._log_gamma)) + 2
+
+    def bins(self, values: np.ndarray) -> np.ndarray:
+        v = np.maximum(np.asarray(values, dtype=np.float64), 1.0)
+        k = np.ceil(np.log(v) / self._log_gamma).astype(np.int64) + 1
+        k[np.asarray(values) <= 0] = 0
+        return np.minimum(k, self.nbins - 1)
+
+    def quantiles(self, counts: np.ndarray, qs: List[float]) -> Dict[str, Optional[float]]:
+        total = int(counts.sum())
+        out: Dict[str, Optional[float]] = {}
+        cum = np.cumsum(counts)
+        for q in qs:
+            if not total:
+                out[f"p{q:g}"] = None
+                continue
+            i = int(np.searchsorted(cum, q / 100.0 * (total - 1), side="right"))
+            out[f"p{q:g}"] = 0.0 if i == 0 else round(2 * self.gamma ** (i - 1) / (self.gamma + 1), 1)
+        return out
+
+class RollupRing:
+    """Fixed ring of time buckets; slot = bucket % capacity, reused once the bucket falls out of retention.
+
+    All state lives in one buffer (a bytearray, or a slice of the shared mmap) laid out as
+    ids | late | sums | sketch.
+    """
+
+    def __init__(self, seconds: int, capacity: int, sketch_bins: int, buf=None, offset: int = 0):
+        self.seconds = seconds
+        self.capacity = capacity
+        if buf is None:
+            buf = bytearray(self.size(capacity, sketch_bins))
+        nf = len(ROLLUP_FIELDS)
+        self.ids = np.ndarray(capacity, np.int64, buf, offset)  # bucket number held by each slot
+        offset += self.ids.nbytes
+        self._late = np.ndarray(1, np.int64, buf, offset)  # turns older than retention when they arrived
+        offset += 8
+        self.sums = np.ndarray((capacity, nf), np.float64, buf, offset)
+        offset += self.sums.nbytes
+        self.sketch = np.ndarray((capacity, sketch_bins), np.uint32, buf, offset)
+        if isinstance(buf, bytearray):
+            self.ids.fill(-1)
+
+    @staticmethod
+    def size(capacity: int, sketch_bins: int) -> int:
+        n = capacity * 8 + 8 + capacity * len(ROLLUP_FIELDS) * 8 + capacity * sketch_bins * 4
+        return -(-n // 8) * 8
+
+    @property
+    def late(self) -> int:
+        return int(self._late[0])
+
+    def add(self, ts: np.ndarray, values: np.ndarray, bins: np.ndarray):
+        buckets = ts // self.seconds
+        uniq = np.unique(buckets)
+        slots = uniq % self.capacity
+        fresh = uniq > self.ids[slots]
+        # uniq is ascending, so if two new buckets share a slot the newest one wins
+        self.sums[slots[fresh]] = 0.0
+        self.sketch[slots[fresh]] = 0
+        self.ids[slots[fresh]] = uniq[fresh]
+        slot = buckets % self.capacity
+        ok = self.ids[slot] == buckets
+        self._late[0] += int(len(ok) - ok.sum())
+        np.add.at(self.sums, slot[ok], values[ok])
+        np.add.at(self.sketch, (slot[ok], bins[ok]), 1)
+
+    def oldest(self, now: int) -> int:
+        """Start of the oldest bucket this ring can still answer for."""
+        return (now // self.seconds - self.capacity + 1) * self.seconds
+
+    def query(self, start: int, end: int):
+        """(bucket numbers, per-bucket sums, merged sketch) for buckets overlapping [start, end].
+
+        At most `capacity` buckets, the newest ones; older buckets are not held anyway.
+        """
+        last = end // self.seconds
+        first = max(start // self.seconds, last - self.capacity + 1) if start <= end else last + 1
+        buckets = np.arange(first, last + 1, dtype=np.int64)
+        slots = buckets % self.capacity
+        ok = self.ids[slots] == buckets
+        sums = np.where(ok[:, None], self.sums[slots], 0.0)
+        return buckets, sums, self.sketch[slots[ok]].sum(axis=0, dtype=np.uint64)
+
+    @property
+    def nbytes(self) -> int:
+        return self.ids.nbytes + self.sums.nbytes + self.sketch.nbytes
+
+class Rollups:
+    """Minute/hour/day totals of applied turns, updated on ingest.
+
+    They record usage as it happened: resetting or evicting a session does not subtract from them.
+    With a `path` the rings are mapped from that file and guarded by flock, so every worker
+    process on the host shares one set of totals; otherwise they are private to this process.
+    """
+
+    MAGIC = b"EDENRLP1"
+
+    def __init__(self, resolutions: Dict[str, tuple], accuracy: float, path: str = ""):
+        self.sketch = TokenSketch(accuracy, ROLLUP_SKETCH_MAX_TOKENS)
+        self.path = path
+        self._lock = threading.Lock()  # /aggregate reads from the threadpool while ingest adds on the loop
+        self._fd = None
+        if not path:
+            self.rings = {name: RollupRing(sec, cap, self.sketch.nbins) for name, (sec, cap) in resolutions.items()}
+            return
+
+        import fcntl  # POSIX only, like the multi-worker deployment that needs it
+        self._fcntl = fcntl
+        layout = json.dumps([ROLLUP_FIELDS, self.sketch.nbins, sorted(resolutions.items())]).encode()
+        header = self.MAGIC + hashlib.blake2b(layout, digest_size=8).digest()
+        size = len(header) + sum(RollupRing.size(cap, self.sketch.nbins) for _, cap in resolutions.values())
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            # first worker in (or a changed layout) starts the file over; the rest map it as is
+            fresh = os.pread(self._fd, len(header), 0) != header or os.fstat(self._fd).st_size != size
+            if fresh:
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+            self._map = mmap.mmap(self._fd, size)
+            self.rings, offset = {}, len(header)
+            for name, (sec, cap) in resolutions.items():
+                self.rings[name] = RollupRing(sec, cap, self.sketch.nbins, self._map, offset)
+                offset += RollupRing.size(cap, self.sketch.nbins)
+                if fresh:
+                    self.rings[name].ids.fill(-1)
+            if fresh:
+                self._map[:len(header)] = header
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    @contextmanager
+    def locked(self, exclusive: bool = True):
+        with self._lock:
+            if self._fd is None:
+                yield
+                return
+            fcntl = self._fcntl
+            fcntl.flock(self._fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def add(self, cols: TurnColumns):
+        if not len(cols):
+            return
+        ts = np.frombuffer(cols.ts, dtype=np.int64).copy()
+        tokens_total = np.frombuffer(cols.tokens_total, dtype=np.int64)
+        values = np.column_stack([np.ones(len(ts)), cols.tokens_input, tokens_total,
+                                  cols.kwh, cols.co2_kg, cols.water_l])
+        bins = self.sketch.bins(tokens_total)
+        del tokens_total
+        with self.locked():
+            for ring in self.rings.values():
+                ring.add(ts, values, bins)
+
+    def pick(self, start: int, now: int) -> str:
+        # finest resolution whose retention still reaches back to start
+        for name, ring in self.rings.items():
+            if ring.oldest(now) <= start:
+                return name
+        return list(self.rings)[-1]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "bytes": sum(r.nbytes for r in self.rings.values()),
+            "late": {name: r.late for name, r in self.rings.items()},
+            "shared_path": self.path or None,
+        }
+
+ROLLUPS = Rollups(ROLLUP_RESOLUTIONS, ROLLUP_SKETCH_ACCURACY, ROLLUP_SHARED_PATH)
+
+def _impact_from_tokens(total_tokens: int, tokens_input: Optional[float] = None,
+                        factors: Optional[FactorSet] = None, ts: Optional[int] = None) -> Dict[str, float]:
+    f = factors or FACTORS.default
+    kwh = f.wh(total_tokens, tokens_input) / 1000.0
     return {
         "kwh": round(kwh, 6),
-        "co2_kg": round(kwh * KGCO2_PER_KWH, 6),
-        "water_l": round(kwh * WUE_L_PER_KWH, 6),
+        "co2_kg": round(kwh * f.kgco2_at(ts), 6),
+        "water_l": round(kwh * f.wue, 6),
     }
 
+def _impact_columns(tokens_total: np.ndarray, tokens_input: Optional[np.ndarray] = None,
+                    factors: Optional[FactorSet] = None, ts: Optional[np.ndarray] = None) -> tuple:
+    """_impact_from_tokens over a whole column at once; same operations, same rounded values."""
+    f = factors or FACTORS.default
+    tt = np.asarray(tokens_total, dtype=np.float64)
+    ti = None if tokens_input is None else np.asarray(tokens_input, dtype=np.float64)
+    kwh = f.wh(tt, ti) / 1000.0
+    return np.round(kwh, 6), np.round(kwh * f.kgco2_column(ts), 6), np.round(kwh * f.wue, 6)
+
 def _impact_summary(rec: Dict[str, Any]) -> Dict[str, float]:
     return {
         "tokens_input": rec["totals"]["tokens_input"],
@@ -91,45 +1905,114 @@ def _impact_summary(rec: Dict[str, Any]) -> Dict[str, float]:
     }
 
 
+def _count_response(req: CountReq, tokens_input: int, **extra) -> CountRes:
+    out_est = req.expected_output_tokens or 200
+    total_est = tokens_input + out_est
+
+    f = _factors(req.model, req.region)
+    now = _now()
+    wh = f.wh(total_est, tokens_input)
+    kwh = wh / 1000.0
+    co2 = kwh * f.kgco2_at(now)
+    water = kwh * f.wue
+
+    return CountRes(
+        tokens_input=tokens_input,
+        tokens_output_estimate=out_est,
+        tokens_total_estimate=total_est,
+        wh_per_token=f.wh_out if f.wh_in == f.wh_out else round(wh / max(total_est, 1), 6),
+        factors=f.info(now),
+        kwh=round(kwh, 6),
+        co2_kg=round(co2, 6),
+        water_l=round(water, 6),
+        **extra,
+    )
+
 @app.post("/count", response_model=CountRes)
 async def count_tokens(req: CountReq):
+    return await _count(req)
+
+async def _count(req: CountReq) -> CountRes:
+    if req.mode not in COUNT_MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of {', '.join(COUNT_MODES)}")
+    _factors(req.model, req.region)  # reject an unknown region before any upstream call
     try:
-        payload = {
-            "model": req.model,
-            "messages": [{"role": "user", "content": req.text}],
-        }
-        headers = {
-            "x-api-key": ANTHROPIC_API_KEY,
-            "anthropic-version": "2023-06-01",
-            "content-type": "application/json",
-        }
-        async with httpx.AsyncClient(timeout=15.0) as client:
-            r = await client.post(ANTHROPIC_BASE_COUNT, json=payload, headers=headers)
-            r.raise_for_status()
-            data = r.json()
-            tokens_input = data.get("input_tokens", 0)
-
-        out_est = req.expected_output_tokens or 200
-        total_est = tokens_input + out_est
-
-        kwh = (total_est * WH_PER_TOKEN) / 1000.0
-        co2 = kwh * KGCO2_PER_KWH
-        water = kwh * WUE_L_PER_KWH
-
-        return CountRes(
-            tokens_input=tokens_input,
-            tokens_output_estimate=out_est,
-            tokens_total_estimate=total_est,
-            wh_per_token=WH_PER_TOKEN,
-            kwh=round(kwh, 6),
-            co2_kg=round(co2, 6),
-            water_l=round(water, 6),
-        )
+        if req.mode == "local":
+            return _count_response(req, _estimate_tokens_local(req.model, req.text), exact=False)
+
+        if req.base_revision:
+            base = _get_revision(req.base_revision, req.model)
+            if base is None:
+                INCREMENTAL_STATS["unknown_base"] += 1
+                if not req.text:
+                    raise HTTPException(status_code=409, detail="Unknown base_revision; resend full text")
+            elif _reconcile_due(base, req.final) and req.text:
+                INCREMENTAL_STATS["reconciled"] += 1
+            else:
+                tokens, chars = _estimate_from_base(base, req.delta, req.removed_chars)
+                rev = _put_revision(req.model, tokens, chars, base["exact_tokens"], base["exact_chars"],
+                                    base["exact_at"], base["edits"] + 1)
+                INCREMENTAL_STATS["estimated"] += 1
+                return _count_response(req, int(round(tokens)), exact=False, revision=rev,
+                                       reconcile_needed=_reconcile_due(base, req.final))
+
+        if req.mode == "auto":
+            tokens_input, exact = await _count_input_tokens_auto(req.model, req.text)
+            if not exact:
+                return _count_response(req, tokens_input, exact=False)
+        else:
+            tokens_input = await _count_input_tokens(req.model, req.text)
+        return _count_response(req, tokens_input, exact=True,
+                               revision=_exact_revision(req.model, req.text, tokens_input))
+    except HTTPException:
+        raise
+    except UpstreamUnavailable as e:
+        if not COUNT_DEGRADE_LOCAL:
+            raise _unavailable_http(e)
+        UPSTREAM_LIMITERS["count"].stats["degraded"] += 1
+        return _count_response(req, _estimate_tokens_local(req.model, req.text), exact=False, degraded=True)
     except httpx.HTTPStatusError as e:
         raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# ------------------------
+# Batch Count
+# ------------------------
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
+COUNT_BATCH_CONCURRENCY = int(os.getenv("COUNT_BATCH_CONCURRENCY", "8"))
+
+class CountBatchReq(BaseModel):
+    items: List[CountReq]
+
+class CountBatchItem(BaseModel):
+    ok: bool
+    result: Optional[CountRes] = None
+    status_code: Optional[int] = None
+    error: Optional[str] = None
+
+class CountBatchRes(BaseModel):
+    results: List[CountBatchItem]  # same order as items
+
+def _check_batch_size(n: int):
+    if n > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_ITEMS} items per batch")
+
+@app.post("/count/batch", response_model=CountBatchRes)
+async def count_batch(req: CountBatchReq):
+    _check_batch_size(len(req.items))
+    sem = asyncio.Semaphore(COUNT_BATCH_CONCURRENCY)
+
+    async def one(item: CountReq) -> CountBatchItem:
+        async with sem:
+            try:
+                return CountBatchItem(ok=True, result=await _count(item))
+            except HTTPException as e:
+                return CountBatchItem(ok=False, status_code=e.status_code, error=str(e.detail))
+
+    # duplicates inside the batch collapse in the count cache / in-flight map
+    return CountBatchRes(results=await asyncio.gather(*(one(item) for item in req.items)))
+
 # ------------------------
 # Rewrite Endpoint
 # ------------------------
@@ -141,59 +2024,359 @@ class RewriteReq(BaseModel):
 class RewriteRes(BaseModel):
     issues: list[str]
     revised_prompt: str
+    cached: bool = False  # served from the rewrite cache, no upstream call
 
-ANTHROPIC_BASE_MESSAGES = "https://api.anthropic.com/v1/messages"
+ANTHROPIC_BASE_MESSAGES = f"{ANTHROPIC_BASE_URL}/v1/messages"
 
-@app.post("/rewrite", response_model=RewriteRes)
-async def rewrite_prompt(req: RewriteReq):
-    system = (
-        "You are a prompt editor focused on clarity, brevity, and sustainability.\n"
-        "Return EXACTLY TWO SECTIONS:\n"
-        "Issues:\n"
-        "- 2 to 4 short bullets about problems (verbosity, ambiguity, missing constraints).\n"
-        "Revised:\n"
-        "- A single concise prompt (≤ 150 tokens)."
+# ------------------------
+# Rewrite cache (normalized prompt digest -> rewrite result)
+# ------------------------
+REWRITE_CACHE_BACKEND = os.getenv("REWRITE_CACHE_BACKEND", "memory")  # memory | sqlite | off
+REWRITE_CACHE_PATH = os.getenv("REWRITE_CACHE_PATH", "rewrite_cache.sqlite3")
+REWRITE_CACHE_MAX_ENTRIES = int(os.getenv("REWRITE_CACHE_MAX_ENTRIES", "5000"))
+REWRITE_CACHE_MAX_BYTES = int(os.getenv("REWRITE_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+REWRITE_CACHE_TTL_SECONDS = int(os.getenv("REWRITE_CACHE_TTL_SECONDS", str(7 * 24 * 60 * 60)))
+
+_PUNCT_RUN_RE = re.compile(r"([^\w\s])\1+")           # "!!!" -> "!"
+_PUNCT_SPACE_RE = re.compile(r"\s*([^\w\s])\s*")     # "a , b" -> "a,b"
+_EDGE_PUNCT = " .,;:!?-–—•*~`'\"()[]{}<>"
+
+def _normalize_prompt(text: str) -> str:
+    # near-identical boilerplate (case, spacing, punctuation noise) maps to one key
+    t = " ".join(text.lower().split())
+    t = _PUNCT_RUN_RE.sub(r"\1", t)
+    t = _PUNCT_SPACE_RE.sub(r"\1", t)
+    return t.strip(_EDGE_PUNCT)
+
+def _rewrite_cache_key(model: str, max_tokens: int, text: str) -> bytes:
+    raw = f"{model}\x00{max_tokens}\x00{_normalize_prompt(text)}"
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).digest()
+
+class MemoryRewriteCache:
+    """In-process LRU+TTL backend; lost on restart."""
+
+    name = "memory"
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl_seconds: int):
+        self._lru = LRUTTLCache(max_entries, max_bytes, ttl_seconds,
+                                sizeof=lambda key, value: len(key) + len(json.dumps(value)))
+
+    async def get(self, key: bytes) -> Optional[Dict[str, Any]]:
+        return self._lru.get(key)
+
+    async def put(self, key: bytes, value: Dict[str, Any]):
+        self._lru.put(key, value)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return self._lru.stats
+
+    def snapshot(self) -> Dict[str, Any]:
+        return self._lru.snapshot()
+
+class SQLiteRewriteCache:
+    """On-disk LRU+TTL backend that survives restarts; queries run in a worker thread."""
+
+    name = "sqlite"
+    TRIM_EVERY = 64  # puts between size checks
+
+    def __init__(self, path: str, max_entries: int, ttl_seconds: int):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS rewrite_cache ("
+            " key BLOB PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS rewrite_cache_last_used ON rewrite_cache(last_used)")
+        self._db.commit()
+        self._puts = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    def _get(self, key: bytes) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT value, expires_at FROM rewrite_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            if row[1] <= now:
+                self._db.execute("DELETE FROM rewrite_cache WHERE key = ?", (key,))
+                self._db.commit()
+                self.stats["expirations"] += 1
+                self.stats["misses"] += 1
+                return None
+            self._db.execute("UPDATE rewrite_cache SET last_used = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self.stats["hits"] += 1
+            return json.loads(row[0])
+
+    def _put(self, key: bytes, value: Dict[str, Any]):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO rewrite_cache (key, value, expires_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now + self.ttl_seconds, now),
+            )
+            self._puts += 1
+            if self._puts % self.TRIM_EVERY == 0:
+                self._trim(now)
+            self._db.commit()
+
+    def _trim(self, now: float):
+        cur = self._db.execute("DELETE FROM rewrite_cache WHERE expires_at <= ?", (now,))
+        self.stats["expirations"] += cur.rowcount
+        (n,) = self._db.execute("SELECT COUNT(*) FROM rewrite_cache").fetchone()
+        if n > self.max_entries:
+            cur = self._db.execute(
+                "DELETE FROM rewrite_cache WHERE key IN"
+                " (SELECT key FROM rewrite_cache ORDER BY last_used LIMIT ?)",
+                (n - self.max_entries,),
+            )
+            self.stats["evictions"] += cur.rowcount
+
+    async def get(self, key: bytes) -> Optional[Dict[str, Any]]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def put(self, key: bytes, value: Dict[str, Any]):
+        await asyncio.to_thread(self._put, key, value)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            (n,) = self._db.execute("SELECT COUNT(*) FROM rewrite_cache").fetchone()
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "entries": n,
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0,
+        }
+
+def _make_rewrite_cache():
+    if REWRITE_CACHE_BACKEND == "off":
+        return None
+    if REWRITE_CACHE_BACKEND == "sqlite":
+        return SQLiteRewriteCache(REWRITE_CACHE_PATH, REWRITE_CACHE_MAX_ENTRIES, REWRITE_CACHE_TTL_SECONDS)
+    if REWRITE_CACHE_BACKEND == "memory":
+        return MemoryRewriteCache(REWRITE_CACHE_MAX_ENTRIES, REWRITE_CACHE_MAX_BYTES, REWRITE_CACHE_TTL_SECONDS)
+    raise RuntimeError(f"Unknown REWRITE_CACHE_BACKEND: {REWRITE_CACHE_BACKEND}")
+
+REWRITE_CACHE = _make_rewrite_cache()
+
+async def _rewrite_cache_get(req: "RewriteReq") -> Optional[RewriteRes]:
+    if REWRITE_CACHE is None:
+        return None
+    hit = await REWRITE_CACHE.get(_rewrite_cache_key(req.model, _rewrite_max_tokens(req), req.text))
+    return RewriteRes(**hit, cached=True) if hit else None
+
+async def _rewrite_cache_put(req: "RewriteReq", res: RewriteRes, full_text: str):
+    # an empty completion falls back to the caller's own text; never share that
+    if REWRITE_CACHE is None or not full_text.strip():
+        return
+    await REWRITE_CACHE.put(
+        _rewrite_cache_key(req.model, _rewrite_max_tokens(req), req.text),
+        {"issues": res.issues, "revised_prompt": res.revised_prompt},
     )
 
-    payload = {
+@register_metric_collector
+def _rewrite_cache_metrics():
+    if REWRITE_CACHE is None:
+        return []
+    # the counters only: snapshot() counts SQLite rows, which is not for the event loop
+    st = REWRITE_CACHE.stats
+    return [("rewrite_cache_requests_total", "counter", "Rewrite cache lookups.",
+             [({"result": "hit"}, st["hits"]), ({"result": "miss"}, st["misses"])])]
+
+@app.get("/rewrite/cache/stats")
+def rewrite_cache_stats():
+    if REWRITE_CACHE is None:
+        return {"backend": "off"}
+    snap = REWRITE_CACHE.snapshot()
+    return {"backend": REWRITE_CACHE.name, **snap, "upstream_calls_saved": snap["hits"]}
+
+REWRITE_SYSTEM = (
+    "You are a prompt editor focused on clarity, brevity, and sustainability.\n"
+    "Return EXACTLY TWO SECTIONS:\n"
+    "Issues:\n"
+    "- 2 to 4 short bullets about problems (verbosity, ambiguity, missing constraints).\n"
+    "Revised:\n"
+    "- A single concise prompt (≤ 150 tokens)."
+)
+
+def _rewrite_max_tokens(req: RewriteReq) -> int:
+    return min(max(req.max_tokens, 100), 250)
+
+def _rewrite_payload(req: RewriteReq) -> Dict[str, Any]:
+    return {
         "model": req.model,
-        "max_tokens": min(max(req.max_tokens, 100), 250),
-        "system": system,
+        "max_tokens": _rewrite_max_tokens(req),
+        "system": REWRITE_SYSTEM,
         "messages": [{"role": "user", "content": req.text}],
     }
 
-    headers = {
-        "x-api-key": ANTHROPIC_API_KEY,
-        "anthropic-version": "2023-06-01",
-        "content-type": "application/json",
-    }
+def _parse_rewrite(full_text: str, original: str) -> RewriteRes:
+    issues, revised = [], ""
+    if "Issues:" in full_text and "Revised:" in full_text:
+        parts = full_text.split("Revised:")
+        issues_text = parts[0].split("Issues:", 1)[1].strip()
+        revised = parts[1].strip()
+        issues = [line.strip(" -•\t") for line in issues_text.splitlines() if line.strip()]
+    else:
+        revised = full_text.strip() or original
+
+    return RewriteRes(issues=issues[:4], revised_prompt=revised)
 
+@app.post("/rewrite", response_model=RewriteRes)
+async def rewrite_prompt(req: RewriteReq):
     try:
-        async with httpx.AsyncClient(timeout=20.0) as client:
-            r = await client.post(ANTHROPIC_BASE_MESSAGES, json=payload, headers=headers)
-            r.raise_for_status()
-            data = r.json()
+        cached = await _rewrite_cache_get(req)
+        if cached is not None:
+            return cached
+
+        r = await _upstream_post(ANTHROPIC_BASE_MESSAGES, _rewrite_payload(req), REWRITE_TIMEOUT, "messages")
+        data = r.json()
 
         full_text = "".join(
             c.get("text", "") for c in data.get("content", []) if c.get("type") == "text"
         )
+        res = _parse_rewrite(full_text, req.text)
+        await _rewrite_cache_put(req, res, full_text)
+        return res
 
-        issues, revised = [], ""
-        if "Issues:" in full_text and "Revised:" in full_text:
-            parts = full_text.split("Revised:")
-            issues_text = parts[0].split("Issues:", 1)[1].strip()
-            revised = parts[1].strip()
-            issues = [line.strip(" -•\t") for line in issues_text.splitlines() if line.strip()]
-        else:
-            revised = full_text.strip() or req.text
-
-        return RewriteRes(issues=issues[:4], revised_prompt=revised)
+    except UpstreamUnavailable as e:
+        raise _unavailable_http(e)
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
+# ------------------------
+# Streaming Rewrite (SSE)
+# ------------------------
+class RewriteStreamParser:
+    """Splits the "Issues:/Revised:" completion into events while text is still arriving.
+
+    feed() returns ("issue", text) for each finished bullet and ("revised", chunk) for
+    revised-prompt text; the authoritative result is still _parse_rewrite on the full text.
+    """
+
+    def __init__(self):
+        self.buf = ""
+        self.state = "pre"        # pre -> issues -> revised
+        self.issues_pos = 0       # start of the next unemitted issues line
+        self.revised_pos = 0      # start of revised text not yet streamed
+        self.revised_started = False
+        self.issues_sent = 0
+
+    def _issue_events(self, chunk: str) -> List[tuple]:
+        events = []
+        for line in chunk.splitlines():
+            if line.strip() and self.issues_sent < 4:
+                self.issues_sent += 1
+                events.append(("issue", line.strip(" -•\t")))
+        return events
+
+    def feed(self, text: str) -> List[tuple]:
+        self.buf += text
+        events: List[tuple] = []
+        if self.state == "pre":
+            i = self.buf.find("Issues:")
+            if i == -1:
+                return events
+            self.state, self.issues_pos = "issues", i + len("Issues:")
+        if self.state == "issues":
+            r = self.buf.find("Revised:", self.issues_pos)
+            if r == -1:
+                nl = self.buf.rfind("\n", self.issues_pos)
+                if nl != -1:  # only whole lines are final
+                    events += self._issue_events(self.buf[self.issues_pos:nl])
+                    self.issues_pos = nl + 1
+                return events
+            events += self._issue_events(self.buf[self.issues_pos:r])
+            self.state, self.revised_pos = "revised", r + len("Revised:")
+        if self.state == "revised":
+            pending = self.buf[self.revised_pos:]
+            if not self.revised_started:
+                stripped = pending.lstrip()
+                self.revised_pos += len(pending) - len(stripped)
+                pending = stripped
+            # a second "Revised:" ends the section, like split() in _parse_rewrite
+            cut = pending.find("Revised:")
+            if cut != -1:
+                pending = pending[:cut]
+                self.state = "done"
+            # hold back trailing whitespace; the final result is stripped
+            out = pending.rstrip()
+            if out:
+                self.revised_started = True
+                self.revised_pos += len(out)
+                events.append(("revised", out))
+        return events
+
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def _anthropic_text_deltas(r: "httpx.Response"):
+    async for line in r.aiter_lines():
+        if not line.startswith("data:"):
+            continue
+        evt = json.loads(line[5:].strip() or "{}")
+        kind = evt.get("type")
+        if kind == "content_block_delta" and evt.get("delta", {}).get("type") == "text_delta":
+            yield evt["delta"].get("text", "")
+        elif kind == "error":
+            raise RuntimeError(evt.get("error", {}).get("message", "upstream stream error"))
+        elif kind == "message_stop":
+            return
+
+@app.post("/rewrite/stream")
+async def rewrite_stream(req: RewriteReq):
+    cached = await _rewrite_cache_get(req)
+    if cached is not None:
+        async def replay():
+            for issue in cached.issues:
+                yield _sse("issue", {"text": issue})
+            yield _sse("revised", {"text": cached.revised_prompt})
+            yield _sse("done", cached.model_dump())
+
+        return StreamingResponse(replay(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    payload = {**_rewrite_payload(req), "stream": True}
+    try:
+        r, release = await _upstream_open_stream(ANTHROPIC_BASE_MESSAGES, payload, REWRITE_TIMEOUT, "messages")
+    except UpstreamUnavailable as e:
+        raise _unavailable_http(e)
     except httpx.HTTPStatusError as e:
         raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+    async def events():
+        parser = RewriteStreamParser()
+        yield ": stream open\n\n"  # flush headers right away
+        try:
+            async for delta in _anthropic_text_deltas(r):
+                for kind, text in parser.feed(delta):
+                    yield _sse(kind, {"text": text})
+            res = _parse_rewrite(parser.buf, req.text)
+            await _rewrite_cache_put(req, res, parser.buf)
+            yield _sse("done", res.model_dump())
+        except Exception as e:
+            yield _sse("error", {"detail": str(e)})
+        finally:
+            await release()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 class ScoreReq(BaseModel):
     # Accept either raw text or a messages[] array (last user turn is scored)
     text: Optional[str] = None
@@ -243,46 +2426,210 @@ def _choose_text(req: ScoreReq) -> str:
         return "\n".join(parts)
     return ""
 
-def _has_action_verb(s: str) -> bool:
-    head = s.strip().lower()
+LENGTH_HINTS = ["no more than","at most","limit to","maximum","max "]
+
+# weights used by _score/_build_suggestions; a rules file may override any of them
+SCORE_WEIGHTS = {
+    "base": 1,
+    "has_task": 1,
+    "has_format": 1,
+    "limit_or_constraints": 1,
+    "has_context": 1,
+    "too_long": -1,
+    "fluff": -1,
+    "fluff_penalty_min": 3,    # fluff count that triggers the penalty
+    "fluff_tip_min": 2,        # fluff count that triggers the suggestion
+    "long_chars": 1200,        # rough: > 1200 chars (~300 tokens) counts as long
+    "min_score": 1,
+    "max_score": 5,
+}
+
+_FENCE_RE = re.compile(r"```(json|csv|yaml|markdown)?")
+_JSON_SKELETON_RE = re.compile(r"\{[^}]{3,}\}")
+_RETURN_ONLY_RE = re.compile(r"\b(return|output)\s+only\b")
+_LENGTH_UNIT_RE = re.compile(r"\b\d+\s*(words?|tokens?|characters?|chars?|sentences?|bullets?)\b")
+_NUMBER_RE = re.compile(r"\b\d{2,}\b")  # also covers years (19xx/20xx)
+
+class LexiconMatcher:
+    """Lexicons compiled once: each distinct term is searched once per prompt and shared."""
+
+    def __init__(self, lexicons: Dict[str, List[str]], counted: tuple = ()):
+        self.lexicons = {name: list(terms) for name, terms in lexicons.items()}
+        # dedup across lexicons ("csv" is both a format hint and a domain term)
+        self._terms = list(dict.fromkeys(t for ts in lexicons.values() for t in ts))
+        self._owners = {t: tuple(name for name, ts in lexicons.items() if t in ts) for t in self._terms}
+        self._counted = {t for name in counted for t in lexicons[name]}
+
+    def scan(self, low: str) -> Dict[str, Dict[str, int]]:
+        """Return {lexicon: {term: occurrences}} for terms present in `low`.
+
+        Occurrences are only counted (str.count semantics) for `counted` lexicons; others report 1.
+        """
+        found: Dict[str, Dict[str, int]] = {name: {} for name in self.lexicons}
+        for t in self._terms:
+            if t in low:
+                n = low.count(t) if t in self._counted else 1
+                for name in self._owners[t]:
+                    found[name][t] = n
+        return found
+
+# rules-file key -> matcher lexicon name
+RULE_LEXICONS = {
+    "format_hints": "format",
+    "fluff": "fluff",
+    "constraint_lex": "constraint",
+    "domain_hints": "domain",
+    "length_hints": "length",
+}
+
+class RuleSet:
+    """A versioned, fully compiled set of scoring lexicons and weights. Never mutated after build."""
+
+    def __init__(self, version: str, lexicons: Dict[str, List[str]], weights: Optional[Dict[str, Any]] = None):
+        self.version = version
+        self.lexicons = lexicons
+        self.weights = {**SCORE_WEIGHTS, **(weights or {})}
+        verbs = lexicons["action_verbs"]
+        self.action_re = re.compile(r"\b(?:" + "|".join(map(re.escape, verbs)) + r")\b") if verbs else None
+        self.matcher = LexiconMatcher(
+            {name: lexicons[key] for key, name in RULE_LEXICONS.items()}, counted=("fluff",)
+        )
+        self.loaded_at = _now()
+
+BUILTIN_LEXICONS = {
+    "action_verbs": ACTION_VERBS,
+    "format_hints": FORMAT_HINTS,
+    "fluff": FLUFF,
+    "constraint_lex": CONSTRAINT_LEX,
+    "domain_hints": DOMAIN_HINTS,
+    "length_hints": LENGTH_HINTS,
+}
+
+RULES_PATH = os.getenv("RULES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "scoring_rules.json"))
+RULES_POLL_SECONDS = float(os.getenv("RULES_POLL_SECONDS", "10"))  # 0 disables the file watcher
+
+def _load_ruleset(path: str) -> RuleSet:
+    """Parse and compile a rules file; raises ValueError on a malformed file."""
+    with open(path, encoding="utf-8") as f:
+        raw = json.load(f)
+    if not isinstance(raw, dict) or not raw.get("version"):
+        raise ValueError("rules file needs a top-level object with a 'version'")
+    lexicons = {}
+    for key, default in BUILTIN_LEXICONS.items():
+        terms = raw.get(key, default)
+        if not isinstance(terms, list) or not all(isinstance(t, str) and t for t in terms):
+            raise ValueError(f"'{key}' must be a list of non-empty strings")
+        lexicons[key] = [t.lower() for t in terms]
+    weights = raw.get("weights", {})
+    if not isinstance(weights, dict):
+        raise ValueError("'weights' must be an object")
+    unknown = set(weights) - set(SCORE_WEIGHTS)
+    if unknown:
+        raise ValueError(f"unknown weights: {', '.join(sorted(unknown))}")
+    # a string or NaN here would only fail later, inside every /score
+    bad = sorted(k for k, v in weights.items()
+                 if isinstance(v, bool) or not isinstance(v, (int, float)) or not math.isfinite(v))
+    if bad:
+        raise ValueError(f"weights must be finite numbers: {', '.join(bad)}")
+    return RuleSet(str(raw["version"]), lexicons, weights)
+
+_RULES_STATE = {"mtime": None, "reloads": 0, "errors": 0, "last_error": None}
+
+def _rules_mtime() -> Optional[float]:
+    try:
+        return os.stat(RULES_PATH).st_mtime
+    except OSError:
+        return None
+
+def _initial_ruleset() -> RuleSet:
+    # mtime before the read: an edit made while (or after) loading still differs at the first poll
+    _RULES_STATE["mtime"] = _rules_mtime()
+    try:
+        return _load_ruleset(RULES_PATH)
+    except FileNotFoundError:
+        return RuleSet("builtin", dict(BUILTIN_LEXICONS))
+
+# swapped as a whole on reload; a request reads RULES once and keeps that object
+RULES = _initial_ruleset()
+
+async def _reload_rules() -> RuleSet:
+    global RULES
+    mtime = _rules_mtime()
+    # json parsing + regex compilation run in a worker thread, never on the event loop
+    rules = await asyncio.to_thread(_load_ruleset, RULES_PATH)
+    RULES = rules
+    _RULES_STATE["mtime"] = mtime
+    _RULES_STATE["reloads"] += 1
+    return rules
+
+async def _watch_rules():
+    while True:
+        await asyncio.sleep(RULES_POLL_SECONDS)
+        mtime = _rules_mtime()
+        if mtime is not None and mtime != _RULES_STATE["mtime"]:
+            _RULES_STATE["mtime"] = mtime  # a bad file is reported once, not on every poll
+            try:
+                await _reload_rules()
+            except Exception as e:
+                _RULES_STATE["errors"] += 1
+                _RULES_STATE["last_error"] = str(e)
+
+def _rules_info() -> Dict[str, Any]:
+    rules = RULES
+    return {
+        "version": rules.version,
+        "loaded_at": rules.loaded_at,
+        "path": RULES_PATH,
+        "reloads": _RULES_STATE["reloads"],
+        "reload_errors": _RULES_STATE["errors"],
+        "last_error": _RULES_STATE["last_error"],
+    }
+
+@app.get("/rules")
+def rules_info():
+    return _rules_info()
+
+@app.post("/rules/reload")
+async def rules_reload():
+    try:
+        await _reload_rules()
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Rules file not found: {RULES_PATH}")
+    except (ValueError, json.JSONDecodeError, re.error) as e:
+        _RULES_STATE["errors"] += 1
+        _RULES_STATE["last_error"] = str(e)
+        raise HTTPException(status_code=400, detail=f"Invalid rules file: {e}")
+    return _rules_info()
+
+def _prompt_features(text_norm: str, rules: RuleSet) -> Dict[str, Any]:
+    """All /score signals from a single lowercased copy of the whitespace-collapsed text."""
+    low = text_norm.lower()
+    found = rules.matcher.scan(low)
     # check first ~8 words for an action verb
-    words = head.split()
-    head8 = " ".join(words[:8])
-    return any(re.search(rf"\b{re.escape(v)}\b", head8) for v in ACTION_VERBS)
-
-def _has_output_format(s: str) -> bool:
-    low = s.lower()
-    # explicit patterns like "Output JSON", code fences, braces, "return only X"
-    if re.search(r"```(json|csv|yaml|markdown)?", low): return True
-    if re.search(r"\{[^}]{3,}\}", s): return True   # looks like a JSON skeleton
-    if re.search(r"\b(return|output)\s+only\b", low): return True
-    return any(f in low for f in FORMAT_HINTS)
-
-def _has_length_limit(s: str) -> bool:
-    low = s.lower()
-    if re.search(r"\b\d+\s*(words?|tokens?|characters?|chars?|sentences?|bullets?)\b", low): return True
-    return any(p in low for p in ["no more than","at most","limit to","maximum","max "])
-
-def _has_constraints(s: str) -> bool:
-    low = s.lower()
-    return any(p in low for p in CONSTRAINT_LEX)
-
-def _too_long(s: str) -> bool:
-    # rough: > 1200 chars (~300 tokens) counts as long
-    return len(s) > 1200
-
-def _fluff_count(s: str) -> int:
-    low = s.lower()
-    return sum(low.count(w) for w in FLUFF)
-
-def _has_domain_context(s: str) -> bool:
-    low = s.lower()
-    # hint of specificity: numbers/dates/file types or domain terms
-    if re.search(r"\b(19|20)\d{2}\b", s): return True
-    if re.search(r"\b\d{2,}\b", s): return True
-    return any(w in low for w in DOMAIN_HINTS)
-
-def _build_suggestions(sig: Dict[str,bool], is_long: bool, fluff: int) -> List[str]:
+    head8 = " ".join(low.split(None, 8)[:8])
+    lex = rules.lexicons
+    return {
+        "has_task": bool(rules.action_re and rules.action_re.search(head8)),
+        # explicit patterns like "Output JSON", code fences, braces, "return only X"
+        "has_format": bool(found["format"] or _FENCE_RE.search(low)
+                           or _JSON_SKELETON_RE.search(text_norm) or _RETURN_ONLY_RE.search(low)),
+        "has_length_limit": bool(found["length"] or _LENGTH_UNIT_RE.search(low)),
+        "has_constraints": bool(found["constraint"]),
+        # hint of specificity: numbers/dates/file types or domain terms
+        "has_context": bool(found["domain"] or _NUMBER_RE.search(text_norm)),
+        "fluff": sum(found["fluff"].get(w, 0) for w in lex["fluff"]),
+        "format_hints": bool(found["format"]),
+        "constraint_keywords_found": [w for w in lex["constraint_lex"] if w in found["constraint"]],
+        "domain_terms_found": [w for w in lex["domain_hints"] if w in found["domain"]],
+    }
+
+def _too_long(s: str, weights: Optional[Dict[str, Any]] = None) -> bool:
+    w = weights or RULES.weights
+    return len(s) > w["long_chars"]
+
+def _build_suggestions(sig: Dict[str,bool], is_long: bool, fluff: int,
+                       weights: Optional[Dict[str, Any]] = None) -> List[str]:
+    w = weights or RULES.weights
     tips = []
     if not sig["has_task"]:
         tips.append("Start with a clear action verb (e.g., “Summarize”, “Classify”, “Extract”).")
@@ -296,59 +2643,61 @@ def _build_suggestions(sig: Dict[str,bool], is_long: bool, fluff: int) -> List[s
         tips.append("Add 1–2 pieces of domain context or examples to reduce ambiguity.")
     if is_long:
         tips.append("Cut filler and redundancy; keep instructions concise.")
-    if fluff >= 2:
+    if fluff >= w["fluff_tip_min"]:
         tips.append("Remove vague fillers (e.g., “kindly”, “very”, “long answer”).")
     # prioritize top 3
     return tips[:3]
 
-def _score(sig: Dict[str,bool], is_long: bool, fluff: int) -> int:
+def _score(sig: Dict[str,bool], is_long: bool, fluff: int, weights: Optional[Dict[str, Any]] = None) -> int:
+    w = weights or RULES.weights
     # Base 1; add positives; subtract penalties; clamp 1..5
-    pts = 1
-    pts += 1 if sig["has_task"] else 0
-    pts += 1 if sig["has_format"] else 0
-    pts += 1 if sig["has_length_limit"] or sig["has_constraints"] else 0
-    pts += 1 if sig["has_context"] else 0
-    if is_long: pts -= 1
-    if fluff >= 3: pts -= 1
-    return max(1, min(5, pts))
+    pts = w["base"]
+    pts += w["has_task"] if sig["has_task"] else 0
+    pts += w["has_format"] if sig["has_format"] else 0
+    pts += w["limit_or_constraints"] if sig["has_length_limit"] or sig["has_constraints"] else 0
+    pts += w["has_context"] if sig["has_context"] else 0
+    if is_long: pts += w["too_long"]
+    if fluff >= w["fluff_penalty_min"]: pts += w["fluff"]
+    return int(max(w["min_score"], min(w["max_score"], pts)))
 
 @app.post("/score", response_model=ScoreRes)
 async def score_prompt(req: ScoreReq):
-    text = _choose_text(req)
+    return _score_text(_choose_text(req))
+
+def _score_text(text: str) -> ScoreRes:
+    t0 = time.perf_counter()
     text_norm = " ".join(text.split())  # collapse whitespace
 
-    has_task        = _has_action_verb(text_norm)
-    has_format      = _has_output_format(text_norm)
-    has_len_limit   = _has_length_limit(text_norm)
-    has_constraints = _has_constraints(text_norm)
-    has_context     = _has_domain_context(text_norm)
-    is_long         = _too_long(text_norm)
-    fluff           = _fluff_count(text_norm)
+    rules = RULES  # one rule set for the whole request, even if a reload lands mid-way
+    feats = _prompt_features(text_norm, rules)
+    is_long = _too_long(text_norm, rules.weights)
+    fluff = feats["fluff"]
 
     signals = {
-    "has_task": has_task,
-    "has_format": has_format,
-    "has_length_limit": has_len_limit,
-    "has_constraints": has_constraints,
-    "has_context": has_context,
-    "too_long": is_long,
-}
+        "has_task": feats["has_task"],
+        "has_format": feats["has_format"],
+        "has_length_limit": feats["has_length_limit"],
+        "has_constraints": feats["has_constraints"],
+        "has_context": feats["has_context"],
+        "too_long": is_long,
+    }
 
-    score = _score(signals, is_long, fluff)
-    suggestions = _build_suggestions(signals, is_long, fluff)
+    score = _score(signals, is_long, fluff, rules.weights)
+    suggestions = _build_suggestions(signals, is_long, fluff, rules.weights)
 
     details = {
+        "ruleset_version": rules.version,
         "text_length_chars": len(text_norm),
         "approx_tokens": max(1, len(text_norm) // 4),
         "fluff_count": fluff,
         "detected": {
-            "format_hints": any(h in text_norm.lower() for h in FORMAT_HINTS),
-            "constraint_keywords_found": [w for w in CONSTRAINT_LEX if w in text_norm.lower()],
-            "domain_terms_found": [w for w in DOMAIN_HINTS if w in text_norm.lower()],
+            "format_hints": feats["format_hints"],
+            "constraint_keywords_found": feats["constraint_keywords_found"],
+            "domain_terms_found": feats["domain_terms_found"],
         }
     }
 
-
+    SCORE_LATENCY.observe(time.perf_counter() - t0)
     return ScoreRes(
         score=score,
         signals=signals,
@@ -356,6 +2705,31 @@ async def score_prompt(req: ScoreReq):
         details=details
     )
 
+class ScoreBatchReq(BaseModel):
+    items: List[ScoreReq]
+
+class ScoreBatchItem(BaseModel):
+    ok: bool
+    result: Optional[ScoreRes] = None
+    error: Optional[str] = None
+
+class ScoreBatchRes(BaseModel):
+    results: List[ScoreBatchItem]  # same order as items
+
+@app.post("/score/batch", response_model=ScoreBatchRes)
+def score_batch(req: ScoreBatchReq):
+    _check_batch_size(len(req.items))
+    # A plain per-item loop, on purpose: the heuristics cost ~one substring pass per lexicon term
+    # over the text, so joining the batch and scanning each term once does the same work (measured:
+    # no gain at 10-1000 items). What the batch saves is the per-request overhead.
+    results = []
+    for item in req.items:
+        try:
+            results.append(ScoreBatchItem(ok=True, result=_score_text(_choose_text(item))))
+        except Exception as e:
+            results.append(ScoreBatchItem(ok=False, error=str(e)))
+    return ScoreBatchRes(results=results)
+
 # ------------------------
 # Session Totals
 # ------------------------
@@ -364,12 +2738,16 @@ class SessionIngestReq(BaseModel):
     tokens_input: int
     tokens_total: int
     ts: Optional[int] = None  # optional, server fills if missing
+    idempotency_key: Optional[str] = None  # a retried turn with the same key is applied once
+    model: Optional[str] = None   # selects impact factors; defaults apply if omitted
+    region: Optional[str] = None
 
 class SessionTotalsRes(BaseModel):
     session_id: str
     totals: Dict[str, float]
     started_at: int
     updated_at: int
+    factors: Optional[Dict[str, Any]] = None  # factor set applied to this turn
 
 class SessionMetricsRes(BaseModel):
     session_id: str
@@ -379,70 +2757,523 @@ class SessionMetricsRes(BaseModel):
     updated_at: int
 
 @app.post("/session/ingest", response_model=SessionTotalsRes)
-def session_ingest(req: SessionIngestReq):
-    _evict_expired_sessions()
+async def session_ingest(req: SessionIngestReq):
     sid = req.session_id.strip()
     if not sid:
         raise HTTPException(status_code=400, detail="session_id required")
 
-    ts = req.ts or _now()
-    rec = SESSIONS.get(sid)
-    if not rec:
-        rec = {
-            "started_at": ts,
-            "updated_at": ts,
-            "totals": {"tokens_input": 0, "tokens_total": 0, "kwh": 0.0, "co2_kg": 0.0, "water_l": 0.0},
-            "turns": [],  # [{turn_index, ts, tokens_input, tokens_total, kwh, co2_kg, water_l}]
-        }
-        SESSIONS[sid] = rec
-
-    turn_index = len(rec["turns"]) + 1
-    per_turn = {
-        "turn_index": turn_index,
-        "ts": ts,
-        "tokens_input": int(req.tokens_input),
-        "tokens_total": int(req.tokens_total),
-        **_impact_from_tokens(int(req.tokens_total)),
-    }
-    rec["turns"].append(per_turn)
+    f = _factors(req.model, req.region)
+    return await _ingest_turn(sid, req.ts or _now(), int(req.tokens_input), int(req.tokens_total), f,
+                              req.idempotency_key)
 
-    rec["totals"]["tokens_input"] += per_turn["tokens_input"]
-    rec["totals"]["tokens_total"] += per_turn["tokens_total"]
-    rec["totals"]["kwh"] += per_turn["kwh"]
-    rec["totals"]["co2_kg"] += per_turn["co2_kg"]
-    rec["totals"]["water_l"] += per_turn["water_l"]
-    rec["updated_at"] = ts
+async def _ingest_turn(sid: str, ts: int, tokens_input: int, tokens_total: int, f: FactorSet,
+                       idempotency_key: Optional[str] = None,
+                       impact: Optional[Dict[str, float]] = None) -> SessionTotalsRes:
+    impact = impact or _impact_from_tokens(tokens_total, tokens_input, f, ts)
+    cols = TurnColumns.single(ts, tokens_input, tokens_total, impact)
+    res = await SESSION_STORE.ingest_many(sid, cols, [idempotency_key])
+    ROLLUPS.add(res["turns"])
+    rec = res["rec"]
+    SESSION_PUSH.publish_turns(sid, rec, res["turns"])
 
     return SessionTotalsRes(
         session_id=sid,
         totals=_impact_summary(rec),
         started_at=rec["started_at"],
         updated_at=rec["updated_at"],
+        factors=f.info(ts),
     )
 
 @app.get("/session/metrics", response_model=SessionMetricsRes)
-def session_metrics(session_id: str):
-    _evict_expired_sessions()
+async def session_metrics(session_id: str):
     sid = session_id.strip()
-    rec = SESSIONS.get(sid)
+    rec = await SESSION_STORE.get(sid)
     if not rec:
         raise HTTPException(status_code=404, detail="Unknown session_id")
     return SessionMetricsRes(
         session_id=sid,
         totals=_impact_summary(rec),
-        turns=rec["turns"],
+        turns=rec["cols"].dicts(),
         started_at=rec["started_at"],
         updated_at=rec["updated_at"],
     )
 
+# ------------------------
+# Bulk Session Ingest
+# ------------------------
+SESSION_BULK_MAX_TURNS = int(os.getenv("SESSION_BULK_MAX_TURNS", "10000"))
+
+class BulkTurn(BaseModel):
+    session_id: str
+    tokens_input: int
+    tokens_total: int
+    ts: Optional[int] = None
+    idempotency_key: Optional[str] = None
+    model: Optional[str] = None
+    region: Optional[str] = None
+
+class SessionBulkIngestReq(BaseModel):
+    turns: List[BulkTurn]
+
+class SessionBulkTotals(SessionTotalsRes):
+    applied: int     # turns added by this request
+    duplicates: int  # turns skipped because their idempotency_key was already seen
+
+class SessionBulkIngestRes(BaseModel):
+    sessions: List[SessionBulkTotals]
+    applied: int
+    duplicates: int
+    factors: List[Dict[str, Any]]  # each factor set used by at least one turn
+
+@app.post("/session/ingest/bulk", response_model=SessionBulkIngestRes)
+async def session_ingest_bulk(req: SessionBulkIngestReq):
+    turns = req.turns
+    if len(turns) > SESSION_BULK_MAX_TURNS:
+        raise HTTPException(status_code=413, detail=f"At most {SESSION_BULK_MAX_TURNS} turns per request")
+    sids = [t.session_id.strip() for t in turns]
+    if not all(sids):
+        raise HTTPException(status_code=400, detail="session_id required")
+
+    now = _now()
+    ts = np.fromiter((t.ts or now for t in turns), dtype=np.int64, count=len(turns))
+    order = np.argsort(ts, kind="stable")  # apply in timestamp order; ties keep request order
+    ts = ts[order]
+    tokens_input = np.fromiter((t.tokens_input for t in turns), dtype=np.int64, count=len(turns))[order]
+    tokens_total = np.fromiter((t.tokens_total for t in turns), dtype=np.int64, count=len(turns))[order]
+
+    # one vectorized pass per distinct factor set (usually one or two per request)
+    sets: Dict[int, FactorSet] = {}
+    codes = np.empty(len(turns), dtype=np.int64)
+    for pos, i in enumerate(order.tolist()):
+        f = _factors(turns[i].model, turns[i].region)
+        sets.setdefault(id(f), f)
+        codes[pos] = id(f)
+    kwh, co2, water = (np.empty(len(turns)) for _ in range(3))
+    for code, f in sets.items():
+        sel = codes == code
+        kwh[sel], co2[sel], water[sel] = _impact_columns(tokens_total[sel], tokens_input[sel], f, ts[sel])
+
+    groups: Dict[str, List[int]] = {}
+    for pos, i in enumerate(order.tolist()):
+        groups.setdefault(sids[i], []).append(pos)
+
+    async def apply(sid: str, idx: List[int]):
+        sel = np.asarray(idx)
+        cols = TurnColumns.from_columns(ts[sel], tokens_input[sel], tokens_total[sel], kwh[sel], co2[sel], water[sel])
+        keys = [turns[int(order[p])].idempotency_key for p in idx]
+        return sid, await SESSION_STORE.ingest_many(sid, cols, keys)
+
+    # concurrent so the SQLite store commits every session in one transaction
+    results = await asyncio.gather(*(apply(sid, idx) for sid, idx in groups.items()))
+    for sid, res in results:
+        ROLLUPS.add(res["turns"])
+        SESSION_PUSH.publish_turns(sid, res["rec"], res["turns"])
+
+    sessions = []
+    for sid, res in results:
+        rec = res["rec"]
+        if rec is None:
+            continue
+        last = groups[sid][-1]  # like /session/ingest: the factor set of the session's latest turn
+        sessions.append(SessionBulkTotals(
+            session_id=sid,
+            totals=_impact_summary(rec),
+            started_at=rec["started_at"],
+            updated_at=rec["updated_at"],
+            factors=sets[int(codes[last])].info(int(ts[last])),
+            applied=res["applied"],
+            duplicates=res["duplicates"],
+        ))
+    return SessionBulkIngestRes(
+        sessions=sessions,
+        applied=sum(r["applied"] for _, r in results),
+        duplicates=sum(r["duplicates"] for _, r in results),
+        factors=[f.info() for f in sets.values()],
+    )
+
 class SessionResetReq(BaseModel):
     session_id: str
 
 @app.post("/session/reset")
-def session_reset(req: SessionResetReq):
-    SESSIONS.pop(req.session_id, None)
+async def session_reset(req: SessionResetReq):
+    await SESSION_STORE.reset(req.session_id)
+    SESSION_PUSH.publish(req.session_id, {"type": "reset", "session_id": req.session_id, "totals": None})
     return {"ok": True}
 
+# ------------------------
+# Session Push (SSE / WebSocket)
+# ------------------------
+SESSION_PUSH_MAX_SUBSCRIBERS = int(os.getenv("SESSION_PUSH_MAX_SUBSCRIBERS", "10000"))
+SESSION_PUSH_KEEPALIVE_SECONDS = float(os.getenv("SESSION_PUSH_KEEPALIVE_SECONDS", "15"))
+SESSION_PUSH_SEND_TIMEOUT_SECONDS = float(os.getenv("SESSION_PUSH_SEND_TIMEOUT_SECONDS", "5"))
+SESSION_PUSH_POLL_MS = float(os.getenv("SESSION_PUSH_POLL_MS", "100"))  # change feed relay interval
+SESSION_PUSH_RELAY_BATCH = 5000
+
+class SessionSubscriber:
+    """One connected client. Holds at most one pending message: deltas published while the
+    client is still sending are summed into it, so a slow client costs O(1) memory and the
+    publisher never waits on it."""
+
+    __slots__ = ("pending", "event", "closed", "seq", "coalesced")
+
+    def __init__(self):
+        self.pending: Optional[Dict[str, Any]] = None
+        self.event = asyncio.Event()
+        self.closed = False
+        self.seq = 0
+        self.coalesced = 0  # deltas merged into an unsent one
+
+    def offer(self, msg: Dict[str, Any]):
+        if msg["type"] == "delta" and self.pending is not None and self.pending["type"] == "delta":
+            merged = self.pending["delta"]
+            for k, v in msg["delta"].items():
+                merged[k] = round(merged[k] + v, 6) if isinstance(v, float) else merged[k] + v
+            self.pending.update(totals=msg["totals"], updated_at=msg["updated_at"],
+                                coalesced=self.pending["coalesced"] + 1)
+            self.coalesced += 1
+        elif msg["type"] == "delta" and self.pending is not None and self.pending["type"] == "reset":
+            # the client still has to see the reset; the delta's totals already count from it
+            self.pending.update(totals=msg["totals"], updated_at=msg["updated_at"])
+            self.coalesced += 1
+        else:
+            # a reset (or the first delta) replaces whatever is pending; totals stay authoritative
+            # (copied: the published dict is shared by every subscriber and the pending one gets merged into)
+            self.pending = {**msg, "delta": dict(msg["delta"]), "coalesced": 0} if msg["type"] == "delta" else dict(msg)
+        self.event.set()
+
+    def close(self):
+        self.closed = True
+        self.event.set()
+
+    async def next(self, timeout: float) -> Optional[Dict[str, Any]]:
+        """Next message, or None after `timeout` seconds idle (time for a keepalive)."""
+        if self.pending is None and not self.closed:
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        self.event.clear()
+        msg, self.pending = self.pending, None
+        if msg is not None:
+            self.seq += 1
+            msg = {**msg, "seq": self.seq}
+        return msg
+
+class SessionBroadcaster:
+    """In-process fan-out: one publish per ingest, O(1) per subscriber, no per-client queues.
+
+    Each worker process has its own. With `relayed` (the session store's change feed is on),
+    publish() does nothing: every worker delivers from the feed instead, so a client sees
+    ingests from all workers, in commit order, whichever worker it is connected to.
+    """
+
+    def __init__(self, max_subscribers: int, relayed: bool = False):
+        self.max_subscribers = max_subscribers
+        self.relayed = relayed
+        self.subs: Dict[str, set] = {}
+        self.count = 0
+        self.published = 0
+        self.dropped_slow = 0
+        self.relay_errors = 0
+
+    def subscribe(self, sid: str) -> SessionSubscriber:
+        if self.count >= self.max_subscribers:
+            raise HTTPException(status_code=503, detail="Too many session subscribers")
+        sub = SessionSubscriber()
+        self.subs.setdefault(sid, set()).add(sub)
+        self.count += 1
+        return sub
+
+    def unsubscribe(self, sid: str, sub: SessionSubscriber):
+        subs = self.subs.get(sid)
+        if subs and sub in subs:
+            subs.discard(sub)
+            self.count -= 1
+            if not subs:
+                del self.subs[sid]
+
+    def has(self, sid: str) -> bool:
+        return sid in self.subs
+
+    def deliver(self, sid: str, msg: Dict[str, Any]):
+        subs = self.subs.get(sid)
+        if not subs:
+            return
+        self.published += 1
+        for sub in subs:
+            sub.offer(msg)
+
+    def publish(self, sid: str, msg: Dict[str, Any]):
+        if not self.relayed:
+            self.deliver(sid, msg)
+
+    def publish_turns(self, sid: str, rec: Optional[Dict[str, Any]], cols: "TurnColumns"):
+        if not cols or rec is None or sid not in self.subs:
+            return
+        self.publish(sid, {"type": "delta", "session_id": sid, "delta": {"turns": len(cols), **cols.sums()},
+                           "totals": _impact_summary(rec), "updated_at": rec["updated_at"]})
+
+    def stats(self) -> Dict[str, int]:
+        return {"subscribers": self.count, "sessions": len(self.subs), "published": self.published,
+                "dropped_slow": self.dropped_slow, "relayed": self.relayed, "relay_errors": self.relay_errors}
+
+SESSION_PUSH = SessionBroadcaster(SESSION_PUSH_MAX_SUBSCRIBERS, relayed=SESSION_CHANGE_FEED)
+
+async def _relay_session_changes():
+    """Deliver the store's change feed to this worker's subscribers (one read per poll for all of them)."""
+    after = None
+    while True:
+        try:
+            if after is None or not SESSION_PUSH.subs:
+                # nobody to deliver to (yet): just follow the tail; a new subscriber gets a snapshot first
+                after = await SESSION_STORE.last_change()
+            else:
+                rows = [None] * SESSION_PUSH_RELAY_BATCH
+                while len(rows) == SESSION_PUSH_RELAY_BATCH:  # catch up before sleeping again
+                    rows = await SESSION_STORE.changes(after, SESSION_PUSH_RELAY_BATCH)
+                    for seq, sid, kind, payload in rows:
+                        if SESSION_PUSH.has(sid):
+                            SESSION_PUSH.deliver(sid, {"type": kind, "session_id": sid, **json.loads(payload)})
+                        after = seq
+        except Exception:
+            SESSION_PUSH.relay_errors += 1
+        await asyncio.sleep(SESSION_PUSH_POLL_MS / 1000.0)
+
+async def _push_snapshot(sid: str) -> Dict[str, Any]:
+    rec = await SESSION_STORE.summary(sid)
+    if not rec:
+        return {"type": "totals", "session_id": sid, "totals": None, "started_at": None, "updated_at": None}
+    return {"type": "totals", "session_id": sid, "totals": _impact_summary(rec),
+            "started_at": rec["started_at"], "updated_at": rec["updated_at"]}
+
+@app.get("/session/subscribe")
+async def session_subscribe_sse(session_id: str):
+    """Server-sent events: a `totals` snapshot, then a `delta` per ingest (coalesced if the client lags)
+    and a `reset` when the session is reset (its `totals`: null, or what was ingested since)."""
+    sid = session_id.strip()
+    if not sid:
+        raise HTTPException(status_code=400, detail="session_id required")
+    # subscribe before the snapshot so no ingest falls in between (a delta already counted in the
+    # snapshot may follow, which is why every message also carries the new totals), and before the
+    # response starts so a 503 is still a status code
+    sub = SESSION_PUSH.subscribe(sid)
+
+    async def events():
+        try:
+            yield _sse("totals", await _push_snapshot(sid))
+            while True:
+                msg = await sub.next(SESSION_PUSH_KEEPALIVE_SECONDS)
+                yield ": keepalive\n\n" if msg is None else _sse(msg["type"], msg)
+        finally:
+            SESSION_PUSH.unsubscribe(sid, sub)
+
+    async def release():
+        # also runs when the client left before the generator was first entered
+        SESSION_PUSH.unsubscribe(sid, sub)
+
+    return StreamingResponse(events(), media_type="text/event-stream", background=BackgroundTask(release),
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.websocket("/session/ws")
+async def session_subscribe_ws(ws: WebSocket, session_id: str):
+    """Same messages as /session/subscribe as JSON frames; a client that cannot take a frame
+    within SESSION_PUSH_SEND_TIMEOUT_SECONDS is disconnected (1013)."""
+    sid = session_id.strip()
+    if not sid:
+        await ws.close(code=1008)
+        return
+    if SESSION_PUSH.count >= SESSION_PUSH.max_subscribers:
+        await ws.close(code=1013)
+        return
+    await ws.accept()
+    sub = SESSION_PUSH.subscribe(sid)
+
+    async def read_until_close():
+        # client frames are ignored; this only notices the disconnect while we wait for deltas
+        try:
+            while (await ws.receive())["type"] != "websocket.disconnect":
+                pass
+        finally:
+            sub.close()
+
+    reader = asyncio.create_task(read_until_close())
+    try:
+        await asyncio.wait_for(ws.send_json(await _push_snapshot(sid)), SESSION_PUSH_SEND_TIMEOUT_SECONDS)
+        while True:
+            msg = await sub.next(SESSION_PUSH_KEEPALIVE_SECONDS)
+            if sub.closed:
+                break
+            await asyncio.wait_for(ws.send_json(msg or {"type": "ping"}), SESSION_PUSH_SEND_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        SESSION_PUSH.dropped_slow += 1
+        try:
+            await ws.close(code=1013)
+        except Exception:
+            pass
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        reader.cancel()
+        SESSION_PUSH.unsubscribe(sid, sub)
+
+
+@register_metric_collector
+def _session_metrics():
+    st = SESSION_STORE.stats()
+    return [
+        ("session_store_sessions", "gauge", "Sessions held by the session store.", [({}, st["sessions"])]),
+        ("session_store_turns", "gauge", "Turns held by the session store.", [({}, st["turns"])]),
+        ("session_evicted_total", "counter", "Sessions evicted by the TTL sweeper.",
+         [({}, SESSION_SWEEP_STATS["evicted"])]),
+        ("rollup_late_turns_total", "counter", "Turns older than a rollup ring's retention on arrival.",
+         [({"bucket": k}, v) for k, v in ROLLUPS.stats()["late"].items()]),
+        ("session_push_subscribers", "gauge", "Connected session push subscribers.",
+         [({}, SESSION_PUSH.count)]),
+        ("session_push_dropped_slow_total", "counter", "WebSocket subscribers closed for not keeping up.",
+         [({}, SESSION_PUSH.dropped_slow)]),
+    ]
+
+@app.get("/session/stats")
+async def session_stats():
+    return {"backend": SESSION_STORE.name, **SESSION_STORE.stats(), "sweeper": dict(SESSION_SWEEP_STATS),
+            "rollups": ROLLUPS.stats(), "push": SESSION_PUSH.stats()}
+
+# ------------------------
+# Analyze (count + score + impact + session in one call)
+# ------------------------
+ANALYZE_SECTIONS = ("count", "score", "impact", "session")
+
+class AnalyzeReq(BaseModel):
+    # the prompt, as for /score: raw text or messages[] (last user turn)
+    text: Optional[str] = None
+    messages: Optional[List[Dict[str, Any]]] = None
+    model: str = "claude-3-5-haiku-20241022"
+    expected_output_tokens: Optional[int] = None
+    mode: str = "exact"              # count mode, as for /count
+    region: Optional[str] = None
+    include: List[str] = ["count", "score", "impact"]  # sections to compute; add "session" to record the turn
+    session_id: Optional[str] = None  # required with "session"
+    idempotency_key: Optional[str] = None
+    ts: Optional[int] = None
+
+class AnalyzeImpact(BaseModel):
+    tokens_input: int
+    tokens_total: int                # tokens_input + output estimate
+    kwh: float
+    co2_kg: float
+    water_l: float
+    factors: Dict[str, Any]
+
+class AnalyzeRes(BaseModel):
+    # sections not in `include` are not computed and stay null
+    count: Optional[CountRes] = None
+    score: Optional[ScoreRes] = None
+    impact: Optional[AnalyzeImpact] = None
+    session: Optional[SessionTotalsRes] = None
+
+@app.post("/analyze", response_model=AnalyzeRes)
+async def analyze(req: AnalyzeReq):
+    """One round trip for what the extension does per prompt: /count, /score and /session/ingest."""
+    include = set(req.include)
+    unknown = include - set(ANALYZE_SECTIONS)
+    if unknown or not include:
+        raise HTTPException(status_code=400, detail=f"include must be a non-empty subset of {', '.join(ANALYZE_SECTIONS)}")
+    sid = (req.session_id or "").strip()
+    if "session" in include and not sid:
+        raise HTTPException(status_code=400, detail="session_id required to record the turn")
+
+    text = _choose_text(ScoreReq(text=req.text, messages=req.messages))
+    out = AnalyzeRes()
+    if not include & {"count", "impact", "session"}:
+        out.score = _score_text(text)
+        return out
+
+    creq = CountReq(text=text, model=req.model, expected_output_tokens=req.expected_output_tokens,
+                    mode=req.mode, region=req.region)
+    if "score" not in include:
+        count = await _count(creq)
+    else:
+        # score once the count has sent its upstream request (or finished: cache hit, local mode),
+        # so the scoring CPU time overlaps the network wait instead of delaying the send
+        sent = asyncio.Event()
+        token = UPSTREAM_WAIT_SIGNAL.set(sent)
+        counting = asyncio.create_task(_count(creq))
+        UPSTREAM_WAIT_SIGNAL.reset(token)
+        waiting = asyncio.create_task(sent.wait())
+        try:
+            await asyncio.wait({counting, waiting}, return_when=asyncio.FIRST_COMPLETED)
+            out.score = _score_text(text)
+        except BaseException:
+            counting.cancel()
+            raise
+        finally:
+            waiting.cancel()
+        count = await counting
+    if "count" in include:
+        out.count = count
+    ts = req.ts or _now()
+    f = _factors(req.model, req.region)
+    tokens_input, tokens_total = count.tokens_input, count.tokens_total_estimate
+    impact = _impact_from_tokens(tokens_total, tokens_input, f, ts)
+    if "impact" in include:
+        out.impact = AnalyzeImpact(tokens_input=tokens_input, tokens_total=tokens_total,
+                                   factors=f.info(ts), **impact)
+    if "session" in include:
+        out.session = await _ingest_turn(sid, ts, tokens_input, tokens_total, f, req.idempotency_key, impact)
+    return out
+
+# ------------------------
+# Aggregate Queries
+# ------------------------
+class AggregateRes(BaseModel):
+    start: int           # range actually covered, widened to bucket boundaries
+    end: int
+    bucket: str
+    totals: Dict[str, float]
+    tokens_per_turn: Dict[str, Optional[float]]  # approximate percentiles of tokens_total
+    partial: bool        # start is older than the chosen resolution retains
+    series: Optional[Dict[str, List[float]]] = None  # columnar, one entry per bucket
+
+@app.get("/aggregate", response_model=AggregateRes)
+def aggregate(start: Optional[int] = None, end: Optional[int] = None, bucket: Optional[str] = None,
+              percentiles: str = "50,90,99", series: bool = False):
+    """Totals across all sessions for [start, end] from the rollup buckets; cost is O(buckets), not O(turns)."""
+    now = _now()
+    end = now if end is None else end
+    start = end - 3600 if start is None else start
+    if end < start:
+        raise HTTPException(status_code=400, detail="end must be >= start")
+    if bucket is not None and bucket not in ROLLUPS.rings:
+        raise HTTPException(status_code=400, detail=f"bucket must be one of {', '.join(ROLLUPS.rings)}")
+    try:
+        qs = [float(q) for q in percentiles.split(",") if q.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="percentiles must be comma-separated numbers")
+    if any(not 0 <= q <= 100 for q in qs):
+        raise HTTPException(status_code=400, detail="percentiles must be within 0..100")
+
+    name = bucket or ROLLUPS.pick(start, now)
+    ring = ROLLUPS.rings[name]
+    # only buckets the ring can hold, so the query size is bounded whatever range is asked for
+    lo, hi = max(start, ring.oldest(now)), min(end, now)
+    with ROLLUPS.locked(exclusive=False):
+        buckets, sums, sketch = ring.query(lo, hi)
+    totals = sums.sum(axis=0)
+    out = AggregateRes(
+        # nothing retained overlaps the range: empty totals over the range as asked
+        start=int(buckets[0]) * ring.seconds if len(buckets) else start,
+        end=(int(buckets[-1]) + 1) * ring.seconds - 1 if len(buckets) else end,
+        bucket=name,
+        totals={f: (round(float(v), 6) if f in ("kwh", "co2_kg", "water_l") else float(v))
+                for f, v in zip(ROLLUP_FIELDS, totals)},
+        tokens_per_turn=ROLLUPS.sketch.quantiles(sketch, qs),
+        partial=start < ring.oldest(now),
+    )
+    if series:
+        out.series = {"start": (buckets * ring.seconds).tolist(),
+                      **{f: np.round(sums[:, i], 6).tolist() for i, f in enumerate(ROLLUP_FIELDS)}}
+    return out
+
 
 # ------------------------
 # What-if Scenarios
@@ -453,13 +3284,17 @@ class WhatIfReq(BaseModel):
     trim_pct: float = 0.0              # 0..1, reduces input tokens
     smaller_model_factor: float = 1.0  # 0..1, multiplies output tokens (e.g., 0.6)
     cache_hit_pct: float = 0.0         # 0..1, reduces total tokens proportionally
+    model: Optional[str] = None        # impact factors; defaults apply if omitted
+    region: Optional[str] = None
 
 class WhatIfRes(BaseModel):
     baseline: Dict[str, float]
     scenarios: Dict[str, Dict[str, Any]]
+    factors: Optional[Dict[str, Any]] = None
 
-def _impact_pack(total_tokens: int) -> Dict[str, float]:
-    d = _impact_from_tokens(total_tokens)
+def _impact_pack(total_tokens: int, tokens_input: Optional[float] = None,
+                 factors: Optional[FactorSet] = None, ts: Optional[int] = None) -> Dict[str, float]:
+    d = _impact_from_tokens(total_tokens, tokens_input, factors, ts)
     return {"tokens_total": total_tokens, **d}
 
 def _delta(after: Dict[str, float], before: Dict[str, float]) -> Dict[str, float]:
@@ -470,71 +3305,312 @@ def _delta(after: Dict[str, float], before: Dict[str, float]) -> Dict[str, float
         "water_l": round(after["water_l"] - before["water_l"], 6),
     }
 
+def _scaled_input(tokens_input: int, before_total: int, after_total: int) -> float:
+    # a proportional cut on the total keeps the input/output mix (matters when their factors differ)
+    return tokens_input * after_total / before_total if before_total else 0.0
+
 @app.post("/whatif", response_model=WhatIfRes)
 def whatif(req: WhatIfReq):
+    f = _factors(req.model, req.region)
+    now = _now()
+
     # Baseline
     baseline_total = int(req.tokens_input) + int(req.tokens_output)
-    baseline = _impact_pack(baseline_total)
+    baseline = _impact_pack(baseline_total, req.tokens_input, f, now)
 
     # Trim → affects input
     trimmed_input = max(0, int(req.tokens_input * (1.0 - req.trim_pct)))
     trim_total = trimmed_input + req.tokens_output
-    trim = _impact_pack(trim_total)
+    trim = _impact_pack(trim_total, trimmed_input, f, now)
     trim["delta"] = _delta(trim, baseline)
 
     # Smaller model → affects output
     smaller_output = max(0, int(req.tokens_output * float(req.smaller_model_factor)))
     small_total = req.tokens_input + smaller_output
-    small = _impact_pack(small_total)
+    small = _impact_pack(small_total, req.tokens_input, f, now)
     small["delta"] = _delta(small, baseline)
 
     # Cache → proportional reduction on total
     cached_total = max(0, int(baseline_total * (1.0 - req.cache_hit_pct)))
-    cache = _impact_pack(cached_total)
+    cache = _impact_pack(cached_total, _scaled_input(req.tokens_input, baseline_total, cached_total), f, now)
     cache["delta"] = _delta(cache, baseline)
 
     # Combined: trim → smaller → cache
-    combined_total = trimmed_input + smaller_output
-    combined_total = max(0, int(combined_total * (1.0 - req.cache_hit_pct)))
-    combined = _impact_pack(combined_total)
+    pre_cache_total = trimmed_input + smaller_output
+    combined_total = max(0, int(pre_cache_total * (1.0 - req.cache_hit_pct)))
+    combined = _impact_pack(combined_total, _scaled_input(trimmed_input, pre_cache_total, combined_total), f, now)
     combined["delta"] = _delta(combined, baseline)
 
     return WhatIfRes(
         baseline=baseline,
         scenarios={"trim": trim, "smaller_model": small, "cache": cache, "combined": combined},
+        factors=f.info(now),
+    )
+
+@app.get("/factors")
+def factors_info():
+    return FACTORS.describe()
+
+# ------------------------
+# What-if Grid Sweep
+# ------------------------
+WHATIF_SWEEP_MAX_POINTS = int(os.getenv("WHATIF_SWEEP_MAX_POINTS", "200000"))
+
+class SweepRange(BaseModel):
+    start: float
+    stop: float
+    num: int = 11  # evenly spaced, both ends included (np.linspace)
+
+class WhatIfBaseline(BaseModel):
+    tokens_input: int
+    tokens_output: int
+
+class WhatIfSweepReq(BaseModel):
+    tokens_input: Optional[int] = None   # single baseline, or use baselines
+    tokens_output: Optional[int] = None
+    baselines: Optional[List[WhatIfBaseline]] = None
+    trim_pct: Union[float, List[float], SweepRange] = 0.0
+    smaller_model_factor: Union[float, List[float], SweepRange] = 1.0
+    cache_hit_pct: Union[float, List[float], SweepRange] = 0.0
+    model: Optional[str] = None
+    region: Optional[str] = None
+
+class WhatIfSweepRes(BaseModel):
+    axes: Dict[str, Any]                    # values along each dimension
+    baseline: Dict[str, List[float]]        # per baseline
+    scenarios: Dict[str, Dict[str, Any]]    # dims, plus C-order flattened columns over those dims
+    factors: Dict[str, Any]
+
+def _sweep_len(name: str, v) -> int:
+    # from the request alone, so an oversized grid is refused before anything is allocated
+    if isinstance(v, SweepRange):
+        if v.num < 1:
+            raise HTTPException(status_code=400, detail=f"{name}.num must be >= 1")
+        return v.num
+    if isinstance(v, list):
+        if not v:
+            raise HTTPException(status_code=400, detail=f"{name} must not be empty")
+        return len(v)
+    return 1
+
+def _sweep_axis(v) -> np.ndarray:
+    if isinstance(v, SweepRange):
+        return np.linspace(v.start, v.stop, v.num)
+    return np.atleast_1d(np.asarray(v, dtype=np.float64))
+
+def _impact_grid(total: np.ndarray, tokens_input: np.ndarray, base: Dict[str, np.ndarray],
+                 f: FactorSet, ts: int) -> Dict[str, Any]:
+    """Columns for one scenario; base arrays broadcast against total (same math as _impact_pack/_delta)."""
+    kwh, co2, water = _impact_columns(total, tokens_input, f, ts)
+    cols = {"tokens_total": total, "kwh": kwh, "co2_kg": co2, "water_l": water}
+    delta = {"tokens_total": total - base["tokens_total"]}
+    for k in ("kwh", "co2_kg", "water_l"):
+        delta[k] = np.round(cols[k] - base[k], 6)
+    return {**{k: v.ravel().tolist() for k, v in cols.items()},
+            "delta": {k: v.ravel().tolist() for k, v in delta.items()}}
+
+@app.post("/whatif/sweep", response_model=WhatIfSweepRes)
+def whatif_sweep(req: WhatIfSweepReq):
+    """Every /whatif scenario over the grid baseline x trim_pct x smaller_model_factor x cache_hit_pct."""
+    if req.baselines:
+        pairs = [(b.tokens_input, b.tokens_output) for b in req.baselines]
+    elif req.tokens_input is not None and req.tokens_output is not None:
+        pairs = [(req.tokens_input, req.tokens_output)]
+    else:
+        raise HTTPException(status_code=400, detail="tokens_input/tokens_output or baselines required")
+    points = len(pairs)
+    for name in ("trim_pct", "smaller_model_factor", "cache_hit_pct"):
+        points *= _sweep_len(name, getattr(req, name))
+    if points > WHATIF_SWEEP_MAX_POINTS:
+        raise HTTPException(status_code=413, detail=f"Grid has {points} points; limit is {WHATIF_SWEEP_MAX_POINTS}")
+    trim_pct = _sweep_axis(req.trim_pct)
+    smaller = _sweep_axis(req.smaller_model_factor)
+    cache_hit = _sweep_axis(req.cache_hit_pct)
+    f = _factors(req.model, req.region)
+    now = _now()
+
+    # dims: b = baseline, t = trim, s = smaller model, c = cache; shaped so they broadcast
+    tin = np.array([p[0] for p in pairs], dtype=np.int64)[:, None, None, None]
+    tout = np.array([p[1] for p in pairs], dtype=np.int64)[:, None, None, None]
+    t = trim_pct[None, :, None, None]
+    sm = smaller[None, None, :, None]
+    c = cache_hit[None, None, None, :]
+
+    base_total = tin + tout
+    bkwh, bco2, bwater = _impact_columns(base_total, tin, f, now)
+    base = {"tokens_total": base_total, "kwh": bkwh, "co2_kg": bco2, "water_l": bwater}
+
+    # int() truncation and max(0, ...) exactly as in whatif()
+    trimmed_input = np.maximum(0, np.trunc(tin * (1.0 - t)).astype(np.int64))
+    smaller_output = np.maximum(0, np.trunc(tout * sm).astype(np.int64))
+    cached_total = np.maximum(0, np.trunc(base_total * (1.0 - c)).astype(np.int64))
+    combined_total = np.maximum(0, np.trunc((trimmed_input + smaller_output) * (1.0 - c)).astype(np.int64))
+    # input share of proportional cuts, as _scaled_input()
+    cached_input = np.divide(tin * cached_total, base_total, out=np.zeros(cached_total.shape),
+                             where=base_total > 0)
+    pre_cache = trimmed_input + smaller_output
+    combined_input = np.divide(trimmed_input * combined_total, pre_cache, out=np.zeros(combined_total.shape),
+                               where=pre_cache > 0)
+
+    return WhatIfSweepRes(
+        axes={
+            "baseline": {"tokens_input": tin.ravel().tolist(), "tokens_output": tout.ravel().tolist()},
+            "trim_pct": trim_pct.tolist(),
+            "smaller_model_factor": smaller.tolist(),
+            "cache_hit_pct": cache_hit.tolist(),
+        },
+        baseline={k: v.ravel().tolist() for k, v in base.items()},
+        scenarios={
+            "trim": {"dims": ["baseline", "trim_pct"],
+                     **_impact_grid(trimmed_input + tout, trimmed_input, base, f, now)},
+            "smaller_model": {"dims": ["baseline", "smaller_model_factor"],
+                              **_impact_grid(tin + smaller_output, tin, base, f, now)},
+            "cache": {"dims": ["baseline", "cache_hit_pct"],
+                      **_impact_grid(cached_total, cached_input, base, f, now)},
+            "combined": {"dims": ["baseline", "trim_pct", "smaller_model_factor", "cache_hit_pct"],
+                         **_impact_grid(combined_total, combined_input, base, f, now)},
+        },
+        factors=f.info(now),
     )
 
 
 # ------------------------
-# Metrics Export (CSV/JSON)
+# Metrics Export (CSV/JSON/NDJSON/Parquet/Arrow)
 # ------------------------
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "5000"))
+EXPORT_MEDIA_TYPES = {
+    "json": "application/json",
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+RANGE_EXPORT_FORMATS = ("csv", "ndjson", "parquet", "arrow")
+
+def _export_format(format: str, allowed) -> str:
+    fmt = format.lower()
+    if fmt not in allowed:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(allowed)}")
+    # pyarrow is optional; only these two formats need it
+    if fmt in ("parquet", "arrow") and importlib.util.find_spec("pyarrow") is None:
+        raise HTTPException(status_code=501, detail=f"{fmt} export requires pyarrow")
+    return fmt
+
+def _batch_rows(fields: List[str], batch: Dict[str, np.ndarray]):
+    return zip(*(batch[f].tolist() for f in fields))
+
+async def _csv_stream(fields: List[str], batches):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(fields)
+    async for batch in batches:
+        writer.writerows(_batch_rows(fields, batch))
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+    if out.tell():
+        yield out.getvalue()
+
+async def _ndjson_stream(fields: List[str], batches):
+    async for batch in batches:
+        yield "".join(json.dumps(dict(zip(fields, row)), separators=(",", ":")) + "\n"
+                      for row in _batch_rows(fields, batch))
+
+class _ByteSink(io.RawIOBase):
+    """Write-only file for pyarrow writers; drain() hands over what was written since the last call."""
+
+    def __init__(self):
+        self._parts: List[bytes] = []
+        self._pos = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._parts.append(bytes(b))
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self) -> int:
+        return self._pos  # writers record offsets from this, so it must not reset on drain
+
+    def drain(self) -> bytes:
+        out = b"".join(self._parts)
+        self._parts.clear()
+        return out
+
+async def _arrow_stream(fields: List[str], batches, fmt: str):
+    import pyarrow as pa
+    schema = pa.schema([
+        (f, pa.string() if f == "session_id" else pa.int64() if EXPORT_DTYPES[f] is np.int64 else pa.float64())
+        for f in fields
+    ])
+    sink = _ByteSink()
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(sink, schema)  # one row group per chunk
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+    try:
+        async for batch in batches:
+            writer.write_batch(pa.record_batch([batch[f] for f in fields], schema=schema))
+            data = sink.drain()
+            if data:
+                yield data
+    finally:
+        writer.close()
+    yield sink.drain()
+
+def _export_response(fields: List[str], batches, fmt: str, filename: str) -> StreamingResponse:
+    if fmt == "csv":
+        body = _csv_stream(fields, batches)
+    elif fmt == "ndjson":
+        body = _ndjson_stream(fields, batches)
+    else:
+        body = _arrow_stream(fields, batches, fmt)
+    return StreamingResponse(
+        body,
+        media_type=EXPORT_MEDIA_TYPES[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{fmt}"'},
+    )
+
+async def _json_session_stream(sid: str, rec: Dict[str, Any], batches):
+    # same document as before, written incrementally: turns go out chunk by chunk
+    dumps = lambda v: json.dumps(v, separators=(",", ":"))
+    yield f'{{"session_id":{dumps(sid)},"totals":{dumps(_impact_summary(rec))},"turns":['
+    sep = ""
+    async for batch in batches:
+        body = ",".join(dumps(dict(zip(TURN_FIELDS, row))) for row in _batch_rows(TURN_FIELDS, batch))
+        if body:
+            yield sep + body
+            sep = ","
+    yield f'],"started_at":{rec["started_at"]},"updated_at":{rec["updated_at"]}}}'
+
 @app.get("/session/export")
-def session_export(session_id: str, format: str = "json"):
-    _evict_expired_sessions()
+async def session_export(session_id: str, format: str = "json"):
+    fmt = _export_format(format, EXPORT_MEDIA_TYPES)
     sid = session_id.strip()
-    rec = SESSIONS.get(sid)
+    rec = await SESSION_STORE.summary(sid)
     if not rec:
         raise HTTPException(status_code=404, detail="Unknown session_id")
 
-    if format.lower() == "csv":
-        output = io.StringIO()
-        writer = csv.writer(output)
-        writer.writerow(["turn_index", "ts", "tokens_input", "tokens_total", "kwh", "co2_kg", "water_l"])
-        for t in rec["turns"]:
-            writer.writerow([t["turn_index"], t["ts"], t["tokens_input"], t["tokens_total"], t["kwh"], t["co2_kg"], t["water_l"]])
-        output.seek(0)
-        return StreamingResponse(
-            iter([output.getvalue()]),
-            media_type="text/csv",
-            headers={"Content-Disposition": f'attachment; filename="session_{sid}.csv"'}
-        )
-
-    # default JSON
-    return {
-        "session_id": sid,
-        "totals": _impact_summary(rec),
-        "turns": rec["turns"],
-        "started_at": rec["started_at"],
-        "updated_at": rec["updated_at"],
-    }
+    batches = SESSION_STORE.iter_turns(sid, EXPORT_CHUNK_ROWS)
+    if fmt == "json":
+        return StreamingResponse(_json_session_stream(sid, rec, batches), media_type="application/json")
+    return _export_response(TURN_FIELDS, batches, fmt, f"session_{sid}")
+
+@app.get("/session/export/range")
+async def session_export_range(start: int = 0, end: Optional[int] = None, format: str = "ndjson"):
+    """Every live session's turns with start <= ts <= end, streamed with a session_id column."""
+    fmt = _export_format(format, RANGE_EXPORT_FORMATS)
+    end = _now() if end is None else end
+    if end < start:
+        raise HTTPException(status_code=400, detail="end must be >= start")
+
+    async def batches():
+        async for sid, batch in SESSION_STORE.iter_range(start, end, EXPORT_CHUNK_ROWS):
+            batch["session_id"] = np.full(len(batch["ts"]), sid, dtype=object)
+            yield batch
+
+    return _export_response(["session_id"] + TURN_FIELDS, batches(), fmt, f"sessions_{start}_{end}")
 
@@ -0,0 +1,46 @@
+import asyncio
+import json
+import os
+import sys
+
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+os.environ.setdefault("ANTHROPIC_API_KEY", "test")
+os.environ.setdefault("SESSION_STORE", "memory")
+os.environ.setdefault("ROLLUP_SHARED_PATH", "")
+
+import httpx  # noqa: E402
+import server  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+# what the fake Anthropic API does; tests change it through the `upstream` fixture
+UPSTREAM = {"count_delay": 0.0, "fail": False, "calls": 0}
+
+async def _handler(request: httpx.Request) -> httpx.Response:
+    UPSTREAM["calls"] += 1
+    if UPSTREAM["count_delay"]:
+        await asyncio.sleep(UPSTREAM["count_delay"])
+    if UPSTREAM["fail"]:
+        return httpx.Response(529, json={"error": {"type": "overloaded_error"}})
+    body = json.loads(request.content)
+    if request.url.path.endswith("count_tokens"):
+        text = body["messages"][0]["content"]
+        return httpx.Response(200, json={"input_tokens": max(1, len(text) // 4)})
+    return httpx.Response(200, json={"content": [{"type": "text", "text": "Revised:\nok"}]})
+
+@pytest.fixture
+def upstream():
+    UPSTREAM.update(count_delay=0.0, fail=False, calls=0)
+    yield UPSTREAM
+    UPSTREAM.update(count_delay=0.0, fail=False, calls=0)
+
+@pytest.fixture
+def client(upstream):
+    with TestClient(server.app) as c:
+        # after startup: the lifespan would otherwise open a real upstream client
+        server._UPSTREAM["client"] = httpx.AsyncClient(transport=httpx.MockTransport(_handler),
+                                                       headers=server.ANTHROPIC_HEADERS)
+        server._UPSTREAM["slots"] = asyncio.Semaphore(server.UPSTREAM_MAX_CONNECTIONS)
+        yield c
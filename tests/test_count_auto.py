@@ -0,0 +1,60 @@
+import time
+
+import pytest
+
+import server
+
+MODEL = "claude-3-5-haiku-20241022"
+
+@pytest.fixture(autouse=True)
+def fresh_auto_state(monkeypatch):
+    monkeypatch.setattr(server, "COUNT_AUTO_BUDGET_MS", 100.0)
+    monkeypatch.setitem(server.COUNT_LATENCY, "ewma_ms", 0.0)
+    monkeypatch.setitem(server.COUNT_LATENCY, "samples", 0)
+    monkeypatch.setitem(server.COUNT_AUTO_PROBE, "task", None)
+    monkeypatch.setitem(server.COUNT_AUTO_PROBE, "at", 0.0)
+    breaker = server.UPSTREAM_LIMITERS["count"].breaker
+    yield
+    breaker.state, breaker.consecutive, breaker.probing = "closed", 0, False
+
+def _auto(client, text):
+    t0 = time.perf_counter()
+    r = client.post("/count", json={"text": text, "model": MODEL, "mode": "auto"})
+    assert r.status_code == 200
+    return r.json(), time.perf_counter() - t0
+
+def test_healthy_upstream_is_raced_and_exact(client, upstream):
+    body, _ = _auto(client, "healthy " * 40)
+    assert body["exact"] and upstream["calls"] == 1
+
+def test_slow_upstream_is_skipped_once_ewma_is_over_budget(client, upstream):
+    upstream["count_delay"] = 0.3
+    body, took = _auto(client, "slow one " * 40)
+    assert not body["exact"] and took < 0.25      # raced, lost, answered at the budget
+    time.sleep(0.4)                                # the raced call finishes in the background
+    assert server.COUNT_LATENCY["ewma_ms"] > server.COUNT_AUTO_BUDGET_MS
+    calls = upstream["calls"]
+    server.COUNT_AUTO_PROBE["at"] = time.monotonic()   # no probe due yet
+    body, took = _auto(client, "slow two " * 40)
+    assert not body["exact"] and took < 0.05 and upstream["calls"] == calls
+    stats = client.get("/count/local/stats").json()
+    assert not stats["upstream_healthy"] and stats["auto"]["local_unhealthy"] >= 1
+
+def test_open_breaker_answers_locally_and_probes_at_most_once(client, upstream):
+    upstream["count_delay"] = 0.3
+    server.UPSTREAM_LIMITERS["count"].breaker.state = "open"
+    server.UPSTREAM_LIMITERS["count"].breaker.opened_at = time.monotonic()
+    for i in range(5):
+        body, took = _auto(client, f"breaker {i} " * 40)
+        assert not body["exact"] and took < 0.05
+    assert upstream["calls"] == 0     # the probe is refused by the open breaker itself
+
+def test_probe_lets_auto_mode_recover(client, upstream):
+    server.COUNT_LATENCY["ewma_ms"] = 1.5 * server.COUNT_AUTO_BUDGET_MS
+    server.COUNT_LATENCY["samples"] = 1
+    body, _ = _auto(client, "recover " * 40)      # local; starts one background probe
+    assert not body["exact"]
+    time.sleep(0.1)
+    assert upstream["calls"] == 1 and server.COUNT_LATENCY["ewma_ms"] < server.COUNT_AUTO_BUDGET_MS
+    body, _ = _auto(client, "recovered " * 40)
+    assert body["exact"]
@@ -0,0 +1,81 @@
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+import pytest
+
+from conftest import REPO
+
+MODEL = "claude-3-5-haiku-20241022"
+
+def test_delta_continues_from_revision(client):
+    r = client.post("/count", json={"text": "x" * 400, "model": MODEL}).json()
+    assert r["exact"] and r["tokens_input"] == 100
+    d = client.post("/count", json={"base_revision": r["revision"], "delta": "y" * 40, "model": MODEL})
+    assert d.status_code == 200
+    assert d.json()["tokens_input"] == 110 and not d.json()["exact"]
+    d2 = client.post("/count", json={"base_revision": d.json()["revision"], "delta": "", "removed_chars": 80,
+                                     "model": MODEL})
+    assert d2.json()["tokens_input"] == 90
+
+def test_forged_or_foreign_revision_is_unknown(client):
+    rev = client.post("/count", json={"text": "x" * 400, "model": MODEL}).json()["revision"]
+    forged = rev[:-2] + ("AA" if rev[-2:] != "AA" else "BB")
+    for base, model in ((forged, MODEL), (rev, "claude-3-opus-20240229"), ("nope", MODEL)):
+        r = client.post("/count", json={"base_revision": base, "delta": "y", "model": model})
+        assert r.status_code == 409
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _wait_ready(url: str, proc: subprocess.Popen, timeout: float = 30.0):
+    t_end = time.time() + timeout
+    while time.time() < t_end:
+        assert proc.poll() is None, f"exited with {proc.returncode} before {url} was ready"
+        try:
+            if httpx.get(url, timeout=1.0).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    raise AssertionError(f"{url} not ready after {timeout}s")
+
+def test_revision_works_on_any_gunicorn_worker(tmp_path):
+    pytest.importorskip("gunicorn")
+    mock_port, api_port = _free_port(), _free_port()
+    mock = subprocess.Popen([sys.executable, os.path.join(REPO, "benchmarks", "mock_anthropic.py"),
+                             "--port", str(mock_port), "--latency-ms", "0", "--count-latency-ms", "5",
+                             "--jitter-ms", "0"])
+    env = {**os.environ, "ANTHROPIC_API_KEY": "offline-test", "WEB_CONCURRENCY": "3",
+           "ANTHROPIC_BASE_URL": f"http://127.0.0.1:{mock_port}", "RULES_POLL_SECONDS": "0",
+           "SESSION_DB_PATH": str(tmp_path / "sessions.sqlite3"),
+           "ROLLUP_SHARED_PATH": str(tmp_path / "rollups.mmap")}
+    env.pop("SESSION_STORE", None)
+    api = subprocess.Popen([sys.executable, "-m", "gunicorn", "server:app", "-c", "gunicorn.conf.py",
+                            "--bind", f"127.0.0.1:{api_port}", "--log-level", "warning"], cwd=REPO, env=env)
+    url = f"http://127.0.0.1:{api_port}"
+
+    async def pair(i: int) -> int:
+        # separate connections, so the delta is free to land on another worker
+        async with httpx.AsyncClient(base_url=url, timeout=10.0) as c:
+            rev = (await c.post("/count", json={"text": f"prompt {i} " * 50, "model": MODEL})).json()["revision"]
+        async with httpx.AsyncClient(base_url=url, timeout=10.0) as c:
+            return (await c.post("/count", json={"base_revision": rev, "delta": " more", "model": MODEL})).status_code
+
+    async def run() -> list:
+        return await asyncio.gather(*(pair(i) for i in range(60)))
+
+    try:
+        _wait_ready(f"http://127.0.0.1:{mock_port}/mock/stats", mock)
+        _wait_ready(f"{url}/health", api)
+        assert asyncio.run(run()) == [200] * 60
+    finally:
+        for p in (api, mock):
+            p.terminate()
+            p.wait(timeout=30)
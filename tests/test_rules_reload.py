@@ -0,0 +1,29 @@
+import json
+import os
+import shutil
+import time
+
+from fastapi.testclient import TestClient
+
+import server
+from conftest import REPO
+
+def test_edit_right_after_startup_is_reloaded(tmp_path, monkeypatch):
+    path = tmp_path / "rules.json"
+    shutil.copy(os.path.join(REPO, "scoring_rules.json"), path)
+    monkeypatch.setattr(server, "RULES_PATH", str(path))
+    monkeypatch.setattr(server, "RULES_POLL_SECONDS", 0.05)
+    monkeypatch.setattr(server, "RULES", server._initial_ruleset())   # as at import
+
+    # edited before the watcher's first poll
+    raw = json.loads(path.read_text())
+    raw["version"] = "edited-after-startup"
+    path.write_text(json.dumps(raw))
+    st = os.stat(path)
+    os.utime(path, (st.st_atime, st.st_mtime + 1))
+
+    with TestClient(server.app) as client:
+        deadline = time.time() + 2
+        while time.time() < deadline and client.get("/rules").json()["version"] != "edited-after-startup":
+            time.sleep(0.05)
+        assert client.get("/rules").json()["version"] == "edited-after-startup"
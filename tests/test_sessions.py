@@ -0,0 +1,47 @@
+import asyncio
+import sqlite3
+
+import server
+
+def _ingest(store, sid, keys):
+    async def run():
+        cols = server.TurnColumns()
+        for _ in keys:
+            cols.append(server._now(), 10, 20, {"kwh": 1.0, "co2_kg": 1.0, "water_l": 1.0})
+        return await store.ingest_many(sid, cols, list(keys))
+    return asyncio.run(run())
+
+def test_sqlite_keeps_the_same_idempotency_keys_as_memory(tmp_path):
+    stores = [server.MemorySessionStore({}, 3600, 5),
+              server.SQLiteSessionStore(str(tmp_path / "s.sqlite3"), 3600, 5, 0)]
+    for store in stores:
+        for i in range(0, 20, 4):
+            _ingest(store, "s", [f"k{j}" for j in range(i, i + 4)] + [None])
+        # the last five keys are still seen; older ones were trimmed with the turns
+        assert _ingest(store, "s", ["k19", "k15"])["duplicates"] == 2
+        assert _ingest(store, "s", ["k14"])["duplicates"] == 0
+    db = sqlite3.connect(str(tmp_path / "s.sqlite3"))
+    assert db.execute("SELECT COUNT(*) FROM turn_keys").fetchone()[0] == 5
+
+def test_sqlite_store_upgrades_old_turn_keys(tmp_path):
+    path = str(tmp_path / "old.sqlite3")
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE turn_keys (session_id TEXT NOT NULL, key TEXT NOT NULL,"
+               " PRIMARY KEY (session_id, key)) WITHOUT ROWID")
+    db.execute("INSERT INTO turn_keys VALUES ('s', 'old')")
+    db.commit()
+    db.close()
+    store = server.SQLiteSessionStore(path, 3600, 2, 0)
+    assert _ingest(store, "s", ["old"])["duplicates"] == 1
+    _ingest(store, "s", ["a", "b", "c"])
+    assert _ingest(store, "s", ["old"])["duplicates"] == 0
+
+def test_bulk_totals_report_factors(client):
+    r = client.post("/session/ingest/bulk", json={"turns": [
+        {"session_id": "bulk-a", "tokens_input": 10, "tokens_total": 50},
+        {"session_id": "bulk-b", "tokens_input": 10, "tokens_total": 50, "model": "claude-3-opus-20240229"},
+    ]})
+    assert r.status_code == 200, r.text
+    single = client.post("/session/ingest", json={"session_id": "one", "tokens_input": 10, "tokens_total": 50})
+    for s in r.json()["sessions"]:
+        assert s["factors"] and s["factors"].keys() == single.json()["factors"].keys()